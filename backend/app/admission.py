@@ -0,0 +1,234 @@
+import math
+import threading
+import logging
+from typing import Callable, Dict, List, Optional, Set
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+# Adds a job to the client's set only while the set is below the limit (0: no
+# limit), so concurrent submissions cannot all pass the check
+_TRY_ACQUIRE_SCRIPT = """
+local limit = tonumber(ARGV[2])
+if limit > 0 and redis.call('SCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SET', KEYS[2], ARGV[4], 'EX', ARGV[3])
+return 1
+"""
+
+
+def client_identity(request: Request) -> str:
+    """Who a job is charged to: explicit X-Client-Id, else the remote address"""
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "unknown")
+
+
+class ThroughputEstimator:
+    """Exponentially weighted average of measured job durations"""
+
+    def __init__(self, default_job_seconds: float, alpha: float = 0.2):
+        self.alpha = alpha
+        self.avg_job_seconds = default_job_seconds
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def record(self, duration_seconds: float):
+        if duration_seconds <= 0:
+            return
+        with self._lock:
+            if self.samples == 0:
+                self.avg_job_seconds = duration_seconds
+            else:
+                self.avg_job_seconds += self.alpha * (duration_seconds - self.avg_job_seconds)
+            self.samples += 1
+
+    def jobs_per_second(self, workers: int) -> float:
+        return max(1, workers) / max(self.avg_job_seconds, 0.001)
+
+
+class ClientSlots:
+    """In-process record of which client owns which unfinished job"""
+
+    def __init__(self):
+        self._jobs: Dict[str, Set[str]] = {}
+        self._owners: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, client_id: str, job_id: str, limit: int) -> bool:
+        """Acquire unless the client already has ``limit`` jobs (0: no limit), in one step"""
+        with self._lock:
+            jobs = self._jobs.setdefault(client_id, set())
+            if limit and len(jobs) >= limit:
+                return False
+            jobs.add(job_id)
+            self._owners[job_id] = client_id
+            return True
+
+    def release(self, job_id: str):
+        with self._lock:
+            client_id = self._owners.pop(job_id, None)
+            if client_id is not None:
+                jobs = self._jobs.get(client_id, set())
+                jobs.discard(job_id)
+                if not jobs:
+                    self._jobs.pop(client_id, None)
+
+    def active(self, client_id: str) -> int:
+        with self._lock:
+            return len(self._jobs.get(client_id, ()))
+
+
+class RedisClientSlots:
+    """Per-client unfinished jobs in Redis, shared by every API replica.
+
+    Finished jobs are released lazily: they are pruned whenever a client's
+    count is read, using ``is_finished(job_id)``. ``release`` is for jobs
+    that were refused or never submitted. Blocking; call from a thread.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        is_finished: Callable[[str], bool],
+        ttl_seconds: int = 86400,
+        prefix: str = "admission:client:",
+        owner_prefix: str = "admission:job:",
+    ):
+        self.redis = redis_client
+        self.is_finished = is_finished
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self.owner_prefix = owner_prefix
+        self._try_acquire = redis_client.register_script(_TRY_ACQUIRE_SCRIPT)
+
+    def try_acquire(self, client_id: str, job_id: str, limit: int) -> bool:
+        """Acquire unless the client already has ``limit`` unfinished jobs (0: no limit), atomically"""
+        if limit:
+            # Finished jobs must not count against the limit
+            self.active(client_id)
+        acquired = self._try_acquire(
+            keys=[self.prefix + client_id, self.owner_prefix + job_id],
+            args=[job_id, limit, self.ttl_seconds, client_id],
+        )
+        return bool(acquired)
+
+    def release(self, job_id: str):
+        owner_key = self.owner_prefix + job_id
+        client_id = self.redis.get(owner_key)
+        if client_id is None:
+            return
+        client_id = client_id.decode() if isinstance(client_id, bytes) else client_id
+        pipe = self.redis.pipeline()
+        pipe.srem(self.prefix + client_id, job_id)
+        pipe.delete(owner_key)
+        pipe.execute()
+
+    def active(self, client_id: str) -> int:
+        key = self.prefix + client_id
+        members = [m.decode() if isinstance(m, bytes) else m for m in self.redis.smembers(key)]
+        finished = [job_id for job_id in members if self.is_finished(job_id)]
+        if finished:
+            self.redis.srem(key, *finished)
+        return len(members) - len(finished)
+
+
+class AdmissionController:
+    """Decides whether a new job may be queued, based on backlog and drain time.
+
+    - per-client limit exceeded        -> 429
+    - queue depth or estimated wait
+      above the configured threshold   -> 503
+    Both carry a Retry-After computed from measured throughput.
+    """
+
+    def __init__(
+        self,
+        max_queue_depth: int,
+        max_wait_seconds: float,
+        max_jobs_per_client: int,
+        default_job_seconds: float,
+    ):
+        self.max_queue_depth = max_queue_depth
+        self.max_wait_seconds = max_wait_seconds
+        self.max_jobs_per_client = max_jobs_per_client
+        self.throughput = ThroughputEstimator(default_job_seconds)
+        self.rejected = {"client_limit": 0, "queue_depth": 0, "wait_time": 0}
+
+    def estimated_wait(self, queue_depth: int, workers: int) -> float:
+        """Seconds until a job submitted now would start"""
+        return queue_depth / self.throughput.jobs_per_second(workers)
+
+    def check(self, queue_depth: int, workers: int, client_active: int = 0):
+        """Raise HTTPException(429/503) with Retry-After if the job must not be admitted"""
+        rate = self.throughput.jobs_per_second(workers)
+
+        if self.max_jobs_per_client and client_active >= self.max_jobs_per_client:
+            self._reject_client_limit()
+
+        if queue_depth >= self.max_queue_depth:
+            self.rejected["queue_depth"] += 1
+            retry_after = (queue_depth - self.max_queue_depth + 1) / rate
+            self._reject(503, f"Job queue is full ({queue_depth} waiting)", retry_after)
+
+        wait = self.estimated_wait(queue_depth, workers)
+        if wait > self.max_wait_seconds:
+            self.rejected["wait_time"] += 1
+            self._reject(503, f"Estimated wait {int(wait)}s exceeds {int(self.max_wait_seconds)}s", wait - self.max_wait_seconds)
+
+    def admit(self, slots, client_id: str, job_id: str, queue_depth: int, workers: int):
+        """Take one of the client's slots for ``job_id``, then check the backlog.
+
+        The per-client limit is enforced by ``slots.try_acquire`` in one step,
+        so concurrent submissions cannot all pass it; the slot is released
+        again when the backlog refuses the job.
+        """
+        if not slots.try_acquire(client_id, job_id, self.max_jobs_per_client):
+            self._reject_client_limit()
+        try:
+            self.check(queue_depth, workers)
+        except HTTPException:
+            slots.release(job_id)
+            raise
+
+    def _reject_client_limit(self):
+        self.rejected["client_limit"] += 1
+        # One of the client's own jobs should finish within about one job time
+        retry_after = self.throughput.avg_job_seconds
+        self._reject(429, f"Too many concurrent jobs for this client (limit {self.max_jobs_per_client})", retry_after)
+
+    def _reject(self, status_code: int, detail: str, retry_after: float):
+        retry_after = max(1, math.ceil(retry_after))
+        logger.warning(f"Admission rejected ({status_code}): {detail}; retry after {retry_after}s")
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
+
+    def snapshot(self, queue_depth: Optional[int] = None, workers: int = 1) -> dict:
+        snapshot = {
+            "avg_job_seconds": round(self.throughput.avg_job_seconds, 1),
+            "throughput_samples": self.throughput.samples,
+            "max_queue_depth": self.max_queue_depth,
+            "max_wait_seconds": self.max_wait_seconds,
+            "max_jobs_per_client": self.max_jobs_per_client,
+            "rejected": dict(self.rejected),
+        }
+        if queue_depth is not None:
+            snapshot["queue_depth"] = queue_depth
+            snapshot["estimated_wait_seconds"] = round(self.estimated_wait(queue_depth, workers), 1)
+        return snapshot
+
+
+def redis_queue_keys(queue: str) -> List[str]:
+    """Kombu stores each priority level in its own list: the queue name for the
+    default priority and ``<queue>\\x06\\x16<n>`` for the others.
+    """
+    return [queue] + [f"{queue}\x06\x16{priority}" for priority in (1, 2, 3, 4, 5, 6, 7, 8, 9)]
+
+
+def redis_queue_depth(redis_client, queue: str) -> int:
+    """Messages waiting in a Celery queue on the Redis broker"""
+    pipe = redis_client.pipeline()
+    for key in redis_queue_keys(queue):
+        pipe.llen(key)
+    return sum(pipe.execute())
@@ -0,0 +1,418 @@
+import argparse
+import fnmatch
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import redis
+from celery.worker import state as worker_state
+from celery.worker.autoscale import Autoscaler
+from pydantic import BaseModel
+
+from .admission import ThroughputEstimator, redis_queue_depth, redis_queue_keys
+from .config import settings
+from .cpu_slots import get_slot_pool
+
+logger = logging.getLogger(__name__)
+
+QUEUE = "face_swap"
+ENQUEUED_AT_HEADER = "enqueued_at"
+DESIRED_REPLICAS_KEY = "autoscaler:face_swap"
+# GPU-stage tasks whose runtimes size the pool
+SCALED_TASKS = {"app.tasks.process_face_swap", "app.tasks.swap_job", "app.tasks.bulk_face_swap"}
+# Workers consuming QUEUE are started as ``face_swap@<host>`` and media
+# workers as ``media@<host>`` (docker-compose.yml); task events do not carry
+# a worker's queue subscriptions, so the node name is what tells them apart
+FACE_SWAP_WORKERS = "face_swap@*"
+
+
+class ScalingSignals(BaseModel):
+    backlog: int  # queued + running jobs
+    oldest_wait_seconds: float = 0.0
+    current: int
+    avg_job_seconds: float
+    busy: int = 0
+    cpu_per_job: Optional[float] = None  # cores
+    memory_per_job_mb: Optional[float] = None
+    cpus: Optional[float] = None
+    memory_available_mb: Optional[float] = None
+
+
+class ScalingDecision(BaseModel):
+    current: int
+    desired: int
+    wanted: int  # before hysteresis and step limits
+    reason: str
+
+    @property
+    def changed(self) -> bool:
+        return self.desired != self.current
+
+
+class ScalingPolicy:
+    """Decide how many workers the backlog needs.
+
+    Enough workers to drain the backlog within ``target_wait_seconds`` (never
+    more than there are jobs), one more whenever the oldest job has waited
+    past ``max_job_age_seconds``, capped by what the measured per-job CPU and
+    memory use lets the host fit. Growing happens at once, up to ``max_step``
+    per decision; shrinking only after the surplus has lasted
+    ``scale_down_delay_seconds``, one worker at a time.
+    """
+
+    def __init__(
+        self,
+        min_workers: int,
+        max_workers: int,
+        target_wait_seconds: float = 300.0,
+        max_job_age_seconds: float = 600.0,
+        scale_down_delay_seconds: float = 300.0,
+        memory_reserve_mb: float = 2048.0,
+        max_step: int = 2,
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target_wait_seconds = target_wait_seconds
+        self.max_job_age_seconds = max_job_age_seconds
+        self.scale_down_delay_seconds = scale_down_delay_seconds
+        self.memory_reserve_mb = memory_reserve_mb
+        self.max_step = max_step
+        self._surplus_since: Optional[float] = None
+
+    def resource_limit(self, signals: ScalingSignals) -> Tuple[Optional[int], str]:
+        limits = []
+        if signals.cpu_per_job and signals.cpus:
+            limits.append((int(signals.cpus // max(signals.cpu_per_job, 0.1)), "cpu"))
+        if signals.memory_per_job_mb and signals.memory_available_mb is not None:
+            # Memory the running jobs hold now would be available to them anyway
+            usable = signals.memory_available_mb - self.memory_reserve_mb + signals.memory_per_job_mb * signals.busy
+            limits.append((int(usable // signals.memory_per_job_mb), "memory"))
+        if not limits:
+            return None, ""
+        limit, resource = min(limits)
+        return max(limit, signals.busy, 0), resource
+
+    def decide(self, signals: ScalingSignals, now: Optional[float] = None) -> ScalingDecision:
+        now = time.monotonic() if now is None else now
+        current = signals.current
+        work_seconds = signals.backlog * signals.avg_job_seconds
+        wanted = min(signals.backlog, math.ceil(work_seconds / max(self.target_wait_seconds, 1.0)))
+        reason = f"backlog {signals.backlog} x {signals.avg_job_seconds:.0f}s"
+        if signals.oldest_wait_seconds > self.max_job_age_seconds and signals.backlog > current:
+            wanted = max(wanted, current + 1)
+            reason += f", oldest job waited {signals.oldest_wait_seconds:.0f}s"
+        limit, resource = self.resource_limit(signals)
+        if limit is not None and wanted > limit:
+            wanted = limit
+            reason += f", capped at {limit} by {resource}"
+        wanted = min(self.max_workers, max(self.min_workers, wanted))
+
+        if wanted > current:
+            self._surplus_since = None
+            desired = min(wanted, current + self.max_step)
+        elif wanted < current:
+            if self._surplus_since is None:
+                self._surplus_since = now
+            held = now - self._surplus_since
+            if held >= self.scale_down_delay_seconds:
+                desired = current - 1
+                # The next step down waits a full delay again
+                self._surplus_since = now
+            else:
+                desired = current
+                reason += f", holding ({held:.0f}/{self.scale_down_delay_seconds:.0f}s)"
+        else:
+            self._surplus_since = None
+            desired = current
+        return ScalingDecision(current=current, desired=desired, wanted=wanted, reason=reason)
+
+
+def policy_from_settings(min_workers: Optional[int] = None, max_workers: Optional[int] = None) -> ScalingPolicy:
+    return ScalingPolicy(
+        min_workers=settings.autoscale_min_workers if min_workers is None else min_workers,
+        max_workers=settings.autoscale_max_workers if max_workers is None else max_workers,
+        target_wait_seconds=settings.autoscale_target_wait_seconds,
+        max_job_age_seconds=settings.autoscale_max_job_age_seconds,
+        scale_down_delay_seconds=settings.autoscale_scale_down_delay_seconds,
+        memory_reserve_mb=settings.autoscale_memory_reserve_mb,
+    )
+
+
+def oldest_wait_seconds(redis_client, queue: str = QUEUE, now: Optional[float] = None) -> float:
+    """Age of the oldest queued message, from the ``enqueued_at`` header stamped at publish"""
+    now = time.time() if now is None else now
+    pipe = redis_client.pipeline()
+    for key in redis_queue_keys(queue):
+        # Kombu pushes on the left and consumes from the right
+        pipe.lindex(key, -1)
+    oldest = None
+    for raw in pipe.execute():
+        if not raw:
+            continue
+        try:
+            enqueued_at = float(json.loads(raw)["headers"][ENQUEUED_AT_HEADER])
+        except (ValueError, KeyError, TypeError):
+            continue
+        oldest = enqueued_at if oldest is None else min(oldest, enqueued_at)
+    return max(0.0, now - oldest) if oldest is not None else 0.0
+
+
+def face_swap_workers(snapshot: Dict, hostname_pattern: str = FACE_SWAP_WORKERS) -> List[str]:
+    """Alive workers of a cluster snapshot that consume the face_swap queue"""
+    return [
+        hostname for hostname, worker in snapshot.get("workers", {}).items()
+        if worker["alive"] and fnmatch.fnmatch(hostname, hostname_pattern)
+    ]
+
+
+def face_swap_tasks(snapshot: Dict, kinds: Iterable[str] = ("active_tasks", "reserved_tasks")) -> int:
+    """Face-swap tasks (``SCALED_TASKS``) of a cluster snapshot, on any worker"""
+    return sum(
+        1 for kind in kinds for tasks in snapshot.get(kind, {}).values()
+        for task in tasks if task.get("name") in SCALED_TASKS
+    )
+
+
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def process_tree(pid: int) -> List[int]:
+    """``pid`` and all its descendants (FaceFusion and ffmpeg under a pool process)"""
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        try:
+            for task_dir in os.listdir(f"/proc/{current}/task"):
+                stack += [int(child) for child in _read(f"/proc/{current}/task/{task_dir}/children").split()]
+        except (OSError, ValueError):
+            continue
+    return pids
+
+
+def process_usage(pids: Iterable[int]) -> Tuple[float, float]:
+    """(resident MB, CPU seconds) summed over live processes"""
+    page_mb = os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    ticks = os.sysconf("SC_CLK_TCK")
+    rss_mb = cpu_seconds = 0.0
+    for pid in pids:
+        try:
+            rss_mb += int(_read(f"/proc/{pid}/statm").split()[1]) * page_mb
+            # Fields after the parenthesised command name; utime and stime are 14 and 15
+            fields = _read(f"/proc/{pid}/stat").rsplit(")", 1)[1].split()
+            cpu_seconds += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, ValueError, IndexError):
+            continue
+    return rss_mb, cpu_seconds
+
+
+def memory_available_mb() -> Optional[float]:
+    try:
+        for line in _read("/proc/meminfo").splitlines():
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class JobResourceSampler:
+    """Per-job CPU and memory use measured over the pool's process trees"""
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.cpu_per_job: Optional[float] = None
+        self.memory_per_job_mb: Optional[float] = None
+        self._last: Optional[Tuple[float, float]] = None
+
+    def _blend(self, current: Optional[float], value: float) -> float:
+        return value if current is None else current + self.alpha * (value - current)
+
+    def sample(self, root_pids: Iterable[int], busy: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        rss_mb, cpu_seconds = process_usage(pid for root in root_pids for pid in process_tree(root))
+        last, self._last = self._last, (now, cpu_seconds)
+        if busy <= 0:
+            return
+        self.memory_per_job_mb = self._blend(self.memory_per_job_mb, rss_mb / busy)
+        # Exited processes drop out of the sum, so only count increases
+        if last is not None and now > last[0] and cpu_seconds >= last[1]:
+            self.cpu_per_job = self._blend(self.cpu_per_job, (cpu_seconds - last[1]) / (now - last[0]) / busy)
+
+
+def log_decision(decision: ScalingDecision, dry_run: bool, unit: str = "processes"):
+    if decision.changed:
+        prefix = "[dry-run] would scale" if dry_run else "Scaling"
+        logger.info(f"{prefix} {unit} {decision.current} -> {decision.desired}: {decision.reason}")
+    else:
+        logger.debug(f"Keeping {decision.current} {unit}: {decision.reason}")
+
+
+class QueueAutoscaler(Autoscaler):
+    """Celery pool autoscaler driven by the broker backlog.
+
+    Enable with ``--autoscale=MAX,MIN`` (``worker_autoscaler`` points here).
+    Celery's stock autoscaler only counts messages the worker has already
+    prefetched, which with a prefetch multiplier of 1 never exceeds the
+    pool size, so it cannot see a growing queue. With CPU slots the pool is
+    capped at the slot count.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        slot_pool = get_slot_pool()
+        if slot_pool is not None:
+            self.max_concurrency = min(self.max_concurrency, len(slot_pool.slots))
+        self.policy = policy_from_settings(self.min_concurrency, self.max_concurrency)
+        self.dry_run = settings.autoscale_dry_run
+        self.throughput = ThroughputEstimator(settings.admission_default_job_seconds)
+        self.sampler = JobResourceSampler()
+        self.cpus = len(os.sched_getaffinity(0))
+        self._redis = None
+        self._active: Dict[str, float] = {}
+        self._next_check = 0.0
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis.Redis.from_url(self.worker.app.conf.broker_url)
+        return self._redis
+
+    def _track_runtimes(self):
+        """Record how long requests ran once they leave the active set"""
+        now = time.time()
+        active = {
+            request.id: request.time_start or now
+            for request in list(worker_state.active_requests)
+            if request.name in SCALED_TASKS
+        }
+        for request_id, started in self._active.items():
+            if request_id not in active:
+                self.throughput.record(now - started)
+        self._active = active
+
+    def _pool_pids(self) -> List[int]:
+        try:
+            return list(self.pool.info.get("processes", []))
+        except Exception:
+            return []
+
+    def signals(self) -> ScalingSignals:
+        busy = len(self._active)
+        self.sampler.sample(self._pool_pids(), busy)
+        return ScalingSignals(
+            backlog=redis_queue_depth(self.redis, QUEUE) + self.qty,
+            oldest_wait_seconds=oldest_wait_seconds(self.redis),
+            current=self.processes,
+            avg_job_seconds=self.throughput.avg_job_seconds,
+            busy=busy,
+            cpu_per_job=self.sampler.cpu_per_job,
+            memory_per_job_mb=self.sampler.memory_per_job_mb,
+            cpus=self.cpus,
+            memory_available_mb=memory_available_mb(),
+        )
+
+    def _maybe_scale(self, req=None):
+        self._track_runtimes()
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + settings.autoscale_interval_seconds
+        try:
+            decision = self.policy.decide(self.signals(), now)
+        except redis.RedisError as e:
+            logger.warning(f"Autoscaler could not read the broker: {e}")
+            return False
+        log_decision(decision, self.dry_run)
+        if self.dry_run or not decision.changed:
+            return False
+        if decision.desired > decision.current:
+            self.scale_up(decision.desired - decision.current)
+        else:
+            # The policy already applied the scale-down delay
+            self._shrink(decision.current - decision.desired)
+        return True
+
+
+def run_replica_controller(
+    interval: float,
+    dry_run: bool,
+    scale_command: Optional[str] = None,
+    hostname_pattern: str = FACE_SWAP_WORKERS,
+) -> None:
+    """Publish the desired number of ``face_swap`` worker replicas for an orchestrator.
+
+    The decision is stored under ``DESIRED_REPLICAS_KEY`` on the broker Redis
+    and, when ``scale_command`` is given, applied by running it with
+    ``{replicas}`` filled in (e.g. ``docker compose up -d --no-recreate
+    --scale celery-worker={replicas}``).
+    """
+    from .celery_app import celery_app
+    from .celery_monitor import ClusterStateMonitor
+
+    monitor = ClusterStateMonitor(celery_app, throughput_tasks=SCALED_TASKS)
+    monitor.start()
+    broker = redis.Redis.from_url(celery_app.conf.broker_url)
+    policy = policy_from_settings()
+    throughput = ThroughputEstimator(settings.admission_default_job_seconds)
+    try:
+        while True:
+            time.sleep(interval)
+            snapshot = monitor.snapshot()
+            workers = face_swap_workers(snapshot, hostname_pattern)
+            running = face_swap_tasks(snapshot)
+            runtimes = [t["avg_runtime_seconds"] for t in snapshot.get("throughput", {}).values() if t["avg_runtime_seconds"]]
+            if runtimes:
+                throughput.record(sum(runtimes) / len(runtimes))
+            try:
+                signals = ScalingSignals(
+                    backlog=redis_queue_depth(broker, QUEUE) + running,
+                    oldest_wait_seconds=oldest_wait_seconds(broker),
+                    current=len(workers),
+                    avg_job_seconds=throughput.avg_job_seconds,
+                    busy=running,
+                )
+            except redis.RedisError as e:
+                logger.warning(f"Autoscaler could not read the broker: {e}")
+                continue
+            decision = policy.decide(signals)
+            log_decision(decision, dry_run, unit="replicas")
+            if dry_run:
+                continue
+            broker.set(
+                DESIRED_REPLICAS_KEY,
+                json.dumps({**decision.dict(), "updated_at": time.time()}),
+                ex=int(max(60, interval * 4)),
+            )
+            if decision.changed and scale_command:
+                subprocess.run(scale_command.format(replicas=decision.desired), shell=True, check=False)
+    finally:
+        monitor.stop()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.autoscaler",
+        description="Emit desired face_swap worker replicas from queue depth and job age",
+    )
+    parser.add_argument("--interval", type=float, default=settings.autoscale_interval_seconds)
+    parser.add_argument("--dry-run", action="store_true", default=settings.autoscale_dry_run,
+                        help="Only log the decisions")
+    parser.add_argument("--scale-command", help="Shell command run on changes; {replicas} is substituted")
+    parser.add_argument("--hostname-pattern", default=FACE_SWAP_WORKERS,
+                        help="Glob of the face_swap workers' node names")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    run_replica_controller(args.interval, args.dry_run, args.scale_command, args.hostname_pattern)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
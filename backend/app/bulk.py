@@ -0,0 +1,336 @@
+import argparse
+import csv
+import hashlib
+import json
+import sys
+import threading
+import time
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+MANIFEST_HELP = """\
+Each row names a source image, a target video, an output path and optional
+FaceFusion options as a JSON object, e.g. {"face_detector_score": 0.6}.
+CSV manifests need a header row (source,target,output,options); JSONL
+manifests have one object per line. Relative paths are resolved against the
+manifest's directory; with --backend celery they must be on the volume the
+workers share.
+
+Rows whose output already exists are skipped, so an interrupted run resumes
+when started again. Interrupting a run (Ctrl-C) revokes its Celery jobs or,
+with --backend local, stops after the chunks being rendered. Rows with
+identical inputs and options are rendered once and copied to every output.
+"""
+
+
+class BulkCancelled(Exception):
+    """Raised inside a local render once the run has been interrupted"""
+
+
+class ManifestRow(BaseModel):
+    line: int
+    source: Path
+    target: Path
+    output: Path
+    options: Dict[str, Any] = {}
+
+
+class BulkJob(BaseModel):
+    job_id: str
+    source: Path
+    target: Path
+    options: Dict[str, Any] = {}
+    outputs: List[Path]
+
+
+def load_manifest(path: Path) -> List[ManifestRow]:
+    """Read a CSV or JSONL manifest"""
+    base = path.parent
+    if path.suffix.lower() in (".jsonl", ".ndjson"):
+        entries = [
+            (number, json.loads(line))
+            for number, line in enumerate(path.read_text().splitlines(), 1)
+            if line.strip()
+        ]
+    else:
+        with path.open(newline="") as f:
+            # Line 1 is the header
+            entries = list(enumerate(csv.DictReader(f), 2))
+
+    rows = []
+    for number, entry in entries:
+        missing = [key for key in ("source", "target", "output") if not entry.get(key)]
+        if missing:
+            raise ValueError(f"{path}:{number}: missing {', '.join(missing)}")
+        options = entry.get("options") or {}
+        if isinstance(options, str):
+            options = json.loads(options)
+        rows.append(ManifestRow(
+            line=number,
+            source=base / entry["source"],
+            target=base / entry["target"],
+            output=base / entry["output"],
+            options=options,
+        ))
+    return rows
+
+
+def file_digest(path: Path, cache: Dict[Path, str]) -> str:
+    """sha256 of a file's contents, computed once per path"""
+    path = path.resolve()
+    if path not in cache:
+        digest = hashlib.sha256()
+        with path.open("rb") as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(block)
+        cache[path] = digest.hexdigest()
+    return cache[path]
+
+
+def plan_bulk(rows: List[ManifestRow]) -> Tuple[List[BulkJob], List[ManifestRow]]:
+    """Group pending rows by (source, target, options) content; returns (jobs, skipped rows)"""
+    digests: Dict[Path, str] = {}
+    jobs: Dict[str, BulkJob] = {}
+    skipped = []
+    for row in rows:
+        if row.output.is_file():
+            skipped.append(row)
+            continue
+        key = hashlib.sha256("|".join([
+            file_digest(row.source, digests),
+            file_digest(row.target, digests),
+            json.dumps(row.options, sort_keys=True),
+        ]).encode()).hexdigest()[:32]
+        job = jobs.get(key)
+        if job is None:
+            # A stable id lets a re-run resume from the job's chunk checkpoint
+            jobs[key] = BulkJob(job_id=f"bulk-{key}", source=row.source, target=row.target,
+                                options=row.options, outputs=[row.output])
+        elif row.output not in job.outputs:
+            job.outputs.append(row.output)
+    return list(jobs.values()), skipped
+
+
+def options_to_args(options: Dict[str, Any]) -> List[str]:
+    """Map ``{"face_detector_score": 0.6}`` to ``--face-detector-score 0.6``.
+
+    They are appended after the defaults, and FaceFusion keeps the last value.
+    """
+    args: List[str] = []
+    for key, value in options.items():
+        flag = "--" + key.replace("_", "-")
+        if value is True:
+            args.append(flag)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, (list, tuple)):
+            args += [flag, *(str(v) for v in value)]
+        else:
+            args += [flag, str(value)]
+    return args
+
+
+class _LocalProgress:
+    """Stands in for the Celery task passed to the render helpers.
+
+    Progress is reported after every chunk, which is where a cancelled
+    render stops; finished chunks stay in the checkpoint for the next run.
+    """
+
+    def __init__(self, on_progress: Callable[[int], None], cancelled: threading.Event):
+        self.on_progress = on_progress
+        self.cancelled = cancelled
+
+    def update_state(self, state=None, meta=None, task_id=None):
+        if self.cancelled.is_set():
+            raise BulkCancelled("Bulk run interrupted")
+        if meta and "current" in meta:
+            self.on_progress(meta["current"])
+
+
+class LocalBackend:
+    """Renders in this process, ``parallelism`` FaceFusion runs at a time"""
+
+    def __init__(self, parallelism: int):
+        self.pool = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="bulk")
+        self.progress: Dict[str, int] = {}
+        self.cancelled = threading.Event()
+
+    def submit(self, job: BulkJob):
+        return self.pool.submit(self._run, job)
+
+    def _run(self, job: BulkJob):
+        from .config import settings
+        from .job_logs import JobLog
+        from .tasks import render_to_outputs
+
+        job_log = JobLog(job.job_id, settings.job_log_max_lines, settings.job_log_forward_per_second)
+        task = _LocalProgress(lambda current: self.progress.__setitem__(job.job_id, current), self.cancelled)
+        render_to_outputs(task, job.job_id, str(job.source), str(job.target), job.outputs, job_log,
+                          extra_args=options_to_args(job.options))
+
+    def poll(self, handle, job: BulkJob) -> Tuple[Optional[str], int]:
+        """(None | "done" | error message, progress percent)"""
+        if not handle.done():
+            return None, self.progress.get(job.job_id, 0)
+        error = handle.exception()
+        return ("done" if error is None else str(error)), 100
+
+    def cancel(self, handles: List[Any]):
+        self.cancelled.set()
+
+    def shutdown(self):
+        # Running renders stop at their next chunk; nothing writes once the CLI returns
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+class CeleryBackend:
+    """Submits to the ``face_swap`` queue, keeping at most ``parallelism`` jobs in flight"""
+
+    def __init__(self):
+        from .tasks import bulk_face_swap
+        self.task = bulk_face_swap
+
+    def submit(self, job: BulkJob):
+        return self.task.apply_async(
+            (job.job_id, str(job.source.resolve()), str(job.target.resolve()),
+             [str(output.resolve()) for output in job.outputs], options_to_args(job.options)),
+        )
+
+    def poll(self, handle, job: BulkJob) -> Tuple[Optional[str], int]:
+        state = handle.state
+        if state == "SUCCESS":
+            return "done", 100
+        if state in ("FAILURE", "REVOKED"):
+            return str(handle.result or state), 100
+        info = handle.info if isinstance(handle.info, dict) else {}
+        return None, info.get("current", 0)
+
+    def cancel(self, handles: List[Any]):
+        """Revoke jobs still queued or running, so they don't keep writing after the CLI stops"""
+        for handle in handles:
+            handle.revoke(terminate=True)
+
+    def shutdown(self):
+        pass
+
+
+def run_bulk(
+    jobs: List[BulkJob],
+    backend,
+    parallelism: int,
+    poll_interval: float = 2.0,
+    out=sys.stdout,
+) -> Dict[str, Any]:
+    """Run ``jobs`` with at most ``parallelism`` in flight, printing progress as it changes"""
+    started = time.monotonic()
+    pending = list(reversed(jobs))
+    in_flight: Dict[str, Tuple[BulkJob, Any, float]] = {}
+    last_progress: Dict[str, int] = {}
+    done, failed = [], []
+    local = isinstance(backend, LocalBackend)
+
+    def emit(message: str):
+        elapsed = time.monotonic() - started
+        print(f"[{elapsed:8.1f}s] [{len(done) + len(failed)}/{len(jobs)}] {message}", file=out, flush=True)
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < parallelism:
+                job = pending.pop()
+                in_flight[job.job_id] = (job, backend.submit(job), time.monotonic())
+                emit(f"submitted {job.target.name} -> {', '.join(o.name for o in job.outputs)}")
+
+            if local:
+                wait([handle for _, handle, _ in in_flight.values()], timeout=poll_interval, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(poll_interval)
+
+            for job_id, (job, handle, submitted_at) in list(in_flight.items()):
+                outcome, progress = backend.poll(handle, job)
+                if outcome is None:
+                    if progress // 10 != last_progress.get(job_id, 0) // 10:
+                        emit(f"{job.target.name}: {progress}%")
+                    last_progress[job_id] = progress
+                    continue
+                del in_flight[job_id]
+                seconds = time.monotonic() - submitted_at
+                if outcome == "done":
+                    done.append((job, seconds))
+                    emit(f"done {job.outputs[0]} ({seconds:.1f}s)")
+                else:
+                    failed.append((job, outcome))
+                    emit(f"FAILED {job.outputs[0]}: {outcome.strip().splitlines()[-1] if outcome.strip() else outcome}")
+    except BaseException:
+        # Ctrl-C included: in-flight jobs are stopped, finished chunks kept for the next run
+        if in_flight:
+            emit(f"interrupted, cancelling {len(in_flight)} job(s) in flight")
+            backend.cancel([handle for _, handle, _ in in_flight.values()])
+        raise
+    finally:
+        backend.shutdown()
+
+    wall = time.monotonic() - started
+    return {
+        "jobs": len(jobs),
+        "completed": len(done),
+        "failed": len(failed),
+        "outputs_written": sum(len(job.outputs) for job, _ in done),
+        "wall_seconds": round(wall, 1),
+        "jobs_per_hour": round(len(done) / wall * 3600, 2) if wall > 0 else 0.0,
+        "avg_job_seconds": round(sum(s for _, s in done) / len(done), 1) if done else 0.0,
+        "failures": [{"output": str(job.outputs[0]), "error": error} for job, error in failed],
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.bulk",
+        description="Bulk face swap from a manifest",
+        epilog=MANIFEST_HELP,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("manifest", type=Path, help="CSV or JSONL with source, target, output[, options]")
+    parser.add_argument("--backend", choices=("celery", "local"), default="celery")
+    parser.add_argument("--parallelism", type=int, default=2, help="Jobs in flight at once")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    rows = load_manifest(args.manifest)
+    jobs, skipped = plan_bulk(rows)
+    deduped = len(rows) - len(skipped) - len(jobs)
+    print(f"{len(rows)} rows: {len(skipped)} already complete, {len(jobs)} to render ({deduped} duplicate rows merged)")
+
+    backend = LocalBackend(args.parallelism) if args.backend == "local" else CeleryBackend()
+    try:
+        summary = run_bulk(jobs, backend, max(1, args.parallelism), args.poll_interval)
+    except KeyboardInterrupt:
+        print("Interrupted; run again to resume from the finished outputs and chunks")
+        return 130
+    summary["skipped"] = len(skipped)
+    summary["duplicates_merged"] = deduped
+
+    print(
+        f"\n{summary['completed']}/{summary['jobs']} jobs completed, {summary['failed']} failed, "
+        f"{summary['outputs_written']} outputs written, {summary['skipped']} skipped"
+    )
+    print(
+        f"wall {summary['wall_seconds']}s, {summary['jobs_per_hour']} jobs/hour, "
+        f"avg {summary['avg_job_seconds']}s per job"
+    )
+    for failure in summary["failures"]:
+        print(f"  failed: {failure['output']}")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,8 @@
 import os
+import time
 from celery import Celery
+from celery.signals import before_task_publish
+from .cpu_slots import get_slot_pool
 
 celery_app = Celery(
     "face_fusion_tasks",
@@ -19,7 +22,28 @@ celery_app.conf.update(
     task_acks_late=True,
     task_reject_on_worker_lost=True,
     worker_prefetch_multiplier=1,
+    # API側のクラスタ状態スナップショット（celery_monitor）用にイベントを送信
+    worker_send_task_events=True,
+    task_send_sent_event=True,
+    # GPUワーカー（face_swap）には顔交換のみ、CPU処理は media キューへ
+    # --autoscale 指定時はブローカーの待ち行列長で子プロセス数を調整
+    worker_autoscaler="app.autoscaler:QueueAutoscaler",
     task_routes={
         "app.tasks.process_face_swap": "face_swap",
+        "app.tasks.swap_job": "face_swap",
+        "app.tasks.bulk_face_swap": "face_swap",
+        "app.tasks.prepare_job": "media",
+        "app.tasks.finalize_job": "media",
+        "app.tasks.build_template": "media",
     },
-)
\ No newline at end of file
+)
+# CPUモード: --concurrency 未指定時はCPUスロット数だけ子プロセスを起動
+slot_pool = get_slot_pool()
+if slot_pool is not None:
+    celery_app.conf.worker_concurrency = len(slot_pool.slots)
+
+@before_task_publish.connect
+def stamp_enqueued_at(headers=None, **kwargs):
+    """投入時刻をヘッダーに記録（オートスケーラーが最古ジョブの待ち時間に使用）"""
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
@@ -0,0 +1,165 @@
+import time
+import threading
+import logging
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, Optional, Set
+
+from celery import Celery, states
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterStateMonitor:
+    """Keeps an in-memory snapshot of the Celery cluster from the event stream.
+
+    A daemon thread consumes worker and task events (the same feed Flower
+    uses) and folds them into ``celery.events.State``. Readers get a cached
+    snapshot, so serving cluster status never broadcasts to workers or blocks
+    on an inspect timeout.
+    """
+
+    def __init__(
+        self,
+        app: Celery,
+        throughput_window: float = 300.0,
+        snapshot_min_interval: float = 1.0,
+        on_task_succeeded: Optional[Callable[[str, float], None]] = None,
+        throughput_tasks: Optional[Set[str]] = None,
+    ):
+        self.app = app
+        self.on_task_succeeded = on_task_succeeded
+        self.throughput_tasks = throughput_tasks
+        self.throughput_window = throughput_window
+        self.snapshot_min_interval = snapshot_min_interval
+        self.state = app.events.State()
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._receiver = None
+        self._connected = False
+        self._last_event_at: Optional[float] = None
+        self._completions: Dict[str, Deque[tuple]] = defaultdict(deque)
+        self._dirty = True
+        self._snapshot: Dict[str, Any] = {}
+        self._snapshot_built_at = 0.0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="celery-event-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._receiver is not None:
+            self._receiver.should_stop = True
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                with self.app.connection_for_read() as connection:
+                    self._receiver = self.app.events.Receiver(
+                        connection, handlers={"*": self.on_event}
+                    )
+                    self._connected = True
+                    backoff = 1.0
+                    logger.info("Celery event monitor connected")
+                    # wakeup=True asks every worker for an immediate heartbeat
+                    self._receiver.capture(limit=None, timeout=None, wakeup=True)
+            except Exception as e:
+                logger.warning(f"Celery event monitor disconnected: {e}")
+            finally:
+                self._connected = False
+                self._receiver = None
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def on_event(self, event: Dict[str, Any]):
+        now = time.time()
+        counted = False
+        with self._lock:
+            self.state.event(event)
+            self._last_event_at = now
+            self._dirty = True
+            if event.get("type") == "task-succeeded":
+                task = self.state.tasks.get(event.get("uuid"))
+                counted = self.throughput_tasks is None or (task is not None and task.name in self.throughput_tasks)
+            if counted:
+                completions = self._completions[event.get("hostname", "unknown")]
+                completions.append((now, event.get("runtime") or 0.0))
+                self._trim(completions, now)
+        if counted and self.on_task_succeeded is not None:
+            self.on_task_succeeded(event.get("hostname", "unknown"), event.get("runtime") or 0.0)
+
+    def _trim(self, completions: Deque[tuple], now: float):
+        while completions and now - completions[0][0] > self.throughput_window:
+            completions.popleft()
+
+    def _build_snapshot(self, now: float) -> Dict[str, Any]:
+        workers = {}
+        for hostname, worker in self.state.workers.items():
+            workers[hostname] = {
+                "alive": worker.alive,
+                "active": worker.active,
+                "processed": worker.processed,
+                "loadavg": worker.loadavg,
+                "last_heartbeat": worker.heartbeats[-1] if worker.heartbeats else None,
+            }
+
+        active_tasks = defaultdict(list)
+        reserved_tasks = defaultdict(list)
+        for task_id, task in self.state.tasks.items():
+            if task.state == states.STARTED:
+                active_tasks[task.worker.hostname if task.worker else "unknown"].append(
+                    {"id": task_id, "name": task.name, "started": task.started}
+                )
+            elif task.state == states.RECEIVED:
+                reserved_tasks[task.worker.hostname if task.worker else "unknown"].append(
+                    {"id": task_id, "name": task.name, "received": task.received}
+                )
+
+        throughput = {}
+        for hostname, completions in self._completions.items():
+            self._trim(completions, now)
+            count = len(completions)
+            throughput[hostname] = {
+                "tasks_per_minute": round(count * 60.0 / self.throughput_window, 2),
+                "avg_runtime_seconds": round(sum(r for _, r in completions) / count, 2) if count else None,
+                "window_seconds": self.throughput_window,
+            }
+
+        return {
+            "workers": workers,
+            "active_tasks": dict(active_tasks),
+            "reserved_tasks": dict(reserved_tasks),
+            "throughput": throughput,
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cached cluster state plus freshness information"""
+        now = time.time()
+        with self._lock:
+            if self._dirty and now - self._snapshot_built_at >= self.snapshot_min_interval:
+                self._snapshot = self._build_snapshot(now)
+                self._snapshot_built_at = now
+                self._dirty = False
+            snapshot = dict(self._snapshot) or self._build_snapshot(now)
+            last_event_at = self._last_event_at
+
+        alive = any(worker["alive"] for worker in snapshot["workers"].values())
+        snapshot.update({
+            "status": "connected" if alive else "disconnected",
+            "monitor_connected": self._connected,
+            "updated_at": (
+                datetime.fromtimestamp(last_event_at, tz=timezone.utc).isoformat()
+                if last_event_at else None
+            ),
+            "age_seconds": round(now - last_event_at, 1) if last_event_at else None,
+        })
+        return snapshot
@@ -0,0 +1,153 @@
+import json
+import os
+import shutil
+import time
+import logging
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (start_frame, end_frame) with end exclusive, matching FaceFusion's trim options
+FrameRange = Tuple[int, int]
+
+CHECKPOINT_DIR_NAME = ".checkpoints"
+MANIFEST_NAME = "manifest.json"
+
+
+def checkpoint_dir(output_dir: Path, job_id: str) -> Path:
+    """Checkpoint directory for a job, on the shared output volume"""
+    return output_dir / CHECKPOINT_DIR_NAME / job_id
+
+
+def input_fingerprint(*paths: Path, **params) -> str:
+    """Identify the inputs a checkpoint was made from (name, size, mtime, options)"""
+    parts = [f"{p.name}:{p.stat().st_size}:{int(p.stat().st_mtime)}" for p in paths]
+    parts += [f"{key}={params[key]}" for key in sorted(params)]
+    return "|".join(parts)
+
+
+class JobCheckpoint:
+    """Completed frame-range chunks of one job, persisted next to a manifest.
+
+    Chunks are only recorded after the renderer finished writing them, and
+    the manifest is replaced atomically, so a worker killed mid-chunk leaves
+    at most one unrecorded (and later re-rendered) chunk behind.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.ranges: List[FrameRange] = []
+        self.fingerprint: Optional[str] = None
+        self.completed: Dict[int, dict] = {}
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.directory / MANIFEST_NAME
+
+    def chunk_path(self, index: int) -> Path:
+        return self.directory / f"chunk_{index:05d}.mp4"
+
+    def begin(self, ranges: List[FrameRange], fingerprint: Optional[str] = None) -> int:
+        """Load a previous attempt's progress; returns how many chunks can be reused.
+
+        A manifest for different inputs or a different chunk plan is discarded.
+        """
+        self.ranges = [tuple(r) for r in ranges]
+        self.fingerprint = fingerprint
+        self.completed = {}
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            manifest = None
+
+        if manifest and manifest.get("fingerprint") == fingerprint and \
+                [tuple(r) for r in manifest.get("ranges", [])] == self.ranges:
+            for key, entry in manifest.get("completed", {}).items():
+                index = int(key)
+                chunk = self.chunk_path(index)
+                if chunk.is_file() and chunk.stat().st_size == entry.get("size"):
+                    self.completed[index] = entry
+        elif self.directory.exists():
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._write()
+        return len(self.completed)
+
+    def is_done(self, index: int) -> bool:
+        return index in self.completed
+
+    def mark_done(self, index: int):
+        start, end = self.ranges[index]
+        self.completed[index] = {
+            "start": start,
+            "end": end,
+            "size": self.chunk_path(index).stat().st_size,
+            "completed_at": time.time(),
+        }
+        self._write()
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self):
+        tmp_path = self.manifest_path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps({
+            "fingerprint": self.fingerprint,
+            "ranges": self.ranges,
+            "completed": {str(index): entry for index, entry in sorted(self.completed.items())},
+            "updated_at": time.time(),
+        }))
+        os.replace(tmp_path, self.manifest_path)
+
+
+def render_chunks(
+    checkpoint: JobCheckpoint,
+    render_chunk: Callable[[int, int, Path], None],
+    on_chunk: Optional[Callable[[int, Path, bool], None]] = None,
+) -> List[Path]:
+    """Render every range of ``checkpoint`` that is not already complete.
+
+    ``render_chunk(start, end, output_path)`` must write frames ``[start, end)``.
+    ``on_chunk(index, path, resumed)`` is called for every chunk in order,
+    including ones restored from the checkpoint.
+    """
+    paths = []
+    for index, (start, end) in enumerate(checkpoint.ranges):
+        chunk_path = checkpoint.chunk_path(index)
+        resumed = checkpoint.is_done(index)
+        if resumed:
+            logger.info(f"Chunk {index} ({start}-{end}) restored from checkpoint")
+        else:
+            # Leftovers from an interrupted attempt are never trusted
+            chunk_path.unlink(missing_ok=True)
+            render_chunk(start, end, chunk_path)
+            if not chunk_path.exists():
+                raise Exception(f"Chunk {index} ({start}-{end}) produced no output")
+            checkpoint.mark_done(index)
+        paths.append(chunk_path)
+        if on_chunk:
+            on_chunk(index, chunk_path, resumed)
+    return paths
+
+
+def cleanup_expired_checkpoints(output_dir: Path, max_age_seconds: float) -> int:
+    """Remove checkpoints of jobs that have not made progress for ``max_age_seconds``"""
+    root = output_dir / CHECKPOINT_DIR_NAME
+    if not root.is_dir():
+        return 0
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    for directory in root.iterdir():
+        manifest = directory / MANIFEST_NAME
+        try:
+            updated = (manifest if manifest.exists() else directory).stat().st_mtime
+        except OSError:
+            continue
+        if updated < cutoff:
+            shutil.rmtree(directory, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info(f"Removed {removed} expired checkpoint(s)")
+    return removed
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Optional
 import os
 from pathlib import Path
 
@@ -24,16 +24,141 @@ class Settings(BaseSettings):
     max_upload_size_mb: int = 100
     allowed_video_extensions: List[str] = [".mp4", ".avi", ".mov", ".webm"]
     allowed_image_extensions: List[str] = [".jpg", ".jpeg", ".png"]
+    image_max_dimension: int = 2048  # Source images are downscaled to this longest side
+    image_require_face: bool = True  # Reject source images with no detectable face
     
     # FaceFusion Service
     facefusion_url: str = "http://facefusion:7860"
+    facefusion_urls: List[str] = []  # Multiple backends; falls back to facefusion_url
     facefusion_timeout: int = 300
+    facefusion_max_connections: int = 20
+    facefusion_max_keepalive_connections: int = 10
+    facefusion_keepalive_expiry: float = 30.0
+    facefusion_retry_attempts: int = 3
+    facefusion_retry_base_delay: float = 0.5
+    facefusion_breaker_failure_threshold: int = 5
+    facefusion_breaker_reset_seconds: float = 30.0
+    facefusion_hedge_delay: float = 0.5
+    
+    # Shared volume: when uploads/outputs live under this root on both the API
+    # and FaceFusion containers, files are passed by path instead of re-uploaded.
+    # Off by default: it needs upload_dir/output_dir under the root and a
+    # FaceFusion service whose /api/capabilities advertises path_reference
+    # with the same volume id (the bundled service only takes multipart)
+    shared_volume_root: Path = Path("/workspace")
+    facefusion_path_reference: bool = False
     
     # Storage Settings
     upload_dir: Path = Path("/app/uploads")
     output_dir: Path = Path("/app/outputs")
     cleanup_interval_hours: int = 24
     
+    # Object storage: "s3" keeps uploads/outputs in an S3-compatible bucket
+    # (MinIO works locally) and downloads redirect to presigned URLs
+    storage_backend: str = "local"
+    s3_bucket: str = ""
+    s3_prefix: str = ""
+    s3_endpoint_url: str = ""  # e.g. http://minio:9000; empty for AWS
+    s3_public_endpoint_url: str = ""  # Host clients use for presigned URLs, if different
+    s3_region: str = ""
+    s3_access_key_id: str = ""
+    s3_secret_access_key: str = ""
+    s3_presign_expiry_seconds: int = 3600
+    s3_multipart_threshold_mb: int = 64
+    s3_multipart_chunk_mb: int = 16
+    
+    # Worker input cache: inputs are resolved by content digest into a local
+    # LRU cache, trying the fetchers in order (shared volume, the API over
+    # HTTP, the storage backend)
+    input_cache_dir: Path = Path("/tmp/facefusion-inputs")
+    input_cache_max_gb: float = 50.0
+    input_fetchers: str = "shared,http,storage"
+    input_fetch_url: str = ""  # API base URL for the http fetcher, e.g. http://backend:8000
+    input_fetch_token: str = ""  # Shared secret for /api/inputs/{digest}; empty disables it
+    input_index_ttl_hours: int = 72
+    
+    # Admission control for /api/process
+    admission_max_queue_depth: int = 20
+    admission_max_wait_seconds: int = 1800
+    admission_max_jobs_per_client: int = 2
+    admission_default_job_seconds: float = 120.0  # Used until real durations are measured
+    
+    # Idempotency-Key handling for uploads and /api/process
+    idempotency_backend: str = "memory"  # "redis" shares keys across workers and replicas
+    idempotency_ttl_seconds: int = 86400
+    # A key stays pending this long at most, so a request that crashed before
+    # completing does not block its retries for the whole TTL
+    idempotency_pending_ttl_seconds: int = 300
+    
+    # Preview generation (posters, scrub sprites, animated previews)
+    preview_workers: int = 2
+    preview_cache_max_age: int = 31536000
+    preview_failure_ttl_seconds: int = 600  # Failed previews/galleries answer 404/422 until this expires
+    
+    # Target face gallery (identities a request can pick as its reference face)
+    face_gallery_sample_fps: float = 1.0
+    face_gallery_max_samples: int = 300
+    face_gallery_match_threshold: float = 0.75  # Cosine similarity that re-identifies a face
+    face_gallery_min_sightings: int = 2  # Fewer sightings are treated as false detections
+    
+    # Progressive (HLS) output
+    progressive_chunk_seconds: float = 10.0
+    
+    # CPU execution (GPU-less nodes): the host is split into pinned slots,
+    # one FaceFusion process per slot
+    execution_mode: str = "cuda"  # cuda | cpu
+    cpu_slots: int = 0  # 0 = physical cores / cpu_cores_per_slot
+    cpu_cores_per_slot: int = 4
+    cpu_slot_lock_dir: Path = Path("/tmp/facefusion-cpu-slots")
+    
+    # Autoscaling of face_swap workers (pool processes via --autoscale, or
+    # desired replicas from `python -m app.autoscaler`)
+    autoscale_min_workers: int = 1
+    autoscale_max_workers: int = 4
+    autoscale_target_wait_seconds: float = 300.0  # Backlog should drain within this
+    autoscale_max_job_age_seconds: float = 600.0  # Older queued jobs force a step up
+    autoscale_scale_down_delay_seconds: float = 300.0  # Surplus must last this long
+    autoscale_memory_reserve_mb: float = 2048.0
+    autoscale_interval_seconds: float = 15.0
+    autoscale_dry_run: bool = False  # Log decisions without applying them
+    
+    # Local executor (main.py, single node without Redis/Celery)
+    local_max_concurrent_jobs: int = 1
+    local_queue_path: Path = Path("/app/outputs/.jobs.sqlite3")
+    
+    # Template library (shared volume; least recently used templates are evicted)
+    template_dir: Path = Path("/app/outputs/.templates")
+    template_cache_max_gb: float = 20.0
+    template_face_sample_fps: float = 5.0
+    # Face ranges come from the Haar frontal cascade, which misses profile,
+    # small and occluded faces: ranges are padded generously, and skipping
+    # FaceFusion outside them is opt-in
+    template_face_pad_seconds: float = 2.0
+    template_passthrough: bool = False
+    
+    # Staged pipeline: probe/prepare and encode run on the CPU "media" queue,
+    # only the swap itself on the GPU "face_swap" queue
+    staged_pipeline: bool = True
+    pipeline_intermediate_preset: str = "ultrafast"  # FaceFusion's chunk encode on the GPU worker
+    
+    # Processing profiles (fast | balanced | quality, plus any from profiles_file);
+    # the final encode follows the profile's encoder settings
+    default_profile: str = "fast"
+    # main_improved (FaceFusion service API) keeps the detector and enhancers
+    # it always sent (retinaface, gfpgan_1.4, real_esrgan_x4plus)
+    service_default_profile: str = "quality"
+    profiles_file: Optional[Path] = None  # JSON list overriding/adding profiles
+    
+    # Duplicate-frame decimation (mp4 uploads without trim): only unique frames
+    # go through FaceFusion and the output is re-timed to the original frames
+    decimate_default: bool = False  # Used when a request does not set "decimate"
+    decimate_max_diff: int = 6  # Largest block difference (0-255) still counted as a duplicate
+    decimate_min_ratio: float = 0.1  # Smaller duplicate shares are processed as is
+    
+    # Checkpointed rendering: completed chunks survive a lost worker
+    checkpoint_chunk_seconds: float = 60.0
+    checkpoint_ttl_hours: int = 24
+    
     # Security
     secret_key: str = "your-secret-key-here"
     algorithm: str = "HS256"
@@ -46,6 +171,8 @@ class Settings(BaseSettings):
     
     # Monitoring
     log_level: str = "INFO"
+    job_log_max_lines: int = 500  # Per-job tail kept for /api/job/{id}/logs
+    job_log_forward_per_second: float = 5.0  # FaceFusion lines copied to the app log
     sentry_dsn: str = ""
     
     class Config:
@@ -56,6 +183,10 @@ class Settings(BaseSettings):
     def max_upload_size_bytes(self) -> int:
         return self.max_upload_size_mb * 1024 * 1024
     
+    @property
+    def facefusion_backend_urls(self) -> List[str]:
+        return self.facefusion_urls or [self.facefusion_url]
+    
     @property
     def redis_url(self) -> str:
         return f"redis://{self.redis_host}:{self.redis_port}/{self.redis_db}"
@@ -0,0 +1,295 @@
+import fcntl
+import os
+import time
+import logging
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+SYS_CPU = Path("/sys/devices/system/cpu")
+SYS_NODE = Path("/sys/devices/system/node")
+PROC_STAT = Path("/proc/stat")
+
+# Libraries that size their thread pools from these instead of the affinity mask
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+
+class LogicalCpu(BaseModel):
+    cpu: int
+    package: int
+    core: int
+    node: int
+
+
+class CpuSlot(BaseModel):
+    index: int
+    cpus: List[int]
+    nodes: List[int]
+    threads: int
+
+    def pin(self):
+        """Restrict the calling process (e.g. as ``preexec_fn``) to this slot's CPUs"""
+        os.sched_setaffinity(0, self.cpus)
+
+    def env(self, base: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        env = dict(os.environ if base is None else base)
+        env.update({name: str(self.threads) for name in THREAD_ENV_VARS})
+        return env
+
+    def facefusion_options(self) -> Dict[str, object]:
+        """Keyword arguments for ``build_facefusion_command``"""
+        return {"execution_providers": "cpu", "execution_thread_count": self.threads}
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """Expand a kernel CPU list such as ``0-3,8-11``"""
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpulist(cpus: List[int]) -> str:
+    parts = []
+    for cpu in sorted(cpus):
+        if parts and cpu == parts[-1][1] + 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ",".join(f"{a}-{b}" if a != b else str(a) for a, b in parts)
+
+
+def _read_int(path: Path, default: int) -> int:
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def discover_topology(
+    allowed: Optional[List[int]] = None,
+    sys_cpu: Path = SYS_CPU,
+    sys_node: Path = SYS_NODE,
+) -> List[LogicalCpu]:
+    """CPUs this process may run on, with their physical core and NUMA node.
+
+    Defaults to the affinity mask, which already reflects container cpusets.
+    Missing sysfs entries degrade to one core per CPU on node 0.
+    """
+    if allowed is None:
+        allowed = sorted(os.sched_getaffinity(0))
+    node_of: Dict[int, int] = {}
+    for node_dir in sys_node.glob("node[0-9]*"):
+        try:
+            for cpu in parse_cpulist((node_dir / "cpulist").read_text()):
+                node_of[cpu] = int(node_dir.name[4:])
+        except (OSError, ValueError):
+            continue
+    return [
+        LogicalCpu(
+            cpu=cpu,
+            package=_read_int(sys_cpu / f"cpu{cpu}" / "topology" / "physical_package_id", 0),
+            core=_read_int(sys_cpu / f"cpu{cpu}" / "topology" / "core_id", cpu),
+            node=node_of.get(cpu, 0),
+        )
+        for cpu in sorted(allowed)
+    ]
+
+
+def _split(items: list, parts: int) -> List[list]:
+    """Split ``items`` into ``parts`` contiguous, near-equal groups"""
+    size, extra = divmod(len(items), parts)
+    groups, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+def plan_slots(topology: List[LogicalCpu], slot_count: int = 0, cores_per_slot: int = 4) -> List[CpuSlot]:
+    """Split the host into CPU slots.
+
+    Hyperthread siblings always share a slot and slots stay within one NUMA
+    node whenever there are at least as many slots as nodes. ``slot_count=0``
+    picks one slot per ``cores_per_slot`` physical cores.
+    """
+    cores: Dict[int, Dict[Tuple[int, int], List[int]]] = defaultdict(lambda: defaultdict(list))
+    for cpu in topology:
+        cores[cpu.node][(cpu.package, cpu.core)].append(cpu.cpu)
+    node_cores = {node: [sorted(c) for _, c in sorted(by_core.items())] for node, by_core in sorted(cores.items())}
+    total = sum(len(c) for c in node_cores.values())
+    if total == 0:
+        return []
+    if slot_count <= 0:
+        slot_count = max(1, total // max(1, cores_per_slot))
+    slot_count = min(slot_count, total)
+
+    groups: List[List[List[int]]] = []
+    if slot_count >= len(node_cores):
+        # Largest-remainder share of slots per node, at least one each
+        shares = {node: max(1, slot_count * len(c) // total) for node, c in node_cores.items()}
+        by_remainder = sorted(node_cores, key=lambda n: (slot_count * len(node_cores[n])) % total, reverse=True)
+        while sum(shares.values()) < slot_count:
+            for node in by_remainder:
+                if sum(shares.values()) < slot_count and shares[node] < len(node_cores[node]):
+                    shares[node] += 1
+        while sum(shares.values()) > slot_count:
+            node = max(shares, key=shares.get)
+            shares[node] -= 1
+        for node, node_core_list in node_cores.items():
+            groups.extend(_split(node_core_list, shares[node]))
+    else:
+        groups = _split([c for node_core_list in node_cores.values() for c in node_core_list], slot_count)
+
+    node_of = {cpu.cpu: cpu.node for cpu in topology}
+    slots = []
+    for index, group in enumerate(groups):
+        cpus = sorted(cpu for core in group for cpu in core)
+        slots.append(CpuSlot(
+            index=index,
+            cpus=cpus,
+            nodes=sorted({node_of[cpu] for cpu in cpus}),
+            threads=len(cpus),
+        ))
+    return slots
+
+
+def read_cpu_times(proc_stat: Path = PROC_STAT) -> Dict[int, Tuple[int, int]]:
+    """Per-CPU (busy, total) jiffies from /proc/stat"""
+    times: Dict[int, Tuple[int, int]] = {}
+    try:
+        lines = proc_stat.read_text().splitlines()
+    except OSError:
+        return times
+    for line in lines:
+        name, *fields = line.split()
+        if not name.startswith("cpu") or name == "cpu":
+            continue
+        values = [int(v) for v in fields[:8]]
+        idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+        times[int(name[3:])] = (sum(values) - idle, sum(values))
+    return times
+
+
+def utilization(cpus: List[int], before: Dict[int, Tuple[int, int]], after: Dict[int, Tuple[int, int]]) -> float:
+    """Average busy fraction of ``cpus`` between two ``read_cpu_times`` samples"""
+    busy = sum(after[c][0] - before[c][0] for c in cpus if c in before and c in after)
+    total = sum(after[c][1] - before[c][1] for c in cpus if c in before and c in after)
+    return round(busy / total, 3) if total > 0 else 0.0
+
+
+class SlotLease:
+    """A slot held by one job; released explicitly or by leaving the ``with`` block"""
+
+    def __init__(self, slot: CpuSlot, lock_file, proc_stat: Path = PROC_STAT):
+        self.slot = slot
+        self._lock_file = lock_file
+        self._proc_stat = proc_stat
+        self._started = read_cpu_times(proc_stat)
+
+    def utilization(self) -> float:
+        """Busy fraction of the slot's CPUs since it was acquired"""
+        return utilization(self.slot.cpus, self._started, read_cpu_times(self._proc_stat))
+
+    def release(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self) -> "SlotLease":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SlotPool:
+    """CPU slots leased to jobs through ``flock``'d files in ``lock_dir``.
+
+    File locks work across prefork Celery children as well as threads, and
+    are dropped by the kernel if a worker dies mid-job.
+    """
+
+    def __init__(self, slots: List[CpuSlot], lock_dir: Path, poll_interval: float = 0.5, proc_stat: Path = PROC_STAT):
+        self.slots = slots
+        self.lock_dir = lock_dir
+        self.poll_interval = poll_interval
+        self.proc_stat = proc_stat
+        self._sample = read_cpu_times(proc_stat)
+
+    def _try_lock(self, slot: CpuSlot):
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.lock_dir / f"slot-{slot.index}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            lock_file.close()
+            return None
+
+    def try_acquire(self) -> Optional[SlotLease]:
+        for slot in self.slots:
+            lock_file = self._try_lock(slot)
+            if lock_file is not None:
+                return SlotLease(slot, lock_file, self.proc_stat)
+        return None
+
+    def acquire(self, timeout: Optional[float] = None) -> SlotLease:
+        """Block until a slot is free (blocking; call from a thread on the event loop)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            lease = self.try_acquire()
+            if lease is not None:
+                return lease
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError("No free CPU slot")
+            time.sleep(self.poll_interval)
+
+    def snapshot(self) -> List[Dict[str, object]]:
+        """Per-slot occupancy and utilization since the previous snapshot"""
+        sample = read_cpu_times(self.proc_stat)
+        previous, self._sample = self._sample, sample
+        result = []
+        for slot in self.slots:
+            lock_file = self._try_lock(slot)
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            result.append({
+                "slot": slot.index,
+                "cpus": format_cpulist(slot.cpus),
+                "nodes": slot.nodes,
+                "threads": slot.threads,
+                "busy": lock_file is None,
+                "utilization": utilization(slot.cpus, previous, sample),
+            })
+        return result
+
+
+_shared_pool: Optional[SlotPool] = None
+
+
+def get_slot_pool() -> Optional[SlotPool]:
+    """Host-wide slot pool when ``execution_mode`` is ``cpu``, otherwise None"""
+    global _shared_pool
+    if settings.execution_mode != "cpu":
+        return None
+    if _shared_pool is None:
+        slots = plan_slots(discover_topology(), settings.cpu_slots, settings.cpu_cores_per_slot)
+        _shared_pool = SlotPool(slots, settings.cpu_slot_lock_dir)
+        logger.info(
+            f"CPU execution: {len(slots)} slots "
+            + ", ".join(f"[{format_cpulist(s.cpus)}]x{s.threads}" for s in slots)
+        )
+    return _shared_pool
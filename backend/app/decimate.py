@@ -0,0 +1,269 @@
+import os
+import shutil
+import subprocess
+import logging
+from fractions import Fraction
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+import cv2
+import numpy as np
+from pydantic import BaseModel
+
+from .checkpoints import CHECKPOINT_DIR_NAME, input_fingerprint
+from .media import FFMPEG, probe_video, run_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+REPORT_NAME = "report.json"
+UNIQUE_VIDEO = "unique.mp4"
+AUDIO_TRACK = "audio.mka"
+
+# Frames are compared as grayscale block means on this grid (mpdecimate-style):
+# coarse enough to ignore encoder noise, fine enough that a moving mouth in
+# a talking head changes a block
+SIGNATURE_GRID = (32, 32)
+
+
+class DecimationReport(BaseModel):
+    """Duplicate-frame runs of a target; ``runs[i]`` target frames repeat unique frame ``i``"""
+
+    fingerprint: str
+    fps: float
+    frames: int
+    runs: List[int] = []
+    has_audio: bool = False
+    applied: bool = False  # False when too few duplicates to be worth a re-time
+
+    @property
+    def unique_frames(self) -> int:
+        return len(self.runs)
+
+    @property
+    def duplicate_frames(self) -> int:
+        return self.frames - self.unique_frames
+
+    @property
+    def duplicate_ratio(self) -> float:
+        return self.duplicate_frames / self.frames if self.frames else 0.0
+
+    def unique_index(self, frame: int) -> int:
+        """Frame of the decimated video that stands for target frame ``frame``"""
+        end = 0
+        for index, run in enumerate(self.runs):
+            end += run
+            if frame < end:
+                return index
+        return max(0, len(self.runs) - 1)
+
+    def summary(self) -> dict:
+        """Per-job report without the run list"""
+        return {
+            "applied": self.applied,
+            "frames": self.frames,
+            "unique_frames": self.unique_frames,
+            "duplicate_frames": self.duplicate_frames,
+            "duplicate_ratio": round(self.duplicate_ratio, 3),
+        }
+
+
+def decimation_dir(output_dir: Path, job_id: str) -> Path:
+    """Work directory of a job's decimation, next to its checkpoint (expired the same way)"""
+    return output_dir / CHECKPOINT_DIR_NAME / f"{job_id}.decimate"
+
+
+def unique_video(directory: Path) -> Path:
+    return directory / UNIQUE_VIDEO
+
+
+def frame_signature(frame: np.ndarray, grid=SIGNATURE_GRID) -> np.ndarray:
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, grid, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def duplicate_runs(signatures: Iterable[np.ndarray], max_diff: int) -> List[int]:
+    """Lengths of runs of frames that duplicate the first frame of the run.
+
+    Frames are compared with the run's first frame rather than their
+    predecessor, so a slow fade or pan still starts new runs instead of
+    drifting into one long frozen frame.
+    """
+    runs: List[int] = []
+    reference = None
+    for signature in signatures:
+        if reference is not None and int(np.abs(signature - reference).max()) <= max_diff:
+            runs[-1] += 1
+        else:
+            reference = signature
+            runs.append(1)
+    return runs
+
+
+def read_frames(path: Path) -> Iterator[np.ndarray]:
+    capture = cv2.VideoCapture(str(path))
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+class FrameEncoder:
+    """Pipes BGR frames into ffmpeg (libx264/yuv420p), optionally muxing an audio track"""
+
+    def __init__(
+        self,
+        output_path: Path,
+        width: int,
+        height: int,
+        fps: float,
+        audio_path: Optional[Path] = None,
+        preset: str = "veryfast",
+        crf: int = 18,
+    ):
+        rate = str(Fraction(fps).limit_denominator(1001))
+        audio_input = ["-i", str(audio_path)] if audio_path else []
+        audio_map = ["-map", "1:a:0", "-c:a", "aac"] if audio_path else []
+        self.process = subprocess.Popen(
+            [FFMPEG, "-hide_banner", "-loglevel", "error", "-y",
+             "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", rate, "-i", "-",
+             *audio_input,
+             "-map", "0:v:0", *audio_map,
+             "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p",
+             "-movflags", "+faststart", str(output_path)],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def write(self, frame: np.ndarray):
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except BrokenPipeError:
+            self.process.wait()
+            raise Exception(f"ffmpeg failed: {self.process.stderr.read().decode(errors='replace')[-500:]}")
+
+    def close(self, timeout: int = 600):
+        self.process.stdin.close()
+        returncode = self.process.wait(timeout=timeout)
+        if returncode != 0:
+            raise Exception(f"ffmpeg failed: {self.process.stderr.read().decode(errors='replace')[-500:]}")
+
+    def __enter__(self) -> "FrameEncoder":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            self.process.wait()
+
+
+def load_report(directory: Path) -> Optional[DecimationReport]:
+    try:
+        return DecimationReport.model_validate_json((directory / REPORT_NAME).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def decimate_video(path: Path, directory: Path, max_diff: int, min_ratio: float) -> DecimationReport:
+    """Find duplicate frames of ``path`` and write its unique frames to ``directory``.
+
+    The unique frames are encoded at the target's frame rate, so FaceFusion
+    sees an ordinary (shorter) video; the audio track is kept aside for
+    ``restore_timing``. A report from an earlier attempt on the same target
+    is reused.
+    """
+    fingerprint = input_fingerprint(path, max_diff=max_diff, min_ratio=min_ratio)
+    report = load_report(directory)
+    if report and report.fingerprint == fingerprint and (not report.applied or unique_video(directory).is_file()):
+        return report
+
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+    info = probe_video(path)
+    runs = duplicate_runs((frame_signature(frame) for frame in read_frames(path)), max_diff)
+    report = DecimationReport(
+        fingerprint=fingerprint, fps=info.fps, frames=sum(runs), runs=runs, has_audio=info.has_audio
+    )
+    report.applied = report.unique_frames > 0 and report.duplicate_ratio >= min_ratio
+    if report.applied:
+        write_unique_frames(path, report, unique_video(directory))
+        if info.has_audio:
+            run_ffmpeg(["-i", str(path), "-map", "0:a:0", "-c", "copy", str(directory / AUDIO_TRACK)])
+    logger.info(
+        f"Decimation of {path.name}: {report.duplicate_frames}/{report.frames} duplicate frames"
+        + ("" if report.applied else " (not applied)")
+    )
+
+    tmp_path = directory / f"{REPORT_NAME}.tmp"
+    tmp_path.write_text(report.model_dump_json())
+    os.replace(tmp_path, directory / REPORT_NAME)
+    return report
+
+
+def write_unique_frames(path: Path, report: DecimationReport, output_path: Path):
+    starts = set()
+    frame_index = 0
+    for run in report.runs:
+        starts.add(frame_index)
+        frame_index += run
+
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp.mp4")
+    encoder = None
+    try:
+        for index, frame in enumerate(read_frames(path)):
+            if index not in starts:
+                continue
+            if encoder is None:
+                encoder = FrameEncoder(tmp_path, frame.shape[1], frame.shape[0], report.fps)
+            encoder.write(frame)
+        if encoder is None:
+            raise Exception(f"No frames decoded from {path}")
+        encoder.close()
+    except BaseException:
+        if encoder is not None and encoder.process.poll() is None:
+            encoder.process.kill()
+            encoder.process.wait()
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, output_path)
+
+
+def restore_timing(
+    directory: Path,
+    swapped_path: Path,
+    output_path: Path,
+    preset: str = "medium",
+    crf: int = 18,
+):
+    """Expand the swapped unique frames back to the target's frames, with its audio"""
+    report = load_report(directory)
+    if report is None:
+        raise Exception(f"Decimation report missing in {directory}")
+    frames = read_frames(swapped_path)
+    frame = next(frames, None)
+    if frame is None:
+        raise Exception(f"No frames decoded from {swapped_path}")
+    audio_path = directory / AUDIO_TRACK
+    missing = 0
+    with FrameEncoder(
+        output_path, frame.shape[1], frame.shape[0], report.fps,
+        audio_path if audio_path.is_file() else None, preset, crf,
+    ) as encoder:
+        for index, run in enumerate(report.runs):
+            for _ in range(run):
+                encoder.write(frame)
+            if index + 1 < len(report.runs):
+                following = next(frames, None)
+                if following is None:
+                    # A short render repeats its last frame rather than shortening the video
+                    missing += 1
+                else:
+                    frame = following
+    frames.close()
+    if missing:
+        logger.warning(f"{swapped_path.name} had {missing} fewer frames than expected; repeated the last one")
@@ -0,0 +1,47 @@
+import threading
+import logging
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# (x, y, w, h) in pixels of the image passed in
+Box = Tuple[int, int, int, int]
+
+CASCADE_PATH = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+DETECTION_MAX_SIDE = 640
+
+_local = threading.local()
+
+
+def _cascade() -> cv2.CascadeClassifier:
+    # CascadeClassifier isn't safe to share between threads
+    cascade = getattr(_local, "cascade", None)
+    if cascade is None:
+        cascade = cv2.CascadeClassifier(CASCADE_PATH)
+        _local.cascade = cascade
+    return cascade
+
+
+def detect_faces(image: np.ndarray, min_size_ratio: float = 0.05) -> List[Box]:
+    """Fast frontal-face detection on a BGR or grayscale image.
+
+    The image is downscaled to DETECTION_MAX_SIDE first; returned boxes are
+    in the original image's coordinates. This is a cheap presence check,
+    not a replacement for FaceFusion's detector.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape[:2]
+    scale = min(1.0, DETECTION_MAX_SIDE / max(height, width))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    gray = cv2.equalizeHist(gray)
+
+    min_side = max(24, int(min(gray.shape[:2]) * min_size_ratio))
+    faces = _cascade().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+    return [
+        (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+        for (x, y, w, h) in (faces if len(faces) else [])
+    ]
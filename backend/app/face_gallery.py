@@ -0,0 +1,331 @@
+import math
+import os
+import time
+import logging
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from pydantic import BaseModel
+
+from .config import settings
+from .face_detect import Box, detect_faces
+from .media import probe_video
+from .previews import DONE_MARKER, PreviewService, find_media
+
+logger = logging.getLogger(__name__)
+
+GALLERY_DIR_NAME = ".faces"
+GALLERY_INDEX = "gallery.json"
+
+# FaceFusion numbers the faces of the reference frame in this order, so
+# ``reference_face_position`` 0 is the largest face
+REFERENCE_FACE_ORDER = "large-small"
+
+THUMBNAIL_SIZE = 160
+THUMBNAIL_MARGIN = 0.3
+
+# HOG over an equalized 64x64 crop: no model download, and stable enough
+# across nearby frames to tell the people in one video apart
+_hog = cv2.HOGDescriptor((64, 64), (16, 16), (8, 8), (8, 8), 9)
+
+
+class GalleryNotReady(Exception):
+    """Raised when an upload's face gallery has not been built yet"""
+
+
+class FaceSighting(BaseModel):
+    frame: int
+    box: Box
+    position: int  # Rank by size among the faces of its frame, largest first
+    faces: int  # Faces detected in the frame
+
+
+class FaceIdentity(BaseModel):
+    identity: int
+    sightings: int
+    first_frame: int
+    last_frame: int
+    reference_frame: int  # Frame FaceFusion reads the reference face from
+    reference_position: int
+    box: Box  # In the reference frame
+    thumbnail: str
+
+
+class FaceGallery(BaseModel):
+    """People found in a target video, for reference-face selection"""
+
+    video: str
+    fps: float
+    frame_count: int
+    sample_step: int
+    identities: List[FaceIdentity] = []
+    created_at: float
+
+    def reference(self, identity: int) -> Optional[Dict[str, int]]:
+        """``{"frame", "position"}`` FaceFusion needs to select ``identity``"""
+        for face in self.identities:
+            if face.identity == identity:
+                return {"frame": face.reference_frame, "position": face.reference_position}
+        return None
+
+
+def gallery_dir(upload_dir: Path, video_id: str) -> Path:
+    """Gallery cache directory for an uploaded target, kept alongside the upload"""
+    # A dot-only id would resolve outside .faces
+    return upload_dir / GALLERY_DIR_NAME / video_id.lstrip(".")
+
+
+def load_gallery(out_dir: Path) -> Optional[FaceGallery]:
+    try:
+        return FaceGallery.model_validate_json((out_dir / GALLERY_INDEX).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def create_gallery_service(max_workers: int = 1) -> PreviewService:
+    """Background builder for galleries, one job per target, cached next to the upload"""
+    return PreviewService(
+        max_workers=max_workers,
+        failure_ttl_seconds=settings.preview_failure_ttl_seconds,
+        generate=partial(
+            build_gallery,
+            sample_fps=settings.face_gallery_sample_fps,
+            max_samples=settings.face_gallery_max_samples,
+            match_threshold=settings.face_gallery_match_threshold,
+            min_sightings=settings.face_gallery_min_sightings,
+        ),
+    )
+
+
+async def ensure_gallery(service: PreviewService, upload_dir: Path, video_id: str) -> Optional[FaceGallery]:
+    """Cached gallery of an upload, building it first if needed.
+
+    Returns None when there is no such upload; raises ValueError when the
+    upload is not a video the gallery can be built from.
+    """
+    found = find_media("upload", video_id, upload_dir, upload_dir)
+    if found is None:
+        return None
+    out_dir = gallery_dir(upload_dir, video_id)
+    if await service.ensure(found[0], out_dir, GALLERY_INDEX) is None:
+        raise ValueError("Could not build a face gallery for this upload")
+    return load_gallery(out_dir)
+
+
+def cached_gallery(service: PreviewService, upload_dir: Path, video_id: str) -> Optional[FaceGallery]:
+    """Built gallery of an upload, without building it on the caller's request.
+
+    Returns None when there is no such upload. When the gallery is not
+    built yet, its build is queued and GalleryNotReady raised, so the client
+    can fetch /api/faces/{video_id} and retry; a recently failed build
+    raises ValueError instead of being queued again.
+    """
+    found = find_media("upload", video_id, upload_dir, upload_dir)
+    if found is None:
+        return None
+    out_dir = gallery_dir(upload_dir, video_id)
+    gallery = load_gallery(out_dir) if (out_dir / DONE_MARKER).exists() else None
+    if gallery is None:
+        error = service.failure(out_dir)
+        if error is not None:
+            raise ValueError(f"Could not build a face gallery for this upload: {error}")
+        service.schedule(found[0], out_dir)
+        raise GalleryNotReady(f"The face gallery of this video is not ready; fetch /api/faces/{video_id} first")
+    return gallery
+
+
+def gallery_payload(gallery: FaceGallery, video_id: str) -> dict:
+    """API response: the gallery with a thumbnail URL per identity"""
+    payload = gallery.model_dump()
+    for face in payload["identities"]:
+        face["thumbnail_url"] = f"/api/faces/{video_id}/{face['thumbnail']}"
+    return payload
+
+
+def resolve_reference(gallery: FaceGallery, identity: int) -> Dict[str, int]:
+    """Reference frame/position of a gallery identity; ValueError if it is not in the gallery"""
+    reference = gallery.reference(identity)
+    if reference is None:
+        raise ValueError(f"Unknown face identity {identity} (gallery has {len(gallery.identities)})")
+    return reference
+
+
+def reference_options(reference: Optional[Dict[str, int]]) -> Dict[str, object]:
+    """FaceFusion options that swap only the chosen face (empty: FaceFusion's default selection)"""
+    if not reference:
+        return {}
+    return {
+        "face_selector_mode": "reference",
+        "face_selector_order": REFERENCE_FACE_ORDER,
+        "reference_face_position": reference["position"],
+        "reference_frame_number": reference["frame"],
+    }
+
+
+def face_embedding(frame: np.ndarray, box: Box) -> np.ndarray:
+    x, y, w, h = box
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    crop = cv2.resize(gray[max(0, y):y + h, max(0, x):x + w], (64, 64), interpolation=cv2.INTER_AREA)
+    vector = _hog.compute(cv2.equalizeHist(crop)).ravel().astype(np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def box_iou(a: Box, b: Box) -> float:
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return 0.0
+    return w * h / float(aw * ah + bw * bh - w * h)
+
+
+def sample_faces(video_path: Path, step: int) -> List[Tuple[FaceSighting, np.ndarray]]:
+    """Faces and their embeddings on every ``step``-th frame"""
+    capture = cv2.VideoCapture(str(video_path))
+    sightings = []
+    frame_index = 0
+    try:
+        while True:
+            # grab() skips the decode-to-BGR cost on frames we don't sample
+            if not capture.grab():
+                break
+            if frame_index % step == 0:
+                ok, frame = capture.retrieve()
+                if ok:
+                    boxes = sorted(detect_faces(frame), key=lambda box: box[2] * box[3], reverse=True)
+                    for position, box in enumerate(boxes):
+                        sighting = FaceSighting(frame=frame_index, box=box, position=position, faces=len(boxes))
+                        sightings.append((sighting, face_embedding(frame, box)))
+            frame_index += 1
+    finally:
+        capture.release()
+    return sightings
+
+
+def cluster_faces(
+    sightings: List[Tuple[FaceSighting, np.ndarray]],
+    step: int,
+    match_threshold: float,
+    track_iou: float = 0.3,
+) -> List[List[int]]:
+    """Group sightings into identities; returns sighting indices per identity.
+
+    A face continues an identity when it overlaps that identity's box in
+    the previous sample (tracking), or when its embedding is within
+    ``match_threshold`` cosine similarity of the identity's mean (someone
+    re-entering the shot). Each identity takes at most one face per frame.
+    """
+    clusters: List[List[int]] = []
+    centroids: List[np.ndarray] = []
+    last_seen: List[Tuple[int, Box]] = []
+
+    frames: Dict[int, List[int]] = {}
+    for index, (sighting, _) in enumerate(sightings):
+        frames.setdefault(sighting.frame, []).append(index)
+
+    for frame in sorted(frames):
+        candidates = []
+        for index in frames[frame]:
+            sighting, embedding = sightings[index]
+            for identity, centroid in enumerate(centroids):
+                seen_frame, seen_box = last_seen[identity]
+                similarity = float(np.dot(embedding, centroid) / (np.linalg.norm(centroid) or 1.0))
+                tracked = frame - seen_frame <= step and box_iou(sighting.box, seen_box) >= track_iou
+                if tracked or similarity >= match_threshold:
+                    candidates.append((tracked, similarity, index, identity))
+        assigned_faces, taken = set(), set()
+        for _, _, index, identity in sorted(candidates, reverse=True):
+            if index in assigned_faces or identity in taken:
+                continue
+            assigned_faces.add(index)
+            taken.add(identity)
+            clusters[identity].append(index)
+            centroids[identity] = centroids[identity] + sightings[index][1]
+            last_seen[identity] = (frame, sightings[index][0].box)
+        for index in frames[frame]:
+            if index not in assigned_faces:
+                clusters.append([index])
+                centroids.append(sightings[index][1].copy())
+                last_seen.append((frame, sightings[index][0].box))
+    return clusters
+
+
+def pick_reference(sightings: List[FaceSighting]) -> FaceSighting:
+    """Sighting FaceFusion can select most reliably: alone in its frame, else the largest face"""
+    return max(sightings, key=lambda s: (s.faces == 1, s.position == 0, s.box[2] * s.box[3]))
+
+
+def save_thumbnail(frame: np.ndarray, box: Box, path: Path):
+    x, y, w, h = box
+    margin = int(max(w, h) * THUMBNAIL_MARGIN)
+    height, width = frame.shape[:2]
+    crop = frame[max(0, y - margin):min(height, y + h + margin), max(0, x - margin):min(width, x + w + margin)]
+    scale = THUMBNAIL_SIZE / max(crop.shape[:2])
+    crop = cv2.resize(crop, (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale))))
+    cv2.imwrite(str(path), crop, [cv2.IMWRITE_JPEG_QUALITY, 85])
+
+
+def build_gallery(
+    video_path: Path,
+    out_dir: Path,
+    sample_fps: float = 1.0,
+    max_samples: int = 300,
+    match_threshold: float = 0.75,
+    min_sightings: int = 2,
+) -> FaceGallery:
+    """Sample the target, cluster its faces into identities and write the gallery (blocking)"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    info = probe_video(video_path)
+    step = max(1, int(round(info.fps / sample_fps)), math.ceil(info.frame_count / max_samples))
+    sightings = sample_faces(video_path, step)
+    clusters = [
+        cluster for cluster in cluster_faces(sightings, step, match_threshold)
+        # A face seen once at a low sample rate is usually a false detection
+        if len(cluster) >= min(min_sightings, len(sightings))
+    ]
+    clusters.sort(key=len, reverse=True)
+
+    identities = []
+    for identity, cluster in enumerate(clusters):
+        members = [sightings[index][0] for index in cluster]
+        reference = pick_reference(members)
+        identities.append(FaceIdentity(
+            identity=identity,
+            sightings=len(members),
+            first_frame=min(s.frame for s in members),
+            last_frame=max(s.frame for s in members),
+            reference_frame=reference.frame,
+            reference_position=reference.position,
+            box=reference.box,
+            thumbnail=f"{identity}.jpg",
+        ))
+
+    capture = cv2.VideoCapture(str(video_path))
+    try:
+        for face in identities:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, face.reference_frame)
+            ok, frame = capture.read()
+            if ok:
+                save_thumbnail(frame, face.box, out_dir / face.thumbnail)
+    finally:
+        capture.release()
+
+    gallery = FaceGallery(
+        video=video_path.name,
+        fps=info.fps,
+        frame_count=info.frame_count,
+        sample_step=step,
+        identities=identities,
+        created_at=time.time(),
+    )
+    tmp_path = out_dir / f"{GALLERY_INDEX}.tmp"
+    tmp_path.write_text(gallery.model_dump_json())
+    os.replace(tmp_path, out_dir / GALLERY_INDEX)
+    (out_dir / DONE_MARKER).touch()
+    logger.info(f"Face gallery for {video_path.name}: {len(identities)} identities from {len(sightings)} faces")
+    return gallery
@@ -0,0 +1,70 @@
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+FACEFUSION_PATH = Path("/workspace/facefusion")  # FaceFusionのインストールパス
+
+
+def build_facefusion_command(
+    source_image: str,
+    target_video: str,
+    output_path: str,
+    execution_providers: str = "cuda",
+    execution_thread_count: int = 2,  # 4GB VRAMに配慮
+    face_detector_model: str = "yolo_face",
+    face_detector_score: float = 0.5,
+    processors: Sequence[str] = ("face_swapper",),
+    log_level: str = "info",
+    face_enhancer_model: Optional[str] = None,
+    frame_enhancer_model: Optional[str] = None,
+    output_video_resolution: Optional[str] = None,
+    output_video_encoder: Optional[str] = None,
+    output_video_preset: Optional[str] = None,
+    output_video_quality: Optional[int] = None,
+    face_selector_mode: Optional[str] = None,
+    face_selector_order: Optional[str] = None,
+    reference_face_position: Optional[int] = None,
+    reference_frame_number: Optional[int] = None,
+    trim_frame_start: Optional[int] = None,
+    trim_frame_end: Optional[int] = None,
+    extra_args: Optional[List[str]] = None,
+) -> List[str]:
+    """FaceFusion headless-run のコマンドラインを構築"""
+    cmd = [
+        "python3",
+        str(FACEFUSION_PATH / "facefusion.py"),
+        "headless-run",
+        "--source", source_image,
+        "--target", target_video,
+        "--output-path", output_path,
+        "--execution-providers", execution_providers,
+        "--execution-thread-count", str(execution_thread_count),
+        "--face-detector-model", face_detector_model,
+        "--face-detector-score", str(face_detector_score),
+        "--processors", *processors,
+        "--log-level", log_level,
+    ]
+    # プロファイルの強調モデル・出力エンコード設定（未指定はFaceFusionの既定値）
+    optional = {
+        "--face-enhancer-model": face_enhancer_model,
+        "--frame-enhancer-model": frame_enhancer_model,
+        "--output-video-resolution": output_video_resolution,
+        "--output-video-encoder": output_video_encoder,
+        "--output-video-preset": output_video_preset,
+        "--output-video-quality": output_video_quality,
+        # 参照顔の指定（ギャラリーで選んだ人物だけを顔交換）
+        "--face-selector-mode": face_selector_mode,
+        "--face-selector-order": face_selector_order,
+        "--reference-face-position": reference_face_position,
+        "--reference-frame-number": reference_frame_number,
+    }
+    for flag, value in optional.items():
+        if value is not None:
+            cmd += [flag, str(value)]
+    # フレーム範囲指定（終了フレームは含まない）
+    if trim_frame_start is not None:
+        cmd += ["--trim-frame-start", str(trim_frame_start)]
+    if trim_frame_end is not None:
+        cmd += ["--trim-frame-end", str(trim_frame_end)]
+    if extra_args:
+        cmd += extra_args
+    return cmd
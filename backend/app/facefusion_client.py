@@ -1,120 +1,461 @@
 import httpx
 import asyncio
+import os
+import random
+import uuid
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
+from urllib.parse import urljoin
 import logging
+from starlette.concurrency import run_in_threadpool
 from .config import settings
+from .face_gallery import REFERENCE_FACE_ORDER, reference_options
+from .profiles import get_profile
+from .resilience import CircuitBreaker, CircuitOpenError, retry_async, hedged
 
 logger = logging.getLogger(__name__)
 
+# Errors where the request never reached the backend, so even a POST is safe to resend
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, CircuitOpenError)
+
+# Errors worth retrying for idempotent calls
+RETRYABLE_ERRORS = CONNECT_ERRORS + (httpx.ReadTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+
+# Downloaded chunks are written in batches of about this size, off the event loop
+DOWNLOAD_WRITE_BATCH = 1024 * 1024
+
+
+class BackendUnavailableError(Exception):
+    """Raised when no FaceFusion backend can accept a request"""
+
+
+# Marker file identifying a shared volume; both sides must read the same id
+VOLUME_ID_FILE = ".facefusion_volume_id"
+
+
+def local_volume_id(root: Path) -> Optional[str]:
+    """Read the shared-volume marker under ``root``, creating it on first use"""
+    marker = root / VOLUME_ID_FILE
+    try:
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        try:
+            return marker.read_text().strip() or None
+        except OSError:
+            return None
+    except OSError:
+        # Root missing or read-only: path-reference mode is unavailable
+        return None
+    volume_id = uuid.uuid4().hex
+    with os.fdopen(fd, "w") as f:
+        f.write(volume_id)
+    return volume_id
+
+
+def shared_relative_path(path: Path, root: Path) -> Optional[str]:
+    """Path relative to the shared volume root, or None if it lives elsewhere"""
+    try:
+        return Path(path).resolve().relative_to(root.resolve()).as_posix()
+    except ValueError:
+        return None
+
+
+class FaceFusionBackend:
+    """A single FaceFusion service URL with its own breaker and load counter"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.breaker = CircuitBreaker(
+            name=self.url,
+            failure_threshold=settings.facefusion_breaker_failure_threshold,
+            reset_timeout=settings.facefusion_breaker_reset_seconds,
+        )
+        self.outstanding = 0
+        # None until negotiated; then whether the backend sees our shared volume
+        self.path_reference: Optional[bool] = None
+
+    def absolute(self, path: str) -> str:
+        return urljoin(self.url + "/", path.lstrip("/"))
+
+
+class BackendPool:
+    """Least-outstanding-requests selection over the configured backends"""
+
+    def __init__(self, urls: List[str]):
+        self.backends = [FaceFusionBackend(url) for url in urls]
+        self._by_url = {backend.url: backend for backend in self.backends}
+
+    def get(self, url: str) -> Optional[FaceFusionBackend]:
+        return self._by_url.get(url.rstrip("/"))
+
+    def choose(self, exclude: Optional[set] = None) -> FaceFusionBackend:
+        candidates = [
+            backend for backend in self.backends
+            if backend.url not in (exclude or set()) and backend.breaker.state != CircuitBreaker.OPEN
+        ]
+        if not candidates:
+            raise BackendUnavailableError("No FaceFusion backend available (all circuits open)")
+        least = min(backend.outstanding for backend in candidates)
+        return random.choice([backend for backend in candidates if backend.outstanding == least])
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "url": backend.url,
+                "outstanding": backend.outstanding,
+                "path_reference": backend.path_reference,
+                **backend.breaker.snapshot()
+            }
+            for backend in self.backends
+        ]
+
+
+_shared_http_client: Optional[httpx.AsyncClient] = None
+_shared_pool: Optional[BackendPool] = None
+
+
+def get_shared_http_client() -> httpx.AsyncClient:
+    """Process-wide pooled HTTP client for FaceFusion calls (keep-alive reuse)"""
+    global _shared_http_client
+    if _shared_http_client is None or _shared_http_client.is_closed:
+        _shared_http_client = httpx.AsyncClient(
+            timeout=settings.facefusion_timeout,
+            limits=httpx.Limits(
+                max_connections=settings.facefusion_max_connections,
+                max_keepalive_connections=settings.facefusion_max_keepalive_connections,
+                keepalive_expiry=settings.facefusion_keepalive_expiry,
+            ),
+        )
+    return _shared_http_client
+
+
+def get_backend_pool() -> BackendPool:
+    global _shared_pool
+    if _shared_pool is None:
+        _shared_pool = BackendPool(settings.facefusion_backend_urls)
+    return _shared_pool
+
+
+async def close_shared_http_client():
+    global _shared_http_client
+    if _shared_http_client is not None:
+        await _shared_http_client.aclose()
+        _shared_http_client = None
+
+
+async def write_stream(response: httpx.Response, save_path: Path):
+    """Write a streamed response body to ``save_path``, with the disk writes in the threadpool"""
+    f = await run_in_threadpool(open, save_path, 'wb')
+    try:
+        pending, size = [], 0
+        async for chunk in response.aiter_bytes(chunk_size=65536):
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= DOWNLOAD_WRITE_BATCH:
+                await run_in_threadpool(f.write, b"".join(pending))
+                pending, size = [], 0
+        if pending:
+            await run_in_threadpool(f.write, b"".join(pending))
+    finally:
+        await run_in_threadpool(f.close)
+
+
 class FaceFusionClient:
     """Client for interacting with FaceFusion API"""
-    
+
     def __init__(self, base_url: str = None, timeout: int = None):
-        self.base_url = base_url or settings.facefusion_url
+        # An explicit base_url pins the client to a single backend
+        self.pool = BackendPool([base_url]) if base_url else get_backend_pool()
         self.timeout = timeout or settings.facefusion_timeout
         self.client = None
-    
+        self._job_backends: Dict[str, str] = {}
+
     async def __aenter__(self):
-        self.client = httpx.AsyncClient(
-            base_url=self.base_url,
-            timeout=self.timeout
-        )
+        self.client = get_shared_http_client()
         return self
-    
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.client:
-            await self.client.aclose()
-    
-    async def check_health(self) -> bool:
-        """Check if FaceFusion service is healthy"""
+        # The shared client outlives this context; it is closed on app shutdown
+        self.client = None
+
+    async def _send(self, backend: FaceFusionBackend, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send one request through a backend's circuit breaker"""
+        probe = backend.breaker.state == CircuitBreaker.HALF_OPEN
+        if not backend.breaker.allow_request():
+            raise CircuitOpenError(f"Circuit open for {backend.url}")
+        backend.outstanding += 1
         try:
-            response = await self.client.get("/health")
-            return response.status_code == 200
+            response = await self.client.request(
+                method, backend.absolute(path), timeout=self.timeout, **kwargs
+            )
+            if response.status_code >= 500:
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.record_success()
+            response.raise_for_status()
+            return response
+        except httpx.TransportError:
+            backend.breaker.record_failure()
+            raise
+        finally:
+            backend.outstanding -= 1
+            # A cancelled probe (e.g. the losing copy of a hedged call) records nothing
+            if probe:
+                backend.breaker.release_probe()
+
+    async def _idempotent(self, backend: FaceFusionBackend, path: str, hedge: bool = False) -> httpx.Response:
+        """GET with bounded jittered retries and optional hedging"""
+        async def attempt():
+            if hedge:
+                return await hedged(lambda: self._send(backend, "GET", path), settings.facefusion_hedge_delay)
+            return await self._send(backend, "GET", path)
+
+        return await retry_async(
+            attempt,
+            attempts=settings.facefusion_retry_attempts,
+            base_delay=settings.facefusion_retry_base_delay,
+            retry_on=RETRYABLE_ERRORS,
+        )
+
+    async def _negotiate_path_reference(self, backend: FaceFusionBackend) -> bool:
+        """Ask the backend whether it mounts the same shared volume as we do.
+
+        The service reports the id found in its copy of VOLUME_ID_FILE; a
+        match proves both sides see the same files. The answer is cached per
+        backend, except when the capabilities call itself failed.
+        """
+        if not settings.facefusion_path_reference:
+            return False
+        if backend.path_reference is not None:
+            return backend.path_reference
+
+        volume_id = local_volume_id(settings.shared_volume_root)
+        if volume_id is None:
+            backend.path_reference = False
+            return False
+
+        try:
+            response = await self._idempotent(backend, "/api/capabilities")
+            capabilities = response.json()
+        except httpx.HTTPStatusError:
+            # Older services without the endpoint only speak multipart
+            backend.path_reference = False
+            return False
         except Exception as e:
-            logger.error(f"FaceFusion health check failed: {e}")
+            logger.warning(f"Capability negotiation with {backend.url} failed: {e}")
             return False
-    
+
+        backend.path_reference = bool(
+            capabilities.get("path_reference") and capabilities.get("volume_id") == volume_id
+        )
+        logger.info(f"FaceFusion backend {backend.url} path-reference mode: {backend.path_reference}")
+        return backend.path_reference
+
+    def _path_reference_payload(
+        self,
+        source_image_path: Path,
+        target_video_path: Path,
+        output_path: Optional[Path]
+    ) -> Optional[Dict[str, Any]]:
+        """Relative paths for the request, or None if any file is off the shared volume"""
+        root = settings.shared_volume_root
+        paths = {
+            'source_path': shared_relative_path(source_image_path, root),
+            'target_path': shared_relative_path(target_video_path, root),
+        }
+        if output_path is not None:
+            paths['output_path'] = shared_relative_path(output_path, root)
+        if any(value is None for value in paths.values()):
+            return None
+        paths['source_size'] = os.path.getsize(source_image_path)
+        paths['target_size'] = os.path.getsize(target_video_path)
+        return paths
+
+    def circuit_state(self) -> List[Dict[str, Any]]:
+        """Breaker state and load for every backend, for health reporting"""
+        return self.pool.snapshot()
+
+    async def check_health(self) -> bool:
+        """Check if any FaceFusion backend is healthy"""
+        for backend in self.pool.backends:
+            try:
+                await self._send(backend, "GET", "/health")
+                return True
+            except Exception as e:
+                logger.error(f"FaceFusion health check failed for {backend.url}: {e}")
+        return False
+
     async def process_face_swap(
         self,
         source_image_path: Path,
         target_video_path: Path,
-        options: Optional[Dict[str, Any]] = None
+        options: Optional[Dict[str, Any]] = None,
+        output_path: Optional[Path] = None,
+        profile: Optional[str] = None,
+        reference: Optional[Dict[str, int]] = None
     ) -> Dict[str, Any]:
         """
         Process face swap with FaceFusion
-        
+
+        When the backend mounts the same shared volume, only relative paths
+        are sent and the service writes its result straight to ``output_path``
+        (``path_reference`` is True in the result). Otherwise the files are
+        uploaded as multipart and the output must be downloaded.
+
         Args:
             source_image_path: Path to source face image
             target_video_path: Path to target video
             options: Processing options
-        
+            output_path: Where the service should write the output in path mode
+            profile: Processing profile supplying detector, enhancers and
+                encoder settings (``service_default_profile`` when None)
+            reference: ``{"frame", "position"}`` of the only face to swap,
+                from the target's face gallery (every face when None)
+
         Returns:
-            Processing result with output URL
+            Processing result with output URL (absolute, on the backend that ran the job)
         """
         default_options = {
             'face_selector_mode': 'many',
             'face_analyser_order': 'left-right',
             'face_analyser_age': 'all',
             'face_analyser_gender': 'all',
-            'face_detector_model': 'retinaface',
             'face_recognizer_model': 'arcface_inswapper',
             'face_mask_type': 'box',
-            'face_enhancer_model': 'gfpgan_1.4',
-            'frame_enhancer_model': 'real_esrgan_x4plus',
             'execution_providers': ['cpu'],
             'execution_thread_count': 4,
-            'execution_queue_count': 1
+            'execution_queue_count': 1,
+            **get_profile(profile or settings.service_default_profile).api_options()
         }
-        
+        if reference:
+            # The service takes the FaceFusion 2 name for the face order
+            default_options.update(reference_options(reference), face_analyser_order=REFERENCE_FACE_ORDER)
+            default_options.pop('face_selector_order')
+
         if options:
             default_options.update(options)
-        
-        try:
-            with open(source_image_path, 'rb') as source_file, \
-                 open(target_video_path, 'rb') as target_file:
-                
-                files = {
-                    'source': ('source.jpg', source_file, 'image/jpeg'),
-                    'target': ('target.mp4', target_file, 'video/mp4')
-                }
-                
-                response = await self.client.post(
-                    "/api/process",
-                    files=files,
-                    data=default_options
-                )
-                response.raise_for_status()
-                
-                return response.json()
-        
-        except httpx.HTTPStatusError as e:
-            logger.error(f"FaceFusion API error: {e.response.status_code} - {e.response.text}")
-            raise Exception(f"FaceFusion processing failed: {e.response.status_code}")
-        except Exception as e:
-            logger.error(f"Error during face swap processing: {e}")
-            raise
-    
-    async def get_job_status(self, job_id: str) -> Dict[str, Any]:
-        """Get processing job status"""
+
+        # Submission is not idempotent: only fail over when the request never
+        # left this process (connect errors or an open circuit).
+        tried = set()
+        last_error: Optional[Exception] = None
+        for attempt in range(settings.facefusion_retry_attempts):
+            try:
+                backend = self.pool.choose(exclude=tried)
+            except BackendUnavailableError:
+                if last_error is not None:
+                    break
+                raise
+            tried.add(backend.url)
+
+            try:
+                response = None
+                payload = None
+                if await self._negotiate_path_reference(backend):
+                    payload = self._path_reference_payload(source_image_path, target_video_path, output_path)
+
+                if payload is not None:
+                    try:
+                        response = await self._send(
+                            backend,
+                            "POST",
+                            "/api/process",
+                            json={**default_options, **payload}
+                        )
+                    except httpx.HTTPStatusError as e:
+                        if e.response.status_code >= 500:
+                            raise
+                        # The service can't resolve our paths after all: stop
+                        # trying and fall back to uploading the bytes
+                        logger.warning(f"Path-reference request rejected by {backend.url}: {e.response.status_code}")
+                        backend.path_reference = False
+                        payload = None
+
+                if response is None:
+                    with open(source_image_path, 'rb') as source_file, \
+                         open(target_video_path, 'rb') as target_file:
+
+                        files = {
+                            'source': ('source.jpg', source_file, 'image/jpeg'),
+                            'target': ('target.mp4', target_file, 'video/mp4')
+                        }
+
+                        response = await self._send(
+                            backend,
+                            "POST",
+                            "/api/process",
+                            files=files,
+                            data=default_options
+                        )
+
+                result = response.json()
+                result['backend_url'] = backend.url
+                result['path_reference'] = payload is not None and 'output_path' in payload
+                if 'output_url' in result:
+                    result['output_url'] = backend.absolute(result['output_url'])
+                if 'job_id' in result:
+                    self._job_backends[result['job_id']] = backend.url
+                return result
+
+            except CONNECT_ERRORS as e:
+                last_error = e
+                logger.warning(f"FaceFusion backend {backend.url} unreachable: {e}")
+            except httpx.HTTPStatusError as e:
+                logger.error(f"FaceFusion API error: {e.response.status_code} - {e.response.text}")
+                raise Exception(f"FaceFusion processing failed: {e.response.status_code}")
+            except Exception as e:
+                logger.error(f"Error during face swap processing: {e}")
+                raise
+
+        raise BackendUnavailableError(f"All FaceFusion backends failed: {last_error}")
+
+    async def get_job_status(self, job_id: str, backend_url: Optional[str] = None) -> Dict[str, Any]:
+        """Get processing job status (hedged, retried GET on the owning backend)"""
+        url = backend_url or self._job_backends.get(job_id)
+        backend = (self.pool.get(url) if url else None) or self.pool.choose()
         try:
-            response = await self.client.get(f"/api/job/{job_id}")
-            response.raise_for_status()
+            response = await self._idempotent(backend, f"/api/job/{job_id}", hedge=True)
             return response.json()
         except Exception as e:
             logger.error(f"Error getting job status: {e}")
             raise
-    
+
     async def download_output(self, output_url: str, save_path: Path) -> None:
         """Download processed output file"""
+        backend = next(
+            (b for b in self.pool.backends if output_url.startswith(b.url)),
+            None
+        ) or self.pool.choose()
+
+        async def stream_to_file():
+            probe = backend.breaker.state == CircuitBreaker.HALF_OPEN
+            if not backend.breaker.allow_request():
+                raise CircuitOpenError(f"Circuit open for {backend.url}")
+            backend.outstanding += 1
+            try:
+                async with self.client.stream("GET", backend.absolute(output_url), timeout=self.timeout) as response:
+                    # Same accounting as _send: a backend answering 5xx counts against its breaker
+                    if response.status_code >= 500:
+                        backend.breaker.record_failure()
+                    else:
+                        backend.breaker.record_success()
+                    response.raise_for_status()
+                    await write_stream(response, save_path)
+            except httpx.TransportError:
+                backend.breaker.record_failure()
+                raise
+            finally:
+                backend.outstanding -= 1
+                if probe:
+                    backend.breaker.release_probe()
+
         try:
-            response = await self.client.get(output_url)
-            response.raise_for_status()
-            
-            with open(save_path, 'wb') as f:
-                async for chunk in response.aiter_bytes(chunk_size=8192):
-                    f.write(chunk)
-            
+            await retry_async(
+                stream_to_file,
+                attempts=settings.facefusion_retry_attempts,
+                base_delay=settings.facefusion_retry_base_delay,
+                retry_on=RETRYABLE_ERRORS,
+            )
             logger.info(f"Downloaded output to: {save_path}")
         except Exception as e:
             logger.error(f"Error downloading output: {e}")
@@ -126,20 +467,21 @@ async def example_usage():
         # Check health
         is_healthy = await client.check_health()
         print(f"FaceFusion service healthy: {is_healthy}")
-        
+
         # Process face swap
         result = await client.process_face_swap(
             source_image_path=Path("/path/to/source.jpg"),
             target_video_path=Path("/path/to/target.mp4")
         )
         print(f"Processing result: {result}")
-        
+
         # Download output
         if 'output_url' in result:
             await client.download_output(
                 output_url=result['output_url'],
                 save_path=Path("/path/to/output.mp4")
             )
+    await close_shared_http_client()
 
 if __name__ == "__main__":
-    asyncio.run(example_usage())
\ No newline at end of file
+    asyncio.run(example_usage())
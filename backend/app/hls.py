@@ -0,0 +1,150 @@
+import math
+import os
+import shutil
+import logging
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from .checkpoints import FrameRange, JobCheckpoint, render_chunks
+from .media import concat_videos, run_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_NAME = "index.m3u8"
+
+
+def plan_chunks(
+    frame_count: int,
+    fps: float,
+    chunk_seconds: float,
+    start_frame: int = 0,
+    end_frame: Optional[int] = None,
+) -> List[FrameRange]:
+    """Split ``[start_frame, end_frame)`` into consecutive ranges of ~chunk_seconds"""
+    end_frame = frame_count if end_frame is None else min(end_frame, frame_count)
+    chunk_frames = max(1, int(round(chunk_seconds * fps)))
+    return [
+        (start, min(start + chunk_frames, end_frame))
+        for start in range(start_frame, end_frame, chunk_frames)
+    ]
+
+
+class LivePlaylist:
+    """HLS EVENT playlist that grows one segment at a time.
+
+    Every update rewrites the playlist atomically, so players polling it
+    never see a half-written file.
+    """
+
+    def __init__(self, directory: Path, target_duration: float):
+        self.directory = directory
+        self.target_duration = max(1, math.ceil(target_duration))
+        self.segments: List[Tuple[str, float]] = []
+        self.ended = False
+
+    @property
+    def path(self) -> Path:
+        return self.directory / PLAYLIST_NAME
+
+    def add_segment(self, name: str, duration: float):
+        self.segments.append((name, duration))
+        self.target_duration = max(self.target_duration, math.ceil(duration))
+        self._write()
+
+    def finalize(self):
+        self.ended = True
+        self._write()
+
+    def render(self) -> str:
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for name, duration in self.segments:
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(name)
+        if self.ended:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def _write(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".m3u8.tmp")
+        tmp_path.write_text(self.render())
+        os.replace(tmp_path, self.path)
+
+
+def remux_segment(chunk_path: Path, segment_path: Path, offset_seconds: float):
+    """Repackage a rendered MP4 chunk as an MPEG-TS segment on the job timeline"""
+    run_ffmpeg([
+        "-i", str(chunk_path),
+        "-c", "copy",
+        "-bsf:v", "h264_mp4toannexb",
+        "-output_ts_offset", f"{offset_seconds:.3f}",
+        "-f", "mpegts",
+        str(segment_path),
+    ])
+
+
+class ProgressiveRenderer:
+    """Render a target in consecutive frame ranges and publish each as an HLS segment.
+
+    ``render_chunk(start, end, output_path)`` must produce an MP4 of frames
+    ``[start, end)``. Each finished chunk is remuxed into ``hls/`` and added
+    to the live playlist; at the end the chunks are joined into one MP4.
+    Chunks live in ``checkpoint`` (default ``job_dir/chunks``), so a re-run
+    with the same checkpoint only renders what is missing.
+    """
+
+    def __init__(self, job_dir: Path, fps: float, chunk_seconds: float, checkpoint: Optional[JobCheckpoint] = None):
+        self.job_dir = job_dir
+        self.fps = fps
+        self.checkpoint = checkpoint or JobCheckpoint(job_dir / "chunks")
+        self.hls_dir = job_dir / "hls"
+        self.playlist = LivePlaylist(self.hls_dir, chunk_seconds)
+
+    def render(
+        self,
+        ranges: List[FrameRange],
+        render_chunk: Callable[[int, int, Path], None],
+        on_segment: Optional[Callable[[int, int], None]] = None,
+        fingerprint: Optional[str] = None,
+    ) -> List[Path]:
+        """Render and publish every range, ending the playlist; returns the chunk paths"""
+        # The playlist is rebuilt from scratch; restored chunks are re-published
+        shutil.rmtree(self.hls_dir, ignore_errors=True)
+        self.checkpoint.begin(ranges, fingerprint)
+        base_frame = ranges[0][0] if ranges else 0
+
+        def publish(index: int, chunk_path: Path, resumed: bool):
+            start, end = ranges[index]
+            segment_name = f"seg_{index:05d}.ts"
+            remux_segment(chunk_path, self.hls_dir / segment_name, (start - base_frame) / self.fps)
+            self.playlist.add_segment(segment_name, (end - start) / self.fps)
+            logger.info(f"Segment {index + 1}/{len(ranges)} published: frames {start}-{end}")
+            if on_segment:
+                on_segment(index + 1, len(ranges))
+
+        self.hls_dir.mkdir(parents=True, exist_ok=True)
+        chunks = render_chunks(self.checkpoint, render_chunk, publish)
+        self.playlist.finalize()
+        return chunks
+
+    def run(
+        self,
+        ranges: List[FrameRange],
+        render_chunk: Callable[[int, int, Path], None],
+        output_path: Path,
+        on_segment: Optional[Callable[[int, int], None]] = None,
+        fingerprint: Optional[str] = None,
+        preset: Optional[str] = None,
+        crf: int = 18,
+    ) -> Path:
+        """Render, then join the chunks into ``output_path`` (re-encoded when ``preset`` is given)"""
+        chunks = self.render(ranges, render_chunk, on_segment, fingerprint)
+        concat_videos(chunks, output_path, preset=preset, crf=crf)
+        self.checkpoint.clear()
+        return output_path
@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+NEW = "new"
+PENDING = "pending"
+DONE = "done"
+MISMATCH = "mismatch"
+
+# Deletes a pending marker only while it still belongs to the caller: once the
+# pending TTL has expired, another request may own the key
+_ABANDON_SCRIPT = """
+local raw = redis.call('GET', KEYS[1])
+if raw then
+    local entry = cjson.decode(raw)
+    if entry['state'] == ARGV[1] and entry['owner'] == ARGV[2] then
+        return redis.call('DEL', KEYS[1])
+    end
+end
+return 0
+"""
+
+
+def request_fingerprint(payload: Any) -> str:
+    """Stable digest of a request body, to detect a key reused for a different request"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class MemoryIdempotencyStore:
+    """Process-local store; only correct with a single API worker"""
+
+    def __init__(self, ttl_seconds: int, pending_ttl_seconds: int = 300):
+        self.ttl_seconds = ttl_seconds
+        self.pending_ttl_seconds = pending_ttl_seconds
+        self._entries: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self._avoided = 0
+
+    def begin(
+        self, key: str, fingerprint: Optional[str], owner: Optional[str] = None
+    ) -> Tuple[str, Optional[Dict[str, Any]]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                self._entries[key] = (
+                    now + self.pending_ttl_seconds,
+                    {"state": PENDING, "fingerprint": fingerprint, "owner": owner},
+                )
+                self._purge(now)
+                return NEW, None
+            return _classify(entry[1], fingerprint)
+
+    def complete(self, key: str, fingerprint: Optional[str], result: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = (
+                time.monotonic() + self.ttl_seconds,
+                {"state": DONE, "fingerprint": fingerprint, "result": result},
+            )
+
+    def abandon(self, key: str, owner: Optional[str] = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1]["state"] == PENDING and entry[1].get("owner") == owner:
+                del self._entries[key]
+
+    def record_avoided(self):
+        with self._lock:
+            self._avoided += 1
+
+    def duplicates_avoided(self) -> int:
+        return self._avoided
+
+    def _purge(self, now: float):
+        if len(self._entries) > 10000:
+            for key in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+                del self._entries[key]
+
+
+class RedisIdempotencyStore:
+    """Shared store: keys are visible to every uvicorn worker and API replica"""
+
+    def __init__(self, redis_client, ttl_seconds: int, pending_ttl_seconds: int = 300, prefix: str = "idempotency:"):
+        self.redis = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.pending_ttl_seconds = pending_ttl_seconds
+        self.prefix = prefix
+        self._abandon = redis_client.register_script(_ABANDON_SCRIPT)
+
+    def begin(
+        self, key: str, fingerprint: Optional[str], owner: Optional[str] = None
+    ) -> Tuple[str, Optional[Dict[str, Any]]]:
+        pending = json.dumps({"state": PENDING, "fingerprint": fingerprint, "owner": owner})
+        if self.redis.set(self.prefix + key, pending, nx=True, ex=self.pending_ttl_seconds):
+            return NEW, None
+        raw = self.redis.get(self.prefix + key)
+        if raw is None:
+            # Expired between SET NX and GET; try once more
+            return self.begin(key, fingerprint, owner)
+        return _classify(json.loads(raw), fingerprint)
+
+    def complete(self, key: str, fingerprint: Optional[str], result: Dict[str, Any]):
+        entry = json.dumps({"state": DONE, "fingerprint": fingerprint, "result": result}, default=str)
+        self.redis.set(self.prefix + key, entry, ex=self.ttl_seconds)
+
+    def abandon(self, key: str, owner: Optional[str] = None):
+        # Compare-and-delete in one step; a GET then DEL could remove a new owner's marker
+        self._abandon(keys=[self.prefix + key], args=[PENDING, owner or ""])
+
+    def record_avoided(self):
+        self.redis.incr(self.prefix + "duplicates_avoided")
+
+    def duplicates_avoided(self) -> int:
+        return int(self.redis.get(self.prefix + "duplicates_avoided") or 0)
+
+
+def _classify(entry: Dict[str, Any], fingerprint: Optional[str]) -> Tuple[str, Optional[Dict[str, Any]]]:
+    if fingerprint is not None and entry.get("fingerprint") not in (None, fingerprint):
+        return MISMATCH, None
+    if entry.get("state") == DONE:
+        return DONE, entry.get("result")
+    return PENDING, None
+
+
+async def run_idempotent(
+    store,
+    scope: str,
+    key: Optional[str],
+    run: Callable[[], Awaitable[Dict[str, Any]]],
+    fingerprint: Optional[str] = None,
+    wait_timeout: float = 10.0,
+) -> Dict[str, Any]:
+    """Run ``run()`` at most once per (scope, Idempotency-Key).
+
+    A retry with the same key gets the original result back (and bumps the
+    duplicates-avoided counter). A retry that arrives while the first request
+    is still running waits up to ``wait_timeout`` for it, then gets 409.
+    If ``run()`` fails the key is released so the client can try again.
+    """
+    if not key:
+        return await run()
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} is too long")
+
+    store_key = f"{scope}:{key}"
+    # Identifies this attempt's pending marker, so releasing it never touches another request's
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + wait_timeout
+    while True:
+        state, result = await run_in_threadpool(store.begin, store_key, fingerprint, owner)
+        if state == NEW:
+            break
+        if state == MISMATCH:
+            raise HTTPException(
+                status_code=422,
+                detail=f"{IDEMPOTENCY_HEADER} was already used for a different request"
+            )
+        if state == DONE:
+            await run_in_threadpool(store.record_avoided)
+            logger.info(f"Idempotent replay for key {key} ({scope})")
+            return {**result, "idempotent_replay": True}
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(0.2)
+
+    try:
+        result = await run()
+    except BaseException:
+        await run_in_threadpool(store.abandon, store_key, owner)
+        raise
+    await run_in_threadpool(store.complete, store_key, fingerprint, result)
+    return result
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import logging
+from pathlib import Path
+
+import numpy as np
+from fastapi import HTTPException
+from PIL import Image, ImageOps, UnidentifiedImageError
+from pydantic import BaseModel
+
+from .face_detect import detect_faces
+
+logger = logging.getLogger(__name__)
+
+
+class NormalizedImage(BaseModel):
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    faces: int
+    size: int
+    sha256: str
+
+
+def _flatten_alpha(image: Image.Image) -> Image.Image:
+    """Composite transparent images onto white; the face models expect RGB"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def normalize_source_image(path: Path, max_dimension: int, require_face: bool = True) -> NormalizedImage:
+    """Normalize an uploaded source face image in place (blocking).
+
+    Applies EXIF orientation, drops alpha and all metadata, and downscales so
+    the longest side is at most ``max_dimension``. With ``require_face`` the
+    image is rejected (and deleted) when no face can be found, so the
+    failure happens at upload time instead of after a queued GPU job.
+    Images over Pillow's ``MAX_IMAGE_PIXELS`` are rejected with 413 before
+    they are decoded.
+    """
+    try:
+        with Image.open(path) as original:
+            if original.width * original.height > Image.MAX_IMAGE_PIXELS:
+                raise Image.DecompressionBombError(f"{original.width}x{original.height} pixels")
+            original.load()
+            image_format = original.format or "JPEG"
+            original_size = original.size
+            image = ImageOps.exif_transpose(original)
+            image = _flatten_alpha(image)
+    except Image.DecompressionBombError as e:
+        path.unlink(missing_ok=True)
+        logger.info(f"Rejected oversized image {path.name}: {e}")
+        raise HTTPException(status_code=413, detail="Image dimensions too large")
+    except (UnidentifiedImageError, OSError) as e:
+        path.unlink(missing_ok=True)
+        logger.info(f"Rejected unreadable image {path.name}: {e}")
+        raise HTTPException(status_code=400, detail="Invalid image file")
+
+    if max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    faces = len(detect_faces(np.asarray(image.convert("L"))))
+    if require_face and faces == 0:
+        path.unlink(missing_ok=True)
+        raise HTTPException(status_code=422, detail="No face detected in the source image")
+
+    # Re-encode without exif/icc/text chunks; write-then-rename so readers
+    # never see a truncated file
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    if image_format == "PNG":
+        image.save(tmp_path, "PNG")
+    else:
+        image.save(tmp_path, "JPEG", quality=95)
+    os.replace(tmp_path, path)
+    data = path.read_bytes()
+
+    return NormalizedImage(
+        width=image.width,
+        height=image.height,
+        original_width=original_size[0],
+        original_height=original_size[1],
+        faces=faces,
+        size=len(data),
+        sha256=hashlib.sha256(data).hexdigest(),
+    )
@@ -0,0 +1,370 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+import httpx
+from pydantic import BaseModel
+
+from .config import settings
+from .storage import UPLOADS, get_storage
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+INPUT_TOKEN_HEADER = "X-Input-Token"
+
+
+class InputRef(BaseModel):
+    """An input file addressed by the sha256 of its contents"""
+
+    digest: str
+    name: str  # Stored name (keeps the extension FaceFusion sniffs)
+    area: str = UPLOADS  # Storage area, or "templates"
+    path: Optional[str] = None  # Location on the shared volume / API host
+    size: int = 0
+    file_id: Optional[str] = None
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class InputIndex:
+    """file_id -> digest and digest -> location, written by the API at upload time.
+
+    Lives on the broker Redis so workers on any node can resolve inputs
+    without the shared upload volume. Per-host cache counters are kept there
+    too so the API can report cluster-wide hit rates.
+    """
+
+    def __init__(self, redis_client, ttl_seconds: int, prefix: str = "inputs:"):
+        self.redis = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def record(self, ref: InputRef):
+        payload = ref.model_dump_json()
+        pipe = self.redis.pipeline()
+        if ref.file_id:
+            pipe.set(f"{self.prefix}file:{ref.file_id}", payload, ex=self.ttl_seconds)
+        pipe.set(f"{self.prefix}digest:{ref.digest}", payload, ex=self.ttl_seconds)
+        pipe.execute()
+
+    def _get(self, key: str) -> Optional[InputRef]:
+        raw = self.redis.get(f"{self.prefix}{key}")
+        return InputRef.model_validate_json(raw) if raw else None
+
+    def lookup(self, file_id: str) -> Optional[InputRef]:
+        return self._get(f"file:{file_id}")
+
+    def by_digest(self, digest: str) -> Optional[InputRef]:
+        return self._get(f"digest:{digest}")
+
+    def count(self, hostname: str, counters: Dict[str, int]):
+        key = f"{self.prefix}stats:{hostname}"
+        pipe = self.redis.pipeline()
+        for field, amount in counters.items():
+            pipe.hincrby(key, field, amount)
+        pipe.expire(key, self.ttl_seconds)
+        pipe.execute()
+
+    def stats(self) -> Dict[str, object]:
+        """Per-host and total counters with hit rates"""
+        hosts = {}
+        for key in self.redis.scan_iter(match=f"{self.prefix}stats:*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            counters = {
+                (k.decode() if isinstance(k, bytes) else k): int(v)
+                for k, v in self.redis.hgetall(key).items()
+            }
+            hosts[key[len(f"{self.prefix}stats:"):]] = _with_hit_rate(counters)
+        total: Dict[str, int] = {}
+        for counters in hosts.values():
+            for field, value in counters.items():
+                if field != "hit_rate":
+                    total[field] = total.get(field, 0) + value
+        return {"hosts": hosts, "total": _with_hit_rate(total)}
+
+
+def _with_hit_rate(counters: Dict[str, int]) -> Dict[str, object]:
+    lookups = counters.get("hits", 0) + counters.get("misses", 0)
+    return {**counters, "hit_rate": round(counters.get("hits", 0) / lookups, 3) if lookups else 0.0}
+
+
+class SharedPathFetcher:
+    """Copies (or hard-links) the file from a volume this node also mounts"""
+
+    name = "shared"
+
+    def fetch(self, ref: InputRef, dest: Path) -> bool:
+        if not ref.path or not Path(ref.path).is_file():
+            return False
+        try:
+            os.link(ref.path, dest)
+        except OSError:
+            shutil.copyfile(ref.path, dest)
+        return True
+
+
+class HttpFetcher:
+    """Streams the file from the API's ``/api/inputs/{digest}`` endpoint"""
+
+    name = "http"
+
+    def __init__(self, base_url: str, token: str = "", timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+
+    def fetch(self, ref: InputRef, dest: Path) -> bool:
+        url = f"{self.base_url}/api/inputs/{ref.digest}"
+        headers = {INPUT_TOKEN_HEADER: self.token} if self.token else {}
+        with httpx.stream("GET", url, headers=headers, timeout=self.timeout, follow_redirects=True) as response:
+            if response.status_code == 404:
+                return False
+            response.raise_for_status()
+            with open(dest, "wb") as f:
+                for block in response.iter_bytes(HASH_CHUNK_SIZE):
+                    f.write(block)
+        return True
+
+
+class StorageFetcher:
+    """Downloads the file from the storage backend (object store)"""
+
+    name = "storage"
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def fetch(self, ref: InputRef, dest: Path) -> bool:
+        # Templates are only kept in the template library
+        if ref.area != UPLOADS or not self.storage.exists(ref.area, ref.name):
+            return False
+        self.storage.fetch(ref.area, ref.name, dest)
+        return True
+
+
+class ContentCache:
+    """Worker-local disk cache of inputs keyed by content digest.
+
+    Misses go through ``fetchers`` in order until one has the file; the
+    result is checked against the digest before it is published. A per-entry
+    ``flock`` makes concurrent fetches of the same input (threads or prefork
+    children on this node) wait for a single download. Jobs read entries
+    inside ``hold``, which keeps a shared lock on them; entries are evicted
+    least recently used first once the cache exceeds ``max_bytes``, skipping
+    held ones and those used within ``protect_seconds``.
+
+    Stored uploads that predate the digest index are cached by name
+    (``find_stored``) under the same size cap.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_bytes: int,
+        fetchers: List,
+        protect_seconds: float = 900.0,
+        on_lookup: Optional[Callable[[Dict[str, int]], None]] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fetchers = fetchers
+        self.protect_seconds = protect_seconds
+        self.on_lookup = on_lookup
+        self.counters: Dict[str, int] = {"hits": 0, "misses": 0, "coalesced": 0, "bytes_fetched": 0}
+
+    def entry_path(self, ref: InputRef) -> Path:
+        return self.cache_dir / ref.digest[:2] / f"{ref.digest}{Path(ref.name).suffix.lower()}"
+
+    def _count(self, **counters: int):
+        for field, amount in counters.items():
+            self.counters[field] = self.counters.get(field, 0) + amount
+        if self.on_lookup is not None:
+            try:
+                self.on_lookup(counters)
+            except Exception as e:
+                logger.warning(f"Could not export input cache stats: {e}")
+
+    def _lock_path(self, path: Path) -> Path:
+        lock_dir = self.cache_dir / ".locks"
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        return lock_dir / f"{path.name}.lock"
+
+    def get(self, ref: InputRef) -> Path:
+        """Local path of the input, fetching it on a miss"""
+        return self._get(self.entry_path(ref), lambda path: self._fetch(ref, path))
+
+    def find_stored(self, storage, area: str, prefix: str) -> Optional[Path]:
+        """Local copy of the first stored file starting with ``prefix`` (uploads without a digest)"""
+        if not storage.remote:
+            name = storage.find(area, prefix)
+            return storage.local_path(area, name) if name else None
+        cached = next((self.cache_dir / area).glob(f"{Path(prefix).name}*"), None)
+        name = cached.name if cached is not None else storage.find(area, prefix)
+        if not name:
+            return None
+
+        def fetch(path: Path) -> str:
+            tmp_path = self._tmp_path(path)
+            try:
+                storage.fetch(area, name, tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            return "storage"
+
+        return self._get(self.cache_dir / area / Path(name).name, fetch)
+
+    def _get(self, path: Path, fetch: Callable[[Path], str]) -> Path:
+        if path.is_file():
+            os.utime(path)
+            self._count(hits=1)
+            return path
+
+        with open(self._lock_path(path), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have fetched it while we waited
+            if path.is_file():
+                os.utime(path)
+                self._count(hits=1, coalesced=1)
+                return path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fetcher = fetch(path)
+            self._count(**{"misses": 1, "bytes_fetched": path.stat().st_size, f"fetched_{fetcher}": 1})
+        self.evict(keep=path)
+        return path
+
+    @contextmanager
+    def hold(self, resolve: Callable[[], Optional[Path]]) -> Iterator[Optional[Path]]:
+        """Path from ``resolve()`` (e.g. ``lambda: cache.get(ref)``), kept from eviction inside the block"""
+        while True:
+            path = resolve()
+            if path is None or self.cache_dir not in path.parents:
+                yield path
+                return
+            lock_path = self._lock_path(path)
+            lock_file = open(lock_path, "a")
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            try:
+                current = os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current and path.is_file():
+                break
+            # Evicted between resolving and locking: fetch it again
+            lock_file.close()
+        try:
+            yield path
+        finally:
+            lock_file.close()
+
+    @staticmethod
+    def _tmp_path(path: Path) -> Path:
+        return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def _fetch(self, ref: InputRef, path: Path) -> str:
+        tmp_path = self._tmp_path(path)
+        errors = []
+        for fetcher in self.fetchers:
+            tmp_path.unlink(missing_ok=True)
+            try:
+                if not fetcher.fetch(ref, tmp_path):
+                    continue
+                if file_sha256(tmp_path) != ref.digest:
+                    errors.append(f"{fetcher.name}: digest mismatch")
+                    continue
+                os.replace(tmp_path, path)
+                return fetcher.name
+            except Exception as e:
+                errors.append(f"{fetcher.name}: {e}")
+            finally:
+                tmp_path.unlink(missing_ok=True)
+        detail = "; ".join(errors) or "not found"
+        raise FileNotFoundError(f"Input {ref.name} ({ref.digest[:12]}) unavailable: {detail}")
+
+    def evict(self, keep: Optional[Path] = None) -> List[Path]:
+        if not self.cache_dir.is_dir():
+            return []
+        files = [
+            p for p in self.cache_dir.glob("*/*")
+            if p.is_file() and not p.name.startswith(".") and p.parent.name != ".locks"
+        ]
+        total = sum(p.stat().st_size for p in files)
+        cutoff = time.time() - self.protect_seconds
+        evicted = []
+        for path in sorted(files, key=lambda p: p.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            if path == keep or path.stat().st_mtime > cutoff:
+                continue
+            size = path.stat().st_size
+            if not self._remove_unheld(path):
+                continue
+            total -= size
+            evicted.append(path)
+            logger.info(f"Evicted cached input {path.name}")
+        # Locks of entries that are gone (failed fetches)
+        names = {p.name for p in files} - {p.name for p in evicted}
+        for lock_path in (self.cache_dir / ".locks").glob("*.lock"):
+            if lock_path.name[:-len(".lock")] not in names:
+                self._remove_unheld(None, lock_path)
+        return evicted
+
+    def _remove_unheld(self, path: Optional[Path], lock_path: Optional[Path] = None) -> bool:
+        """Delete an entry and its lock unless a job holds it or a fetch is in progress"""
+        lock_path = lock_path or self._lock_path(path)
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if path is not None:
+                path.unlink(missing_ok=True)
+            # Removed while locked; a process that opened it meanwhile re-checks the entry
+            lock_path.unlink(missing_ok=True)
+        return True
+
+    def stats(self) -> Dict[str, object]:
+        return _with_hit_rate(self.counters)
+
+
+def create_fetchers(names: str, storage=None) -> List:
+    """Fetchers named in ``input_fetchers`` (shared, http, storage), in order"""
+    fetchers = []
+    for name in (n.strip() for n in names.split(",")):
+        if name == "shared":
+            fetchers.append(SharedPathFetcher())
+        elif name == "http":
+            if settings.input_fetch_url:
+                fetchers.append(HttpFetcher(settings.input_fetch_url, settings.input_fetch_token))
+        elif name == "storage":
+            fetchers.append(StorageFetcher(storage or get_storage()))
+        elif name:
+            raise ValueError(f"Unknown input fetcher: {name}")
+    return fetchers
+
+
+def create_content_cache(index: Optional[InputIndex] = None) -> ContentCache:
+    """Cache configured from settings, exporting its counters to ``index``"""
+    hostname = socket.gethostname()
+    return ContentCache(
+        settings.input_cache_dir,
+        int(settings.input_cache_max_gb * 1024 ** 3),
+        create_fetchers(settings.input_fetchers),
+        on_lookup=(lambda counters: index.count(hostname, counters)) if index is not None else None,
+    )
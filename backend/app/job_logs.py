@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, Deque, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+LOG_DIR_NAME = ".logs"
+
+
+def job_log_path(output_dir: Path, job_id: str) -> Path:
+    """Shared-volume location of a job's log tail (written by workers, read by the API)"""
+    return output_dir / LOG_DIR_NAME / f"{job_id}.json"
+
+
+class JobLog:
+    """Bounded tail of one job's process output.
+
+    Only the last ``max_lines`` lines are kept. Lines are forwarded to the
+    application log at most ``forward_per_second`` times per second; the
+    rest are counted and reported as suppressed. With ``path`` the tail is
+    also persisted (atomically, at most every ``flush_interval`` seconds) so
+    another process can serve it.
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        max_lines: int = 500,
+        forward_per_second: float = 5.0,
+        path: Optional[Path] = None,
+        flush_interval: float = 2.0,
+    ):
+        self.job_id = job_id
+        self.lines: Deque[Dict[str, Any]] = deque(maxlen=max_lines)
+        self.total_lines = 0
+        self.forward_per_second = forward_per_second
+        self.path = path
+        self.flush_interval = flush_interval
+        self._tokens = forward_per_second
+        self._refilled_at = time.monotonic()
+        self._suppressed = 0
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+
+    def append(self, line: str, stream: str = "stdout"):
+        if self._append(line, stream):
+            self.flush()
+
+    async def append_async(self, line: str, stream: str = "stdout"):
+        """``append`` for event-loop callers: the periodic flush runs in the threadpool"""
+        if self._append(line, stream):
+            await run_in_threadpool(self.flush)
+
+    def _append(self, line: str, stream: str) -> bool:
+        """Record a line; True when the tail is due to be flushed"""
+        line = line.rstrip()
+        if not line:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self.lines.append({"t": round(time.time(), 3), "stream": stream, "line": line})
+            self.total_lines += 1
+            forward = self._take_token(now)
+            suppressed = self._suppressed
+            if forward:
+                self._suppressed = 0
+            else:
+                self._suppressed += 1
+            flush = self.path is not None and now - self._flushed_at >= self.flush_interval
+        if forward:
+            note = f" ({suppressed} lines suppressed)" if suppressed else ""
+            logger.info(f"[{self.job_id}] {stream}: {line}{note}")
+        return flush
+
+    def _take_token(self, now: float) -> bool:
+        self._tokens = min(
+            self.forward_per_second,
+            self._tokens + (now - self._refilled_at) * self.forward_per_second,
+        )
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def tail(self, count: int = 20) -> str:
+        """The last ``count`` lines, for attaching to an error"""
+        with self._lock:
+            lines = list(self.lines)[-count:]
+        return "\n".join(entry["line"] for entry in lines)
+
+    def snapshot(self, limit: Optional[int] = None) -> Dict[str, Any]:
+        with self._lock:
+            lines = list(self.lines)
+            total = self.total_lines
+        if limit is not None:
+            lines = lines[-limit:] if limit > 0 else []
+        return {
+            "job_id": self.job_id,
+            "lines": lines,
+            "total_lines": total,
+            "dropped": total - len(self.lines),
+        }
+
+    def flush(self):
+        """Persist the current tail to ``path``, if set"""
+        if self.path is None:
+            return
+        with self._lock:
+            self._flushed_at = time.monotonic()
+        snapshot = self.snapshot()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".json.tmp")
+            tmp_path.write_text(json.dumps(snapshot))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write job log {self.path}: {e}")
+
+
+def read_job_log(path: Path, limit: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Load a tail persisted by ``JobLog.flush``"""
+    try:
+        snapshot = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    if limit is not None:
+        snapshot["lines"] = snapshot["lines"][-limit:] if limit > 0 else []
+    return snapshot
+
+
+def cleanup_job_logs(output_dir: Path, max_age_seconds: float) -> int:
+    """Remove persisted log tails older than ``max_age_seconds``"""
+    log_dir = output_dir / LOG_DIR_NAME
+    if not log_dir.is_dir():
+        return 0
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for path in log_dir.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+class JobLogRegistry:
+    """In-process job logs, keeping only the ``max_jobs`` most recent jobs"""
+
+    def __init__(self, max_lines: int = 500, forward_per_second: float = 5.0, max_jobs: int = 200):
+        self.max_lines = max_lines
+        self.forward_per_second = forward_per_second
+        self.max_jobs = max_jobs
+        self._logs: "OrderedDict[str, JobLog]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job_id: str, path: Optional[Path] = None) -> JobLog:
+        job_log = JobLog(job_id, self.max_lines, self.forward_per_second, path=path)
+        with self._lock:
+            self._logs[job_id] = job_log
+            self._logs.move_to_end(job_id)
+            while len(self._logs) > self.max_jobs:
+                self._logs.popitem(last=False)
+        return job_log
+
+    def get(self, job_id: str) -> Optional[JobLog]:
+        with self._lock:
+            return self._logs.get(job_id)
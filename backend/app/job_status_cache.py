@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import json
+import time
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+logger = logging.getLogger(__name__)
+
+StatusLoader = Callable[[str], Awaitable[Dict[str, Any]]]
+ChangeCallback = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+
+def status_etag(payload: Dict[str, Any]) -> str:
+    """Strong ETag derived from the serialized status, so it changes iff the status does"""
+    body = json.dumps(payload, sort_keys=True, default=str).encode()
+    return '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+
+class CoalescingStatusCache:
+    """Single-flight micro-cache in front of a job status backend.
+
+    Concurrent lookups of the same job share one in-flight backend read, and
+    the result is reused for ``ttl`` seconds. With long-polling watchers all
+    re-checking through this cache, backend load is bounded by roughly one
+    read per job per ``ttl`` regardless of how many clients are watching.
+    """
+
+    def __init__(
+        self,
+        loader: StatusLoader,
+        ttl: float = 1.0,
+        poll_interval: float = 1.0,
+        on_change: Optional[ChangeCallback] = None,
+        max_entries: int = 10000,
+    ):
+        self.loader = loader
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[float, Dict[str, Any], str]] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.backend_reads = 0
+
+    async def get(self, key: str) -> Tuple[Dict[str, Any], str]:
+        """Return ``(payload, etag)`` for a job, loading at most once per ttl"""
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            return entry[1], entry[2]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            self.backend_reads += 1
+            payload = await self.loader(key)
+            etag = status_etag(payload)
+            previous = self._entries.get(key)
+            self._store(key, payload, etag)
+            future.set_result((payload, etag))
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an exception nobody else awaited isn't logged
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        if self.on_change is not None and (previous is None or previous[2] != etag):
+            try:
+                await self.on_change(key, payload)
+            except Exception as e:
+                logger.error(f"Status change callback failed for {key}: {e}")
+        return payload, etag
+
+    async def wait_for_change(self, key: str, etag: str, timeout: float) -> Tuple[Dict[str, Any], str]:
+        """Long-poll: return once the job's ETag differs from ``etag`` or ``timeout`` expires"""
+        deadline = time.monotonic() + timeout
+        while True:
+            payload, current = await self.get(key)
+            remaining = deadline - time.monotonic()
+            if current != etag or remaining <= 0:
+                return payload, current
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+    def _store(self, key: str, payload: Dict[str, Any], etag: str):
+        now = time.monotonic()
+        self._entries[key] = (now, payload, etag)
+        if len(self._entries) > self.max_entries:
+            expired = [k for k, (at, _, _) in self._entries.items() if now - at >= self.ttl]
+            for k in expired:
+                del self._entries[k]
+
+
+async def conditional_status_response(
+    cache: CoalescingStatusCache,
+    key: str,
+    if_none_match: Optional[str],
+    wait: float = 0,
+) -> Response:
+    """Serve a job status with ETag, honoring If-None-Match and ``?wait=`` long-polling"""
+    payload, etag = await cache.get(key)
+    if wait > 0 and if_none_match == etag:
+        payload, etag = await cache.wait_for_change(key, etag, wait)
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=jsonable_encoder(payload), headers=headers)
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import logging
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED = ("pending", "processing")
+STATUS_FIELDS = ("status", "progress", "output_url", "error")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT UNIQUE NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    output_url TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, seq);
+"""
+
+
+class LocalJobQueue:
+    """Durable job queue and status table in a single SQLite file.
+
+    Pending jobs are claimed highest priority first, FIFO within a priority.
+    All methods block; call them from a thread when on the event loop.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def enqueue(self, job_id: str, payload: Dict[str, Any], priority: int = 0):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, priority, payload, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, 'pending', ?, ?)",
+                (job_id, priority, json.dumps(payload), now, now),
+            )
+
+    def claim_next(self) -> Optional[Dict[str, Any]]:
+        """Atomically move the next pending job to ``processing`` and return it"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, payload FROM jobs WHERE status = 'pending'"
+                " ORDER BY priority DESC, seq LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'processing', attempts = attempts + 1, updated_at = ?"
+                " WHERE job_id = ?",
+                (time.time(), row["job_id"]),
+            )
+            return {"job_id": row["job_id"], "payload": json.loads(row["payload"])}
+
+    def update(self, job_id: str, **fields):
+        unknown = set(fields) - set(STATUS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE job_id = ?",
+                (*fields.values(), time.time(), job_id),
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, status, progress, output_url, error FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def position(self, job_id: str) -> Optional[int]:
+        """Number of pending jobs that will be claimed before ``job_id``"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT priority, seq FROM jobs WHERE job_id = ? AND status = 'pending'", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'pending'"
+                " AND (priority > ? OR (priority = ? AND seq < ?))",
+                (row["priority"], row["priority"], row["seq"]),
+            ).fetchone()[0]
+
+    def count(self, statuses=UNFINISHED) -> int:
+        placeholders = ", ".join("?" for _ in statuses)
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status IN ({placeholders})", tuple(statuses)
+            ).fetchone()[0]
+
+    def recover(self) -> int:
+        """Requeue jobs that were running when the process stopped"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', progress = 0, updated_at = ? WHERE status = 'processing'",
+                (time.time(),),
+            )
+            return cursor.rowcount
+
+    def purge_finished(self, older_than_seconds: float) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE status NOT IN ('pending', 'processing') AND updated_at < ?",
+                (time.time() - older_than_seconds,),
+            )
+            return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LocalExecutor:
+    """Runs queued jobs on the event loop with at most ``concurrency`` in flight.
+
+    A semaphore counts pending jobs, so idle workers sleep until a job is
+    submitted instead of polling SQLite. On start, jobs interrupted by a
+    previous shutdown are requeued and picked up in their original order.
+    """
+
+    def __init__(
+        self,
+        queue: LocalJobQueue,
+        handler: Callable[[str, Dict[str, Any]], Awaitable[None]],
+        concurrency: int = 1,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.running: Set[str] = set()
+        self._pending: Optional[asyncio.Semaphore] = None
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self, purge_after_seconds: Optional[float] = None, purge_interval_seconds: float = 3600.0):
+        recovered = await run_in_threadpool(self.queue.recover)
+        if recovered:
+            logger.info(f"Requeued {recovered} interrupted job(s)")
+        pending = await run_in_threadpool(self.queue.count, ("pending",))
+        self._pending = asyncio.Semaphore(pending)
+        self._workers = [
+            asyncio.create_task(self._worker(index)) for index in range(self.concurrency)
+        ]
+        if purge_after_seconds:
+            self._workers.append(
+                asyncio.create_task(self._purge_finished(purge_after_seconds, purge_interval_seconds))
+            )
+        logger.info(f"Local executor started: concurrency={self.concurrency}, pending={pending}")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, job_id: str, payload: Dict[str, Any], priority: int = 0):
+        await run_in_threadpool(self.queue.enqueue, job_id, payload, priority)
+        if self._pending is not None:
+            self._pending.release()
+
+    async def _worker(self, index: int):
+        while True:
+            await self._pending.acquire()
+            job = await run_in_threadpool(self.queue.claim_next)
+            if job is None:
+                continue
+            job_id = job["job_id"]
+            self.running.add(job_id)
+            try:
+                await self.handler(job_id, job["payload"])
+            except asyncio.CancelledError:
+                # Shutdown: leave the job in 'processing' so recover() requeues it
+                raise
+            except Exception as e:
+                logger.error(f"Local job {job_id} crashed: {e}")
+                await run_in_threadpool(self.queue.update, job_id, status="failed", error=str(e))
+            finally:
+                self.running.discard(job_id)
+
+    async def _purge_finished(self, older_than_seconds: float, interval: float):
+        """Delete old finished jobs at startup and then every ``interval`` seconds"""
+        while True:
+            try:
+                purged = await run_in_threadpool(self.queue.purge_finished, older_than_seconds)
+                if purged:
+                    logger.info(f"Purged {purged} finished job(s)")
+            except Exception as e:
+                logger.warning(f"Could not purge finished jobs: {e}")
+            await asyncio.sleep(interval)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "running": len(self.running),
+            "pending": self.queue.count(("pending",)),
+        }
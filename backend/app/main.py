@@ -1,7 +1,8 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from pydantic import BaseModel, Field
 from typing import Optional, List
 import os
 import uuid
@@ -9,14 +10,45 @@ import httpx
 import asyncio
 import json
 from pathlib import Path
-import shutil
 import subprocess
 import logging
+from starlette.concurrency import run_in_threadpool
+from .admission import AdmissionController, ClientSlots, client_identity
+from .config import settings
+from .cpu_slots import get_slot_pool
+from .face_gallery import (
+    GalleryNotReady,
+    cached_gallery,
+    create_gallery_service,
+    ensure_gallery,
+    gallery_dir,
+    gallery_payload,
+    reference_options,
+    resolve_reference,
+)
+from .facefusion_cli import FACEFUSION_PATH, build_facefusion_command
+from .idempotency import IDEMPOTENCY_HEADER, MemoryIdempotencyStore, request_fingerprint, run_idempotent
+from .image_preprocess import normalize_source_image
+from .job_logs import JobLogRegistry, job_log_path, read_job_log
+from .local_executor import LocalExecutor, LocalJobQueue
+from .media import probe_video
+from .profiles import ProfileName, ProfileStats, estimate_job, get_profile
+from .ranges import TargetRange, upload_frames
+from .streaming_upload import UPLOAD_OPENAPI_EXTRA, stream_upload_to_disk
+from .utils import sanitize_filename
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="FaceFusion API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 前回停止時に処理中だったジョブは待機中に戻して再実行
+    await executor.start(purge_after_seconds=settings.cleanup_interval_hours * 3600)
+    yield
+    await executor.stop()
+    gallery_service.shutdown()
+
+app = FastAPI(title="FaceFusion API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,7 +60,6 @@ app.add_middleware(
 
 UPLOAD_DIR = Path("/app/uploads")
 OUTPUT_DIR = Path("/app/outputs")
-FACEFUSION_PATH = Path("/workspace/facefusion")  # FaceFusionのインストールパス
 
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
@@ -39,6 +70,7 @@ class JobStatus(BaseModel):
     progress: int
     output_url: Optional[str] = None
     error: Optional[str] = None
+    queue_position: Optional[int] = None
 
 class ConnectionManager:
     def __init__(self):
@@ -55,65 +87,196 @@ class ConnectionManager:
         await websocket.send_text(message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        # 全クライアントへ並行して送信（切断済みの接続はエンドポイント側で外す）
+        await asyncio.gather(
+            *(connection.send_text(message) for connection in list(self.active_connections)),
+            return_exceptions=True
+        )
 
 manager = ConnectionManager()
-jobs = {}
+
+# キュー深さと処理実績に基づく受付制御
+admission = AdmissionController(
+    max_queue_depth=settings.admission_max_queue_depth,
+    max_wait_seconds=settings.admission_max_wait_seconds,
+    max_jobs_per_client=settings.admission_max_jobs_per_client,
+    default_job_seconds=settings.admission_default_job_seconds,
+)
+client_slots = ClientSlots()
+# 単一プロセス構成のためIdempotency-Keyはメモリ上で保持
+idempotency_store = MemoryIdempotencyStore(
+    settings.idempotency_ttl_seconds, settings.idempotency_pending_ttl_seconds
+)
+# FaceFusion出力はジョブごとに直近N行だけ保持（アプリログへの転送は間引く）
+job_logs = JobLogRegistry(settings.job_log_max_lines, settings.job_log_forward_per_second)
+# プロファイルごとの実測フレーム/秒（受付時の完了見込みに使う）
+profile_stats = ProfileStats()
+# 対象動画の顔ギャラリー（人物ごとのクラスタ）はアップロードごとにキャッシュ
+gallery_service = create_gallery_service()
+# Redis/Celeryなしで動く永続キュー（待機ジョブは再起動後も残る）
+job_queue = LocalJobQueue(settings.local_queue_path)
+
+def unfinished_job_count() -> int:
+    return job_queue.count()
+
+def load_job(job_id: str) -> Optional[JobStatus]:
+    row = job_queue.get(job_id)
+    if row is None:
+        return None
+    job = JobStatus(**row)
+    if job.status == "pending":
+        job.queue_position = job_queue.position(job_id)
+    return job
+
+async def update_job(job_id: str, **fields):
+    """ジョブ状態をキューDBに保存し、WebSocketへ通知"""
+    await run_in_threadpool(job_queue.update, job_id, **fields)
+    job = await run_in_threadpool(load_job, job_id)
+    await manager.broadcast(json.dumps(job.dict()))
 
 @app.get("/")
 async def root():
     return {"message": "FaceFusion API is running!"}
 
-@app.post("/api/upload/video")
-async def upload_video(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(('.mp4', '.avi', '.mov', '.webm')):
-        raise HTTPException(status_code=400, detail="Invalid video format")
-    
-    file_id = str(uuid.uuid4())
-    file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+@app.post("/api/upload/video", openapi_extra=UPLOAD_OPENAPI_EXTRA)
+async def upload_video(request: Request):
+    async def store_video():
+        # リクエストボディを一度だけ読み、最終保存先へ直接書き込む
+        upload = await stream_upload_to_disk(
+            request,
+            UPLOAD_DIR,
+            settings.allowed_video_extensions,
+            settings.max_upload_size_bytes,
+        )
+        return {"file_id": upload.file_id, "filename": upload.filename, "sha256": upload.sha256}
     
-    return {"file_id": file_id, "filename": file.filename}
+    # 同じIdempotency-Keyでの再送は元のfile_idを返す
+    return await run_idempotent(
+        idempotency_store,
+        f"{client_identity(request)}:upload:video",
+        request.headers.get(IDEMPOTENCY_HEADER),
+        store_video,
+    )
 
-@app.post("/api/upload/image")
-async def upload_image(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-        raise HTTPException(status_code=400, detail="Invalid image format")
-    
-    file_id = str(uuid.uuid4())
-    file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+@app.post("/api/upload/image", openapi_extra=UPLOAD_OPENAPI_EXTRA)
+async def upload_image(request: Request):
+    async def store_image():
+        # リクエストボディを一度だけ読み、最終保存先へ直接書き込む
+        upload = await stream_upload_to_disk(
+            request,
+            UPLOAD_DIR,
+            settings.allowed_image_extensions,
+            settings.max_upload_size_bytes,
+        )
+        # EXIF回転・アルファ/メタデータ除去・縮小と顔の有無チェック
+        image = await run_in_threadpool(
+            normalize_source_image,
+            upload.path,
+            settings.image_max_dimension,
+            settings.image_require_face,
+        )
+        return {"file_id": upload.file_id, "filename": upload.filename, "sha256": image.sha256, "faces": image.faces}
     
-    return {"file_id": file_id, "filename": file.filename}
+    return await run_idempotent(
+        idempotency_store,
+        f"{client_identity(request)}:upload:image",
+        request.headers.get(IDEMPOTENCY_HEADER),
+        store_image,
+    )
 
 class ProcessRequest(BaseModel):
     video_id: str
     image_id: str
+    priority: int = 0  # 大きいほど先に処理（同じ優先度はFIFO）
+    # 対象動画の一部だけを処理（FaceFusionのtrimオプション。範囲外は出力に含めない）
+    trim: Optional[TargetRange] = None
+    # 処理プロファイル（fast | balanced | quality など。未指定は default_profile）
+    profile: ProfileName = None
+    # 顔ギャラリー（/api/faces/{video_id}）の人物番号。指定するとその人物の顔だけを交換
+    reference_face: Optional[int] = Field(None, ge=0)
 
 @app.post("/api/process")
-async def process_face_swap(request: ProcessRequest):
-    job_id = str(uuid.uuid4())
+async def process_face_swap(request: ProcessRequest, http_request: Request):
+    client_id = client_identity(http_request)
+    if request.trim and request.trim.mode == "splice":
+        # 範囲外を残すにはチャンク処理が必要（Celery版 /api/process が対応）
+        raise HTTPException(status_code=400, detail="trim.mode=splice is not supported by the local executor")
+    profile = get_profile(request.profile)
+    reference = None
+    if request.reference_face is not None:
+        try:
+            gallery = cached_gallery(gallery_service, UPLOAD_DIR, sanitize_filename(request.video_id))
+        except GalleryNotReady as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if gallery is None:
+            raise HTTPException(status_code=404, detail="Video not found")
+        try:
+            reference = resolve_reference(gallery, request.reference_face)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    jobs[job_id] = JobStatus(
-        job_id=job_id,
-        status="pending",
-        progress=0
-    )
-    
-    asyncio.create_task(run_face_swap(job_id, request.video_id, request.image_id))
+    async def create_job():
+        # プローブ（ブロッキング）は再送の判定後に行う
+        try:
+            frames = await run_in_threadpool(upload_frames, UPLOAD_DIR, request.video_id, request.trim)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        job_id = str(uuid.uuid4())
+        # 処理中・待機中のジョブ数がそのままキュー深さ
+        queue_depth = await run_in_threadpool(unfinished_job_count)
+        # クライアントの枠の確認と確保は一度に行う（同時に送られたリクエストが揃って通らないように）
+        admission.admit(client_slots, client_id, job_id, queue_depth, executor.concurrency)
+        try:
+            # 実測のフレーム/秒（プロファイル別）から完了見込みを算出
+            estimate = estimate_job(
+                profile,
+                profile_stats,
+                frames,
+                admission.estimated_wait(queue_depth, executor.concurrency),
+                admission.throughput.avg_job_seconds,
+            )
+            
+            # ディスク上のキューに登録（再起動後も待機ジョブは残る）
+            await executor.submit(
+                job_id,
+                {
+                    "video_id": request.video_id,
+                    "image_id": request.image_id,
+                    "trim": request.trim.dict() if request.trim else None,
+                    "profile": profile.name,
+                    "frames": frames,
+                    "reference": reference,
+                },
+                priority=request.priority,
+            )
+        except Exception:
+            client_slots.release(job_id)
+            raise
+        
+        return {"job_id": job_id, "estimate": estimate}
     
-    return {"job_id": job_id}
+    # 再送されたリクエストは新しいジョブを作らず元のjob_idを返す
+    return await run_idempotent(
+        idempotency_store,
+        f"{client_id}:process",
+        http_request.headers.get(IDEMPOTENCY_HEADER),
+        create_job,
+        fingerprint=request_fingerprint(request.dict()),
+    )
 
-async def run_face_swap(job_id: str, video_id: str, image_id: str):
+async def run_face_swap(job_id: str, payload: dict):
+    """ローカル実行キューのハンドラ（同時実行数は executor が制限）"""
+    video_id = payload["video_id"]
+    image_id = payload["image_id"]
+    started_at = asyncio.get_running_loop().time()
+    process = None
+    lease = None
+    progress = 10
+    job_log = job_logs.create(job_id, path=job_log_path(OUTPUT_DIR, job_id))
     try:
-        jobs[job_id].status = "processing"
-        jobs[job_id].progress = 10
-        await manager.broadcast(json.dumps(jobs[job_id].dict()))
+        await update_job(job_id, status="processing", progress=progress)
         
         # ファイルパスを取得
         video_files = list(UPLOAD_DIR.glob(f"{video_id}_*"))
@@ -129,49 +292,63 @@ async def run_face_swap(job_id: str, video_id: str, image_id: str):
         
         logger.info(f"処理開始: source={source_image}, target={target_video}, output={output_path}")
         
-        # FaceFusionコマンドを構築
-        cmd = [
-            "python3",
-            str(FACEFUSION_PATH / "facefusion.py"),
-            "headless-run",
-            "--source", source_image,
-            "--target", target_video,
-            "--output-path", output_path,
-            "--execution-providers", "cuda",
-            "--execution-thread-count", "2",  # 4GB VRAMに配慮
-            "--face-detector-model", "yolo_face",
-            "--face-detector-score", "0.5",
-            "--processors", "face_swapper",
-            "--log-level", "debug"
-        ]
+        # CPUモードではジョブごとにCPUスロットを確保し、FaceFusionをそのCPUに固定
+        slot = None
+        if slot_pool is not None:
+            lease = await run_in_threadpool(slot_pool.acquire)
+            slot = lease.slot
+        
+        # 範囲指定はフレームに変換してFaceFusionのtrimオプションへ（秒指定はプローブが必要）
+        trim_frames = {}
+        if payload.get("trim"):
+            trim = TargetRange(**payload["trim"])
+            if trim.in_frames:
+                trim_frames = {"trim_frame_start": trim.start_frame, "trim_frame_end": trim.end_frame}
+            else:
+                info = await run_in_threadpool(probe_video, Path(target_video))
+                start, end = trim.to_frames(info.fps, info.frame_count)
+                trim_frames = {"trim_frame_start": start, "trim_frame_end": end}
+        
+        # FaceFusionコマンドを構築（プロファイルの検出・強調・エンコード設定。debugログは大量になるためinfo）
+        profile = get_profile(payload.get("profile"))
+        cmd = build_facefusion_command(
+            source_image, target_video, output_path,
+            **trim_frames,
+            **profile.facefusion_options(),
+            **reference_options(payload.get("reference")),
+            **(slot.facefusion_options() if slot is not None else {})
+        )
+        render_started_at = asyncio.get_running_loop().time()
         
         # プロセスを非同期で実行
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
-            cwd=str(FACEFUSION_PATH)
+            cwd=str(FACEFUSION_PATH),
+            preexec_fn=slot.pin if slot is not None else None,
+            env=slot.env() if slot is not None else None
         )
         
         # 進捗を監視
-        jobs[job_id].progress = 20
-        await manager.broadcast(json.dumps(jobs[job_id].dict()))
+        progress = 20
+        await update_job(job_id, progress=progress)
         
         # 出力を非同期で読み取り
         async def read_output():
+            nonlocal progress
             while True:
                 line = await process.stdout.readline()
                 if not line:
                     break
-                line_text = line.decode().strip()
-                logger.info(f"FaceFusion stdout: {line_text}")
+                line_text = line.decode(errors="replace").strip()
+                await job_log.append_async(line_text, "stdout")
                 
                 # 進捗を更新（簡易的な実装）
                 if "Processing" in line_text or "processing" in line_text.lower():
-                    current_progress = jobs[job_id].progress
-                    if current_progress < 90:
-                        jobs[job_id].progress = min(current_progress + 10, 90)
-                        await manager.broadcast(json.dumps(jobs[job_id].dict()))
+                    if progress < 90:
+                        progress = min(progress + 10, 90)
+                        await update_job(job_id, progress=progress)
         
         # エラー出力も読み取り
         async def read_error():
@@ -179,8 +356,7 @@ async def run_face_swap(job_id: str, video_id: str, image_id: str):
                 line = await process.stderr.readline()
                 if not line:
                     break
-                line_text = line.decode().strip()
-                logger.info(f"FaceFusion stderr: {line_text}")
+                await job_log.append_async(line.decode(errors="replace"), "stderr")
         
         # 出力読み取りタスクを開始
         output_task = asyncio.create_task(read_output())
@@ -193,29 +369,96 @@ async def run_face_swap(job_id: str, video_id: str, image_id: str):
         
         if return_code == 0 and os.path.exists(output_path):
             # 成功
-            jobs[job_id].status = "completed"
-            jobs[job_id].progress = 100
-            jobs[job_id].output_url = f"/api/download/{output_filename}"
+            await update_job(
+                job_id,
+                status="completed",
+                progress=100,
+                output_url=f"/api/download/{output_filename}"
+            )
+            now = asyncio.get_running_loop().time()
+            admission.throughput.record(now - started_at)
+            if payload.get("frames"):
+                profile_stats.record(profile.name, payload["frames"], now - render_started_at)
             logger.info(f"処理完了: {output_path}")
         else:
-            # エラー
-            stderr = await process.stderr.read()
-            error_msg = stderr.decode() if stderr else "Unknown error"
+            # エラー（出力全体ではなく末尾の数行のみ）
+            error_msg = job_log.tail() or "Unknown error"
             raise Exception(f"FaceFusion処理エラー: {error_msg}")
         
-        await manager.broadcast(json.dumps(jobs[job_id].dict()))
-        
+    except asyncio.CancelledError:
+        # シャットダウン時はFaceFusionを停止し、ジョブは次回起動時に再実行
+        if process is not None and process.returncode is None:
+            process.kill()
+        raise
     except Exception as e:
         logger.error(f"顔交換処理エラー: {e}")
-        jobs[job_id].status = "failed"
-        jobs[job_id].error = str(e)
-        await manager.broadcast(json.dumps(jobs[job_id].dict()))
+        await update_job(job_id, status="failed", error=str(e))
+    finally:
+        if lease is not None:
+            logger.info(f"CPUスロット {lease.slot.index} 使用率: {lease.utilization():.0%}")
+            lease.release()
+        await run_in_threadpool(job_log.flush)
+        client_slots.release(job_id)
+
+# CPUモードではホストをCPUスロットに分割し、スロット数だけ同時実行
+slot_pool = get_slot_pool()
+# GPUを奪い合わないよう同時実行数を制限したローカル実行器
+executor = LocalExecutor(
+    job_queue,
+    run_face_swap,
+    concurrency=len(slot_pool.slots) if slot_pool is not None else settings.local_max_concurrent_jobs
+)
+
+@app.get("/api/executor")
+async def executor_status():
+    """実行キューの状態とCPUスロットごとの使用率"""
+    status = await run_in_threadpool(executor.snapshot)
+    if slot_pool is not None:
+        status["cpu_slots"] = await run_in_threadpool(slot_pool.snapshot)
+    return status
+
+@app.get("/api/profiles")
+async def list_profiles():
+    """処理プロファイルと実測のフレーム/秒"""
+    return profile_stats.snapshot()
+
+@app.get("/api/faces/{video_id}")
+async def get_face_gallery(video_id: str):
+    """対象動画に映る人物の一覧（サムネイル付き）。初回はサンプリングしてクラスタリング"""
+    video_id = sanitize_filename(video_id)
+    try:
+        gallery = await ensure_gallery(gallery_service, UPLOAD_DIR, video_id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if gallery is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return gallery_payload(gallery, video_id)
+
+@app.get("/api/faces/{video_id}/{name}")
+async def get_face_thumbnail(video_id: str, name: str):
+    """顔ギャラリーのサムネイルを配信"""
+    path = gallery_dir(UPLOAD_DIR, sanitize_filename(video_id)) / sanitize_filename(name)
+    if path.suffix != ".jpg" or not path.is_file():
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return FileResponse(path, media_type="image/jpeg")
 
 @app.get("/api/job/{job_id}")
 async def get_job_status(job_id: str):
-    if job_id not in jobs:
+    job = await run_in_threadpool(load_job, job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return jobs[job_id]
+    return job
+
+@app.get("/api/job/{job_id}/logs")
+async def get_job_logs(job_id: str, limit: int = Query(200, ge=0, le=settings.job_log_max_lines)):
+    """FaceFusion出力の直近N行（実行中はメモリ上、終了後はディスクから）"""
+    job_log = job_logs.get(job_id)
+    if job_log is not None:
+        return job_log.snapshot(limit)
+    log = await run_in_threadpool(read_job_log, job_log_path(OUTPUT_DIR, Path(job_id).name), limit)
+    if log is None:
+        raise HTTPException(status_code=404, detail="Log not found")
+    return log
 
 @app.get("/api/download/{filename}")
 async def download_file(filename: str):
@@ -1,22 +1,92 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Request, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Optional, List, Literal
 import os
 import uuid
+import hmac
+import asyncio
 import json
 from pathlib import Path
-import shutil
 import logging
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+import redis
 from celery.result import AsyncResult
+from .admission import AdmissionController, RedisClientSlots, client_identity, redis_queue_depth
+from .autoscaler import DESIRED_REPLICAS_KEY, SCALED_TASKS, face_swap_tasks, face_swap_workers
 from .celery_app import celery_app
-from .tasks import process_face_swap
+from .celery_monitor import ClusterStateMonitor
+from .hls import PLAYLIST_NAME
+from .job_logs import job_log_path, read_job_log
+from .job_status_cache import CoalescingStatusCache, conditional_status_response
+from .face_gallery import (
+    GalleryNotReady,
+    cached_gallery,
+    create_gallery_service,
+    ensure_gallery,
+    gallery_dir,
+    gallery_payload,
+    resolve_reference,
+)
+from .previews import PREVIEW_ASSETS, PreviewService, find_media, preview_dir
+from .profiles import ProfileName, estimate_job, get_profile
+from .ranges import TargetRange, restrict_chunks, swap_frames, upload_frames
+from .config import settings
+from .idempotency import IDEMPOTENCY_HEADER, RedisIdempotencyStore, request_fingerprint, run_idempotent
+from .image_preprocess import normalize_source_image
+from .input_cache import InputRef
+from .storage import OUTPUTS, UPLOADS, get_storage
+from .streaming_upload import UPLOAD_OPENAPI_EXTRA, stream_upload_to_disk
+from .utils import sanitize_filename
+from .tasks import build_template, input_index, profile_stats, start_face_swap, template_library
+from .templates import plan_template_chunks
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="FaceFusion API with Celery", version="2.0.0")
+# キュー深さと実測スループットに基づく受付制御
+admission = AdmissionController(
+    max_queue_depth=settings.admission_max_queue_depth,
+    max_wait_seconds=settings.admission_max_wait_seconds,
+    max_jobs_per_client=settings.admission_max_jobs_per_client,
+    default_job_seconds=settings.admission_default_job_seconds,
+)
+broker_redis = redis.Redis.from_url(celery_app.conf.broker_url)
+# クライアントごとの未完了タスクはRedisで共有（APIレプリカ間で有効）
+client_slots = RedisClientSlots(
+    broker_redis,
+    is_finished=lambda task_id: AsyncResult(task_id, app=celery_app).ready(),
+)
+# Idempotency-KeyもRedisに保存し、uvicornワーカー・APIレプリカ間で共有
+idempotency_store = RedisIdempotencyStore(
+    broker_redis, settings.idempotency_ttl_seconds, settings.idempotency_pending_ttl_seconds
+)
+
+# Celeryイベントからクラスタ状態を保持するモニター
+cluster_monitor = ClusterStateMonitor(
+    celery_app,
+    on_task_succeeded=lambda hostname, runtime: admission.throughput.record(runtime),
+    # 受付制御の処理時間はGPUキュー（face_swap）のタスクのみで推定
+    throughput_tasks=SCALED_TASKS,
+)
+# サムネイル・スプライト生成用のバックグラウンドプール
+preview_service = PreviewService(
+    max_workers=settings.preview_workers, failure_ttl_seconds=settings.preview_failure_ttl_seconds
+)
+# 対象動画の顔ギャラリー（人物ごとのクラスタ）はアップロードごとにキャッシュ
+gallery_service = create_gallery_service()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    cluster_monitor.start()
+    yield
+    cluster_monitor.stop()
+    preview_service.shutdown()
+    gallery_service.shutdown()
+
+app = FastAPI(title="FaceFusion API with Celery", version="2.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +94,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 UPLOAD_DIR = Path("/app/uploads")
@@ -39,10 +110,31 @@ class JobStatus(BaseModel):
     output_url: Optional[str] = None
     error: Optional[str] = None
     message: Optional[str] = None
+    playlist_url: Optional[str] = None
+    stage: Optional[str] = None  # prepare | swap | encode
+    timings: Optional[dict] = None  # ステージ別の処理時間（秒）
+    frames: Optional[int] = None  # FaceFusionで処理するフレーム数（指定範囲のみ）
+    decimation: Optional[dict] = None  # 重複フレームの間引き結果（総数・ユニーク・重複フレーム数）
 
 class ProcessRequest(BaseModel):
-    video_id: str
+    # video_id（アップロード動画）か template_id（登録済みテンプレート）のどちらか
+    video_id: Optional[str] = None
+    template_id: Optional[str] = None
     image_id: str
+    # "hls" はレンダリング中からセグメントを順次配信する
+    output_mode: Literal["mp4", "hls"] = "mp4"
+    # 対象動画の一部だけを処理（秒またはフレーム、終了は含まない）
+    trim: Optional[TargetRange] = None
+    # 処理プロファイル（fast | balanced | quality など。未指定は default_profile）
+    profile: ProfileName = None
+    # 重複フレームを間引いてユニークなフレームだけ処理（未指定は decimate_default）
+    decimate: Optional[bool] = None
+    # 顔ギャラリー（/api/faces/{video_id}）の人物番号。指定するとその人物の顔だけを交換
+    reference_face: Optional[int] = Field(None, ge=0)
+
+class TemplateRequest(BaseModel):
+    video_id: str
+    name: Optional[str] = None
 
 class ConnectionManager:
     def __init__(self):
@@ -59,12 +151,12 @@ class ConnectionManager:
         await websocket.send_text(message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                # 接続が切れている場合は無視
-                pass
+        # 全クライアントへ並行して送信（遅いクライアントが他の送信を待たせない）
+        # 接続が切れている場合は無視
+        await asyncio.gather(
+            *(connection.send_text(message) for connection in list(self.active_connections)),
+            return_exceptions=True
+        )
 
 manager = ConnectionManager()
 
@@ -77,123 +169,402 @@ async def health_check():
     """ヘルスチェックエンドポイント"""
     return {"status": "healthy", "celery": "connected"}
 
-@app.post("/api/upload/video")
-async def upload_video(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(('.mp4', '.avi', '.mov', '.webm')):
-        raise HTTPException(status_code=400, detail="Invalid video format")
-    
-    file_id = str(uuid.uuid4())
-    file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    return {"file_id": file_id, "filename": file.filename}
+async def index_upload(file_id: str, path: Path, digest: str, size: int):
+    """ワーカーがダイジェストで入力を解決できるよう索引に登録"""
+    ref = InputRef(digest=digest, name=path.name, path=str(path), size=size, file_id=file_id)
+    await run_in_threadpool(input_index.record, ref)
 
-@app.post("/api/upload/image")
-async def upload_image(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-        raise HTTPException(status_code=400, detail="Invalid image format")
+@app.post("/api/upload/video", openapi_extra=UPLOAD_OPENAPI_EXTRA)
+async def upload_video(request: Request):
+    async def store_video():
+        # リクエストボディを一度だけ読み、最終保存先へ直接書き込む
+        upload = await stream_upload_to_disk(
+            request,
+            UPLOAD_DIR,
+            settings.allowed_video_extensions,
+            settings.max_upload_size_bytes,
+        )
+        # オブジェクトストレージ利用時は別ノードのワーカーが取得できるようアップロード
+        await run_in_threadpool(get_storage().put, UPLOADS, upload.path.name, upload.path)
+        await index_upload(upload.file_id, upload.path, upload.sha256, upload.size)
+        preview_service.schedule(upload.path, preview_dir(UPLOAD_DIR, upload.file_id))
+        return {"file_id": upload.file_id, "filename": upload.filename, "sha256": upload.sha256}
     
-    file_id = str(uuid.uuid4())
-    file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
+    # 同じIdempotency-Keyでの再送は元のfile_idを返す（ボディは読まない）
+    return await run_idempotent(
+        idempotency_store,
+        f"{client_identity(request)}:upload:video",
+        request.headers.get(IDEMPOTENCY_HEADER),
+        store_video,
+    )
+
+@app.post("/api/upload/image", openapi_extra=UPLOAD_OPENAPI_EXTRA)
+async def upload_image(request: Request):
+    async def store_image():
+        # リクエストボディを一度だけ読み、最終保存先へ直接書き込む
+        upload = await stream_upload_to_disk(
+            request,
+            UPLOAD_DIR,
+            settings.allowed_image_extensions,
+            settings.max_upload_size_bytes,
+        )
+        # EXIF回転・アルファ/メタデータ除去・縮小と顔の有無チェック
+        image = await run_in_threadpool(
+            normalize_source_image,
+            upload.path,
+            settings.image_max_dimension,
+            settings.image_require_face,
+        )
+        await run_in_threadpool(get_storage().put, UPLOADS, upload.path.name, upload.path)
+        await index_upload(upload.file_id, upload.path, image.sha256, image.size)
+        preview_service.schedule(upload.path, preview_dir(UPLOAD_DIR, upload.file_id))
+        return {"file_id": upload.file_id, "filename": upload.filename, "sha256": image.sha256, "faces": image.faces}
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    return await run_idempotent(
+        idempotency_store,
+        f"{client_identity(request)}:upload:image",
+        request.headers.get(IDEMPOTENCY_HEADER),
+        store_image,
+    )
+
+def queue_load() -> tuple:
+    """待機中の顔交換タスク数（ブローカー上＋ワーカー予約済み）と face_swap ワーカー数"""
+    # media キューのワーカーとタスク（prepare_job/finalize_job）は容量にも待ち行列にも数えない
+    snapshot = cluster_monitor.snapshot()
+    reserved = face_swap_tasks(snapshot, kinds=("reserved_tasks",))
+    workers = len(face_swap_workers(snapshot))
+    return redis_queue_depth(broker_redis, "face_swap") + reserved, max(1, workers)
+
+def check_admission(client_id: str, task_id: str) -> float:
+    """
+    受付可否を判定してクライアントの枠を task_id で確保し、開始までの見込み待ち時間（秒）を返す
     
-    return {"file_id": file_id, "filename": file.filename}
+    枠の確認と確保はRedis上で一度に行うため、同時に送られたリクエストが揃って上限を超えることはない。
+    """
+    queue_depth, workers = queue_load()
+    admission.admit(client_slots, client_id, task_id, queue_depth, workers)
+    return admission.estimated_wait(queue_depth, workers)
 
 @app.post("/api/process")
-async def start_face_swap_process(request: ProcessRequest):
+async def start_face_swap_process(request: ProcessRequest, http_request: Request):
     """顔交換処理をCeleryタスクで開始"""
-    job_id = str(uuid.uuid4())
+    client_id = client_identity(http_request)
+    if bool(request.video_id) == bool(request.template_id):
+        raise HTTPException(status_code=400, detail="video_id と template_id のどちらか一方を指定してください")
+    if request.template_id:
+        template = await run_in_threadpool(template_library.get, request.template_id, False)
+        if template is None:
+            raise HTTPException(status_code=404, detail="Template not found")
+        if template.status != "ready":
+            raise HTTPException(status_code=409, detail=f"Template is {template.status}")
+        # テンプレートはプローブ済みなので、範囲の検証と処理フレーム数の見積もりを受付時に行う
+        chunks = plan_template_chunks(template, settings.checkpoint_chunk_seconds)
+        if request.trim:
+            try:
+                frame_range = request.trim.to_frames(template.info.fps, template.info.frame_count)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            chunks = restrict_chunks(chunks, frame_range, request.trim.mode)
+        frames = swap_frames(chunks)
+    else:
+        # アップロード動画は再送の判定後にプローブする（ブロッキングのffprobeを再送で繰り返さない）
+        frames = None
+    profile = get_profile(request.profile)
+    # 間引きはフレームを詰めた動画を処理するため、元のフレーム番号に依存する処理とは併用しない
+    decimate_supported = request.output_mode == "mp4" and not request.template_id and not request.trim
+    if request.decimate and not decimate_supported:
+        raise HTTPException(
+            status_code=400, detail="decimate は output_mode=mp4・範囲指定なしのアップロード動画のみ指定できます"
+        )
+    decimate = decimate_supported and (
+        request.decimate if request.decimate is not None else settings.decimate_default
+    )
+    reference = None
+    if request.reference_face is not None:
+        if not request.video_id:
+            raise HTTPException(status_code=400, detail="reference_face はアップロード動画（video_id）のみ指定できます")
+        try:
+            gallery = cached_gallery(gallery_service, UPLOAD_DIR, sanitize_filename(request.video_id))
+        except GalleryNotReady as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if gallery is None:
+            raise HTTPException(status_code=404, detail="Video not found")
+        try:
+            reference = resolve_reference(gallery, request.reference_face)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    # Celeryタスクを開始
-    task = process_face_swap.delay(job_id, request.video_id, request.image_id)
+    async def enqueue():
+        job_frames = frames
+        if request.video_id:
+            try:
+                job_frames = await run_in_threadpool(upload_frames, UPLOAD_DIR, request.video_id, request.trim)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        job_id = str(uuid.uuid4())
+        task_id = str(uuid.uuid4())
+        # 受付可否を判定して枠を確保（Redisへの同期アクセスのためスレッドプールで実行）
+        wait_seconds = await run_in_threadpool(check_admission, client_id, task_id)
+        try:
+            # 実測のフレーム/秒（プロファイル別）から完了見込みを算出
+            estimate = await run_in_threadpool(
+                estimate_job, profile, profile_stats, job_frames, wait_seconds, admission.throughput.avg_job_seconds
+            )
+            
+            # Celeryタスクを開始（準備・顔交換・エンコードのステージに分割）
+            start_face_swap(
+                job_id, request.video_id, request.image_id, request.output_mode, request.template_id,
+                request.trim.dict() if request.trim else None, profile.name, decimate, reference, task_id=task_id,
+            )
+        except Exception:
+            await run_in_threadpool(client_slots.release, task_id)
+            raise
+        
+        logger.info(f"Celeryタスク開始: job_id={job_id}, task_id={task_id}")
+        
+        return {
+            "job_id": job_id,
+            "task_id": task_id,
+            "status": "queued",
+            "frames": job_frames,
+            "estimate": estimate,
+            "message": "処理がキューに追加されました"
+        }
+    
+    # 再送されたリクエストは新しいタスクを作らず元のjob_id/task_idを返す
+    return await run_idempotent(
+        idempotency_store,
+        f"{client_id}:process",
+        http_request.headers.get(IDEMPOTENCY_HEADER),
+        enqueue,
+        fingerprint=request_fingerprint(request.dict()),
+    )
+
+@app.post("/api/templates")
+async def create_template(request: TemplateRequest):
+    """アップロード済み動画をテンプレートに昇格（プローブ・顔トラックはワーカーで事前計算）"""
+    video_files = list(UPLOAD_DIR.glob(f"{request.video_id}_*"))
+    if not video_files:
+        raise HTTPException(status_code=404, detail="Video file not found")
+    template = await run_in_threadpool(
+        template_library.create, request.name or video_files[0].name.split("_", 1)[-1], video_files[0]
+    )
+    build_template.delay(template.template_id)
+    return template.dict()
+
+@app.get("/api/profiles")
+async def list_profiles():
+    """処理プロファイルと実測のフレーム/秒"""
+    return await run_in_threadpool(profile_stats.snapshot)
+
+@app.get("/api/templates")
+async def list_templates():
+    templates = await run_in_threadpool(template_library.list)
+    return [template.dict(exclude={"face_ranges"}) for template in templates]
+
+@app.get("/api/templates/{template_id}")
+async def get_template(template_id: str):
+    template = await run_in_threadpool(template_library.get, template_id, False)
+    if template is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+    return template.dict()
+
+def load_job_status(task_id: str) -> dict:
+    """Celeryタスクの状態を取得（Redisへの同期アクセス）"""
+    result = AsyncResult(task_id, app=celery_app)
     
-    logger.info(f"Celeryタスク開始: job_id={job_id}, task_id={task.id}")
+    if result.state == "PENDING":
+        response = JobStatus(
+            job_id=task_id,
+            status="pending",
+            progress=0,
+            message="処理待機中..."
+        )
+    elif result.state == "PROGRESS":
+        response = JobStatus(
+            job_id=task_id,
+            status="processing",
+            progress=result.info.get("current", 0),
+            message=result.info.get("status", "処理中..."),
+            playlist_url=result.info.get("playlist_url"),
+            stage=result.info.get("stage"),
+            frames=result.info.get("frames")
+        )
+    elif result.state == "SUCCESS":
+        task_result = result.result
+        response = JobStatus(
+            job_id=task_id,
+            status="completed",
+            progress=100,
+            output_url=task_result.get("output_url"),
+            message=task_result.get("message", "処理完了"),
+            playlist_url=task_result.get("playlist_url"),
+            timings=task_result.get("timings"),
+            frames=task_result.get("frames"),
+            decimation=task_result.get("decimation")
+        )
+    elif result.state == "FAILURE":
+        response = JobStatus(
+            job_id=task_id,
+            status="failed",
+            progress=0,
+            error=str(result.info.get("error", "Unknown error")),
+            message="処理中にエラーが発生しました"
+        )
+    else:
+        response = JobStatus(
+            job_id=task_id,
+            status=result.state.lower(),
+            progress=0,
+            message=f"状態: {result.state}"
+        )
     
-    return {
-        "job_id": job_id,
-        "task_id": task.id,
-        "status": "queued",
-        "message": "処理がキューに追加されました"
-    }
+    return response.dict()
+
+async def broadcast_status_change(task_id: str, payload: dict):
+    # 状態が変化した時だけWebSocket経由でブロードキャスト
+    await manager.broadcast(json.dumps(payload))
+
+# 同一ジョブへの同時問い合わせを1回のRedis読み込みにまとめる
+status_cache = CoalescingStatusCache(
+    loader=lambda task_id: run_in_threadpool(load_job_status, task_id),
+    ttl=1.0,
+    on_change=broadcast_status_change,
+)
 
 @app.get("/api/job/{task_id}")
-async def get_job_status(task_id: str):
-    """Celeryタスクの状態を取得"""
+async def get_job_status(
+    task_id: str,
+    wait: float = Query(0, ge=0, le=60, description="ステータスが変わるまで待機する秒数（ロングポーリング）"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Celeryタスクの状態を取得（ETag / If-None-Match / ?wait= 対応）"""
     try:
-        result = AsyncResult(task_id, app=celery_app)
-        
-        if result.state == "PENDING":
-            response = JobStatus(
-                job_id=task_id,
-                status="pending",
-                progress=0,
-                message="処理待機中..."
-            )
-        elif result.state == "PROGRESS":
-            response = JobStatus(
-                job_id=task_id,
-                status="processing",
-                progress=result.info.get("current", 0),
-                message=result.info.get("status", "処理中...")
-            )
-        elif result.state == "SUCCESS":
-            task_result = result.result
-            response = JobStatus(
-                job_id=task_id,
-                status="completed",
-                progress=100,
-                output_url=task_result.get("output_url"),
-                message=task_result.get("message", "処理完了")
-            )
-        elif result.state == "FAILURE":
-            response = JobStatus(
-                job_id=task_id,
-                status="failed",
-                progress=0,
-                error=str(result.info.get("error", "Unknown error")),
-                message="処理中にエラーが発生しました"
-            )
-        else:
-            response = JobStatus(
-                job_id=task_id,
-                status=result.state.lower(),
-                progress=0,
-                message=f"状態: {result.state}"
-            )
-        
-        # WebSocket経由でブロードキャスト
-        await manager.broadcast(json.dumps(response.dict()))
-        
-        return response
-        
+        return await conditional_status_response(status_cache, task_id, if_none_match, wait)
     except Exception as e:
         logger.error(f"タスク状態取得エラー: {e}")
         raise HTTPException(status_code=500, detail="タスク状態の取得に失敗しました")
 
+@app.get("/api/job/{task_id}/logs")
+async def get_job_logs(
+    task_id: str,
+    limit: int = Query(200, ge=0, le=settings.job_log_max_lines, description="返す行数（末尾から）"),
+):
+    """FaceFusion出力の直近N行（ワーカーが共有ボリュームに書き出したもの）"""
+    log = await run_in_threadpool(read_job_log, job_log_path(OUTPUT_DIR, sanitize_filename(task_id)), limit)
+    if log is None:
+        raise HTTPException(status_code=404, detail="ログが見つかりません")
+    return log
+
 @app.get("/api/download/{filename}")
 async def download_file(filename: str):
-    file_path = OUTPUT_DIR / filename
-    if not file_path.exists():
+    # オブジェクトストレージ利用時は署名付きURLへリダイレクトし、APIを経由させない
+    try:
+        return await run_in_threadpool(get_storage().download_response, OUTPUTS, sanitize_filename(filename), "video/mp4")
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path)
+
+@app.get("/api/inputs/{digest}")
+async def get_input(digest: str, x_input_token: Optional[str] = Header(None)):
+    """別ノードのワーカーの入力キャッシュ向けに、ダイジェストで入力ファイルを配信"""
+    if not settings.input_fetch_token or not hmac.compare_digest(x_input_token or "", settings.input_fetch_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    ref = await run_in_threadpool(input_index.by_digest, digest)
+    if ref is None:
+        raise HTTPException(status_code=404, detail="Input not found")
+    if ref.path and Path(ref.path).is_file():
+        return FileResponse(ref.path, media_type="application/octet-stream")
+    if ref.area == UPLOADS:
+        try:
+            return await run_in_threadpool(get_storage().download_response, UPLOADS, ref.name)
+        except FileNotFoundError:
+            pass
+    raise HTTPException(status_code=404, detail="Input not found")
+
+@app.get("/api/hls/{job_id}/{name}")
+async def get_hls_file(job_id: str, name: str):
+    """レンダリング中のHLSプレイリスト/セグメントを配信"""
+    hls_dir = OUTPUT_DIR / sanitize_filename(job_id) / "hls"
+    file_path = hls_dir / sanitize_filename(name)
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    if name == PLAYLIST_NAME:
+        # プレイリストはレンダリング中に更新されるためキャッシュさせない
+        return FileResponse(
+            file_path,
+            media_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "no-cache"}
+        )
+    return FileResponse(
+        file_path,
+        media_type="video/mp2t",
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
+@app.get("/api/preview/{kind}/{media_id}/{asset}")
+async def get_preview(kind: Literal["upload", "output"], media_id: str, asset: str):
+    """アップロード/出力動画のポスター・スプライト・アニメーションプレビューを配信"""
+    if asset not in PREVIEW_ASSETS:
+        raise HTTPException(status_code=404, detail="Unknown preview asset")
+    
+    found = find_media(kind, sanitize_filename(media_id), UPLOAD_DIR, OUTPUT_DIR)
+    if not found:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # 出力動画のプレビューは初回アクセス時に生成してキャッシュ
+    asset_path = await preview_service.ensure(*found, asset)
+    if asset_path is None:
+        raise HTTPException(status_code=404, detail="Preview not available")
+    
+    return FileResponse(
+        asset_path,
+        media_type=PREVIEW_ASSETS[asset],
+        headers={"Cache-Control": f"public, max-age={settings.preview_cache_max_age}, immutable"}
+    )
+
+@app.get("/api/faces/{video_id}")
+async def get_face_gallery(video_id: str):
+    """対象動画に映る人物の一覧（サムネイル付き）。初回はサンプリングしてクラスタリング"""
+    video_id = sanitize_filename(video_id)
+    try:
+        gallery = await ensure_gallery(gallery_service, UPLOAD_DIR, video_id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if gallery is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return gallery_payload(gallery, video_id)
+
+@app.get("/api/faces/{video_id}/{name}")
+async def get_face_thumbnail(video_id: str, name: str):
+    """顔ギャラリーのサムネイルを配信"""
+    path = gallery_dir(UPLOAD_DIR, sanitize_filename(video_id)) / sanitize_filename(name)
+    if path.suffix != ".jpg" or not path.is_file():
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return FileResponse(
+        path,
+        media_type="image/jpeg",
+        headers={"Cache-Control": f"public, max-age={settings.preview_cache_max_age}, immutable"}
+    )
 
 @app.get("/api/celery/status")
 async def celery_status():
-    """Celery worker の状態確認"""
+    """Celery worker の状態確認（イベントから構築したスナップショットを即時返却）"""
     try:
-        inspect = celery_app.control.inspect()
-        stats = inspect.stats()
-        active = inspect.active()
-        
-        return {
-            "workers": stats,
-            "active_tasks": active,
-            "status": "connected" if stats else "disconnected"
+        snapshot = cluster_monitor.snapshot()
+        queue_depth, workers = await run_in_threadpool(queue_load)
+        snapshot["admission"] = admission.snapshot(queue_depth, workers)
+        snapshot["idempotency"] = {
+            "duplicates_avoided": await run_in_threadpool(idempotency_store.duplicates_avoided)
         }
+        # app.autoscaler が公開した望ましいレプリカ数（未起動なら None）
+        desired = await run_in_threadpool(broker_redis.get, DESIRED_REPLICAS_KEY)
+        snapshot["autoscaler"] = json.loads(desired) if desired else None
+        # ワーカーごとの入力キャッシュのヒット率
+        snapshot["input_cache"] = await run_in_threadpool(input_index.stats)
+        return snapshot
     except Exception as e:
         logger.error(f"Celery状態確認エラー: {e}")
         return {"status": "error", "message": str(e)}
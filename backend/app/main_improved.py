@@ -1,21 +1,57 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect, Depends
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Request, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from typing import Optional, List, Dict
+from pydantic import BaseModel, Field
+from typing import Optional, List, Dict, Literal
 import os
 import uuid
 import httpx
 import asyncio
 import json
+import time
 import logging
 from pathlib import Path
 import shutil
 from datetime import datetime, timedelta
 import aiofiles
+import redis
 from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
 
+from .admission import AdmissionController, ClientSlots, client_identity
 from .config import settings
+from .facefusion_client import (
+    BackendUnavailableError,
+    FaceFusionClient,
+    close_shared_http_client,
+    get_backend_pool,
+    get_shared_http_client,
+)
+from .idempotency import (
+    IDEMPOTENCY_HEADER,
+    MemoryIdempotencyStore,
+    RedisIdempotencyStore,
+    request_fingerprint,
+    run_idempotent,
+)
+from .image_preprocess import normalize_source_image
+from .job_status_cache import CoalescingStatusCache, conditional_status_response
+from .media import probe_video
+from .face_gallery import (
+    GalleryNotReady,
+    cached_gallery,
+    create_gallery_service,
+    ensure_gallery,
+    gallery_dir,
+    gallery_payload,
+    resolve_reference,
+)
+from .previews import PREVIEW_ASSETS, PreviewService, find_media, preview_dir
+from .profiles import ProfileName, ProfileStats, estimate_job, get_profile
+from .resilience import CircuitOpenError
+from .storage import OUTPUTS, UPLOADS, get_storage
+from .streaming_upload import StreamedUpload, UPLOAD_OPENAPI_EXTRA, stream_upload_to_disk
+from .utils import sanitize_filename
 
 # Configure logging
 logging.basicConfig(level=settings.log_level)
@@ -28,6 +64,8 @@ class JobStore:
         self.ttl = timedelta(hours=ttl_hours)
     
     def add_job(self, job_id: str, job: 'JobStatus'):
+        # Re-insert so the dict stays ordered by creation time
+        self.jobs.pop(job_id, None)
         self.jobs[job_id] = (job, datetime.now())
         self._cleanup_old_jobs()
     
@@ -45,11 +83,13 @@ class JobStore:
             self.jobs[job_id] = (job, self.jobs[job_id][1])
     
     def _cleanup_old_jobs(self):
+        # Jobs are in creation order, so only the expired head needs scanning
         current_time = datetime.now()
-        expired_jobs = [
-            job_id for job_id, (_, timestamp) in self.jobs.items()
-            if current_time - timestamp >= self.ttl
-        ]
+        expired_jobs = []
+        for job_id, (_, timestamp) in self.jobs.items():
+            if current_time - timestamp < self.ttl:
+                break
+            expired_jobs.append(job_id)
         for job_id in expired_jobs:
             del self.jobs[job_id]
 
@@ -61,14 +101,17 @@ async def lifespan(app: FastAPI):
     settings.upload_dir.mkdir(exist_ok=True)
     settings.output_dir.mkdir(exist_ok=True)
     
-    # Initialize HTTP client
-    app.state.http_client = httpx.AsyncClient(timeout=settings.facefusion_timeout)
+    # Initialize pooled FaceFusion HTTP client (shared keep-alive connections)
+    get_shared_http_client()
+    get_storage()
     
     yield
     
     # Shutdown
     logger.info("Shutting down FaceFusion API...")
-    await app.state.http_client.aclose()
+    await close_shared_http_client()
+    preview_service.shutdown()
+    gallery_service.shutdown()
 
 app = FastAPI(
     title=settings.app_name,
@@ -83,6 +126,7 @@ app.add_middleware(
     allow_credentials=settings.cors_credentials,
     allow_methods=settings.cors_allow_methods,
     allow_headers=settings.cors_allow_headers,
+    expose_headers=["ETag"],
 )
 
 class JobStatus(BaseModel):
@@ -97,6 +141,8 @@ class JobStatus(BaseModel):
 class ProcessRequest(BaseModel):
     video_id: str
     image_id: str
+    profile: ProfileName = None  # fast | balanced | quality, service_default_profile when unset
+    reference_face: Optional[int] = Field(None, ge=0)  # Identity from /api/faces/{video_id}; swap only that face
 
 class ConnectionManager:
     def __init__(self):
@@ -121,62 +167,63 @@ class ConnectionManager:
                 self.disconnect(client_id)
     
     async def broadcast(self, message: str):
-        disconnected_clients = []
-        for client_id, connection in self.active_connections.items():
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to client {client_id}: {e}")
-                disconnected_clients.append(client_id)
-        
-        for client_id in disconnected_clients:
-            self.disconnect(client_id)
+        # Send to all clients concurrently so one slow client does not delay the rest
+        connections = list(self.active_connections.items())
+        results = await asyncio.gather(
+            *(connection.send_text(message) for _, connection in connections),
+            return_exceptions=True
+        )
+        for (client_id, _), result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error broadcasting to client {client_id}: {result}")
+                self.disconnect(client_id)
 
 # Initialize managers
 manager = ConnectionManager()
 job_store = JobStore(ttl_hours=settings.cleanup_interval_hours)
+preview_service = PreviewService(
+    max_workers=settings.preview_workers, failure_ttl_seconds=settings.preview_failure_ttl_seconds
+)
+gallery_service = create_gallery_service()
+admission = AdmissionController(
+    max_queue_depth=settings.admission_max_queue_depth,
+    max_wait_seconds=settings.admission_max_wait_seconds,
+    max_jobs_per_client=settings.admission_max_jobs_per_client,
+    default_job_seconds=settings.admission_default_job_seconds
+)
+client_slots = ClientSlots()
+# Measured frames/sec per processing profile, for completion estimates
+profile_stats = ProfileStats()
+if settings.idempotency_backend == "redis":
+    idempotency_store = RedisIdempotencyStore(
+        redis.Redis(host=settings.redis_host, port=settings.redis_port, db=settings.redis_db),
+        settings.idempotency_ttl_seconds,
+        settings.idempotency_pending_ttl_seconds
+    )
+else:
+    idempotency_store = MemoryIdempotencyStore(
+        settings.idempotency_ttl_seconds, settings.idempotency_pending_ttl_seconds
+    )
+
+def unfinished_job_count() -> int:
+    return sum(
+        1 for job, _ in job_store.jobs.values()
+        if job.status in ("pending", "processing")
+    )
 
 # Utility functions
-def sanitize_filename(filename: str) -> str:
-    """Sanitize filename to prevent path traversal attacks"""
-    import re
-    # Remove any path separators and special characters
-    filename = os.path.basename(filename)
-    filename = re.sub(r'[^\w\s.-]', '', filename)
-    return filename[:255]  # Limit filename length
+async def save_upload_file(request: Request, allowed_extensions: List[str]) -> StreamedUpload:
+    """Stream the uploaded file to the upload directory with validation"""
+    return await stream_upload_to_disk(
+        request,
+        settings.upload_dir,
+        allowed_extensions,
+        settings.max_upload_size_bytes,
+    )
 
-async def save_upload_file(upload_file: UploadFile, allowed_extensions: List[str]) -> tuple[str, Path]:
-    """Save uploaded file with validation"""
-    # Validate file extension
-    file_ext = Path(upload_file.filename).suffix.lower()
-    if file_ext not in allowed_extensions:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file format. Allowed formats: {', '.join(allowed_extensions)}"
-        )
-    
-    # Check file size
-    if upload_file.size and upload_file.size > settings.max_upload_size_bytes:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large. Maximum size: {settings.max_upload_size_mb}MB"
-        )
-    
-    # Generate safe filename
-    file_id = str(uuid.uuid4())
-    safe_filename = sanitize_filename(upload_file.filename)
-    file_path = settings.upload_dir / f"{file_id}_{safe_filename}"
-    
-    # Save file asynchronously
-    try:
-        async with aiofiles.open(file_path, 'wb') as f:
-            while chunk := await upload_file.read(8192):  # Read in chunks
-                await f.write(chunk)
-    except Exception as e:
-        logger.error(f"Error saving file: {e}")
-        raise HTTPException(status_code=500, detail="Error saving file")
-    
-    return file_id, file_path
+async def publish(area: str, path: Path):
+    """Copy a finished upload/output to the storage backend (no-op for local disk)"""
+    await run_in_threadpool(get_storage().put, area, path.name, path)
 
 # API Endpoints
 @app.get("/")
@@ -190,39 +237,79 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
+    backends = get_backend_pool().snapshot()
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "facefusion": {
+            "available": any(b["state"] != "open" for b in backends),
+            "backends": backends
+        },
+        "admission": admission.snapshot(unfinished_job_count(), len(backends)),
+        "idempotency": {
+            "duplicates_avoided": await run_in_threadpool(idempotency_store.duplicates_avoided)
+        }
     }
 
-@app.post("/api/upload/video")
-async def upload_video(file: UploadFile = File(...)):
+@app.post("/api/upload/video", openapi_extra=UPLOAD_OPENAPI_EXTRA)
+async def upload_video(request: Request):
     """Upload video file"""
-    try:
-        file_id, file_path = await save_upload_file(file, settings.allowed_video_extensions)
-        logger.info(f"Video uploaded: {file_id}")
+    async def store_video():
+        upload = await save_upload_file(request, settings.allowed_video_extensions)
+        logger.info(f"Video uploaded: {upload.file_id}")
+        await publish(UPLOADS, upload.path)
+        preview_service.schedule(upload.path, preview_dir(settings.upload_dir, upload.file_id))
         return {
-            "file_id": file_id,
-            "filename": file.filename,
-            "size": file.size
+            "file_id": upload.file_id,
+            "filename": upload.filename,
+            "size": upload.size,
+            "sha256": upload.sha256
         }
+    
+    try:
+        return await run_idempotent(
+            idempotency_store,
+            f"{client_identity(request)}:upload:video",
+            request.headers.get(IDEMPOTENCY_HEADER),
+            store_video
+        )
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error uploading video: {e}")
         raise HTTPException(status_code=500, detail="Error uploading video")
 
-@app.post("/api/upload/image")
-async def upload_image(file: UploadFile = File(...)):
+@app.post("/api/upload/image", openapi_extra=UPLOAD_OPENAPI_EXTRA)
+async def upload_image(request: Request):
     """Upload image file"""
-    try:
-        file_id, file_path = await save_upload_file(file, settings.allowed_image_extensions)
-        logger.info(f"Image uploaded: {file_id}")
+    async def store_image():
+        upload = await save_upload_file(request, settings.allowed_image_extensions)
+        image = await run_in_threadpool(
+            normalize_source_image,
+            upload.path,
+            settings.image_max_dimension,
+            settings.image_require_face
+        )
+        logger.info(f"Image uploaded: {upload.file_id} ({image.width}x{image.height}, {image.faces} faces)")
+        await publish(UPLOADS, upload.path)
+        preview_service.schedule(upload.path, preview_dir(settings.upload_dir, upload.file_id))
         return {
-            "file_id": file_id,
-            "filename": file.filename,
-            "size": file.size
+            "file_id": upload.file_id,
+            "filename": upload.filename,
+            "size": image.size,
+            "sha256": image.sha256,
+            "width": image.width,
+            "height": image.height,
+            "faces": image.faces
         }
+    
+    try:
+        return await run_idempotent(
+            idempotency_store,
+            f"{client_identity(request)}:upload:image",
+            request.headers.get(IDEMPOTENCY_HEADER),
+            store_image
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -230,37 +317,98 @@ async def upload_image(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail="Error uploading image")
 
 @app.post("/api/process")
-async def process_face_swap(request: ProcessRequest):
+async def process_face_swap(request: ProcessRequest, http_request: Request):
     """Start face swap processing"""
-    job_id = str(uuid.uuid4())
-    
-    # Validate input files exist
-    video_files = list(settings.upload_dir.glob(f"{request.video_id}_*"))
-    image_files = list(settings.upload_dir.glob(f"{request.image_id}_*"))
+    client_id = client_identity(http_request)
+    profile = get_profile(request.profile or settings.service_default_profile)
+    reference = None
+    if request.reference_face is not None:
+        try:
+            gallery = cached_gallery(gallery_service, settings.upload_dir, sanitize_filename(request.video_id))
+        except GalleryNotReady as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if gallery is None:
+            raise HTTPException(status_code=404, detail="Video file not found")
+        try:
+            reference = resolve_reference(gallery, request.reference_face)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    if not video_files:
-        raise HTTPException(status_code=404, detail="Video file not found")
-    if not image_files:
-        raise HTTPException(status_code=404, detail="Image file not found")
+    async def create_job():
+        job_id = str(uuid.uuid4())
+        
+        # Refuse work that would sit in a backlog nobody waits for; the
+        # client's slot is checked and taken in one step
+        queue_depth = unfinished_job_count()
+        workers = len(settings.facefusion_backend_urls)
+        admission.admit(client_slots, client_id, job_id, queue_depth, workers)
+        
+        try:
+            # Validate input files exist
+            video_files = list(settings.upload_dir.glob(f"{request.video_id}_*"))
+            image_files = list(settings.upload_dir.glob(f"{request.image_id}_*"))
+            
+            if not video_files:
+                raise HTTPException(status_code=404, detail="Video file not found")
+            if not image_files:
+                raise HTTPException(status_code=404, detail="Image file not found")
+            
+            # Completion estimate from the profile's measured frames/sec
+            frames = await run_in_threadpool(count_frames, video_files[0])
+            estimate = estimate_job(
+                profile,
+                profile_stats,
+                frames,
+                admission.estimated_wait(queue_depth, workers),
+                admission.throughput.avg_job_seconds
+            )
+        except Exception:
+            client_slots.release(job_id)
+            raise
+        
+        # Create job
+        job = JobStatus(
+            job_id=job_id,
+            status="pending",
+            progress=0
+        )
+        job_store.add_job(job_id, job)
+        
+        # Start processing in background
+        asyncio.create_task(run_face_swap(job_id, video_files[0], image_files[0], profile.name, frames, reference))
+        
+        logger.info(f"Job created: {job_id} ({profile.name})")
+        return {"job_id": job_id, "estimate": estimate}
     
-    # Create job
-    job = JobStatus(
-        job_id=job_id,
-        status="pending",
-        progress=0
+    # A retried submission with the same key returns the original job
+    return await run_idempotent(
+        idempotency_store,
+        f"{client_id}:process",
+        http_request.headers.get(IDEMPOTENCY_HEADER),
+        create_job,
+        fingerprint=request_fingerprint(request.dict())
     )
-    job_store.add_job(job_id, job)
-    
-    # Start processing in background
-    asyncio.create_task(run_face_swap(job_id, video_files[0], image_files[0]))
-    
-    logger.info(f"Job created: {job_id}")
-    return {"job_id": job_id}
 
-async def run_face_swap(job_id: str, video_path: Path, image_path: Path):
+def count_frames(video_path: Path) -> Optional[int]:
+    """Frame count of the target, or None when it cannot be probed"""
+    try:
+        return probe_video(video_path).frame_count
+    except Exception as e:
+        logger.warning(f"Could not probe {video_path.name}: {e}")
+        return None
+
+async def run_face_swap(
+    job_id: str,
+    video_path: Path,
+    image_path: Path,
+    profile: Optional[str] = None,
+    frames: Optional[int] = None,
+    reference: Optional[Dict[str, int]] = None
+):
     """Run face swap processing with FaceFusion"""
-    http_client = app.state.http_client
-    
+    started_at = datetime.now()
     try:
         # Update job status
         job = job_store.get_job(job_id)
@@ -273,60 +421,36 @@ async def run_face_swap(job_id: str, video_path: Path, image_path: Path):
         job_store.update_job(job_id, job)
         await manager.broadcast(json.dumps(job.dict()))
         
-        # Prepare request to FaceFusion
-        files = {
-            'source': open(image_path, 'rb'),
-            'target': open(video_path, 'rb')
-        }
-        
-        data = {
-            'face_selector_mode': 'many',
-            'face_analyser_order': 'left-right',
-            'face_analyser_age': 'all',
-            'face_analyser_gender': 'all',
-            'face_detector_model': 'retinaface',
-            'face_recognizer_model': 'arcface_inswapper',
-            'face_mask_type': 'box',
-            'face_enhancer_model': 'gfpgan_1.4',
-            'frame_enhancer_model': 'real_esrgan_x4plus',
-            'execution_providers': ['cpu'],
-            'execution_thread_count': 4,
-            'execution_queue_count': 1
-        }
-        
-        # Send request to FaceFusion
+        # Send request to FaceFusion (pooled client with retries and circuit breaker)
         logger.info(f"Sending request to FaceFusion for job {job_id}")
         
         try:
-            response = await http_client.post(
-                f"{settings.facefusion_url}/api/process",
-                files=files,
-                data=data
-            )
-            response.raise_for_status()
-            
-            # Process response
-            result = response.json()
-            
-            # Update progress periodically
-            for progress in [30, 50, 70, 90]:
-                job.progress = progress
-                job.updated_at = datetime.now()
-                job_store.update_job(job_id, job)
-                await manager.broadcast(json.dumps(job.dict()))
-                await asyncio.sleep(2)
-            
-            # Save output
             output_filename = f"{job_id}_output.mp4"
             output_path = settings.output_dir / output_filename
             
-            # Download processed video from FaceFusion
-            if 'output_url' in result:
-                output_response = await http_client.get(result['output_url'])
-                output_response.raise_for_status()
+            async with FaceFusionClient() as client:
+                # On a shared volume the service writes output_path itself
+                render_started = time.monotonic()
+                result = await client.process_face_swap(
+                    image_path, video_path, output_path=output_path, profile=profile, reference=reference
+                )
+                # The profile's frames/sec covers only FaceFusion's processing
+                render_seconds = time.monotonic() - render_started
+                
+                # Update progress periodically
+                for progress in [30, 50, 70, 90]:
+                    job.progress = progress
+                    job.updated_at = datetime.now()
+                    job_store.update_job(job_id, job)
+                    await manager.broadcast(json.dumps(job.dict()))
+                    await asyncio.sleep(2)
                 
-                async with aiofiles.open(output_path, 'wb') as f:
-                    await f.write(output_response.content)
+                # Download processed video from FaceFusion unless it was written in place
+                if not result.get('path_reference') and 'output_url' in result:
+                    await client.download_output(result['output_url'], output_path)
+            
+            # Large outputs go up in parallel multipart chunks
+            await publish(OUTPUTS, output_path)
             
             # Update job as completed
             job.status = "completed"
@@ -334,18 +458,18 @@ async def run_face_swap(job_id: str, video_path: Path, image_path: Path):
             job.output_url = f"/api/download/{output_filename}"
             job.updated_at = datetime.now()
             job_store.update_job(job_id, job)
+            preview_service.schedule(output_path, preview_dir(settings.output_dir, job_id))
+            elapsed = (datetime.now() - started_at).total_seconds()
+            admission.throughput.record(elapsed)
+            if frames:
+                profile_stats.record(profile or settings.service_default_profile, frames, render_seconds)
             
             logger.info(f"Job completed: {job_id}")
             
-        except httpx.HTTPError as e:
+        except (httpx.HTTPError, CircuitOpenError, BackendUnavailableError) as e:
             logger.error(f"HTTP error during FaceFusion processing: {e}")
             raise Exception(f"FaceFusion API error: {str(e)}")
         
-        finally:
-            # Close file handles
-            for file_handle in files.values():
-                file_handle.close()
-        
         await manager.broadcast(json.dumps(job.dict()))
         
     except Exception as e:
@@ -357,14 +481,30 @@ async def run_face_swap(job_id: str, video_path: Path, image_path: Path):
             job.updated_at = datetime.now()
             job_store.update_job(job_id, job)
             await manager.broadcast(json.dumps(job.dict()))
+    finally:
+        client_slots.release(job_id)
 
-@app.get("/api/job/{job_id}")
-async def get_job_status(job_id: str):
-    """Get job status"""
+async def load_job_status(job_id: str) -> dict:
     job = job_store.get_job(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    return job
+    return job.dict()
+
+status_cache = CoalescingStatusCache(loader=load_job_status, ttl=0.25, poll_interval=0.5)
+
+@app.get("/api/profiles")
+async def list_profiles():
+    """Processing profiles with their measured frames/sec"""
+    return profile_stats.snapshot()
+
+@app.get("/api/job/{job_id}")
+async def get_job_status(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=60, description="Long-poll: seconds to wait for a status change"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """Get job status (ETag, If-None-Match and ?wait= long-polling)"""
+    return await conditional_status_response(status_cache, job_id, if_none_match, wait)
 
 @app.get("/api/jobs")
 async def list_jobs():
@@ -378,22 +518,57 @@ async def list_jobs():
 
 @app.get("/api/download/{filename}")
 async def download_file(filename: str):
-    """Download processed file"""
+    """Download processed file (redirects to a presigned URL with object storage)"""
     # Sanitize filename to prevent path traversal
     safe_filename = sanitize_filename(filename)
-    file_path = settings.output_dir / safe_filename
     
-    if not file_path.exists() or not file_path.is_file():
+    try:
+        return await run_in_threadpool(get_storage().download_response, OUTPUTS, safe_filename, 'video/mp4')
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+@app.get("/api/faces/{video_id}")
+async def get_face_gallery(video_id: str):
+    """People in an uploaded target, with thumbnails (sampled and clustered on first request)"""
+    video_id = sanitize_filename(video_id)
+    try:
+        gallery = await ensure_gallery(gallery_service, settings.upload_dir, video_id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if gallery is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return gallery_payload(gallery, video_id)
+
+@app.get("/api/faces/{video_id}/{name}")
+async def get_face_thumbnail(video_id: str, name: str):
+    """Serve a face gallery thumbnail"""
+    path = gallery_dir(settings.upload_dir, sanitize_filename(video_id)) / sanitize_filename(name)
+    if path.suffix != ".jpg" or not path.is_file():
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return FileResponse(
+        path,
+        media_type="image/jpeg",
+        headers={"Cache-Control": f"public, max-age={settings.preview_cache_max_age}, immutable"}
+    )
+
+@app.get("/api/preview/{kind}/{media_id}/{asset}")
+async def get_preview(kind: Literal["upload", "output"], media_id: str, asset: str):
+    """Serve a cached poster, scrub sprite or animated preview for an upload or job output"""
+    if asset not in PREVIEW_ASSETS:
+        raise HTTPException(status_code=404, detail="Unknown preview asset")
+    
+    found = find_media(kind, sanitize_filename(media_id), settings.upload_dir, settings.output_dir)
+    if not found:
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Check if file is within output directory
-    if not str(file_path).startswith(str(settings.output_dir)):
-        raise HTTPException(status_code=403, detail="Access denied")
+    asset_path = await preview_service.ensure(*found, asset)
+    if asset_path is None:
+        raise HTTPException(status_code=404, detail="Preview not available")
     
     return FileResponse(
-        file_path,
-        media_type='video/mp4',
-        filename=safe_filename
+        asset_path,
+        media_type=PREVIEW_ASSETS[asset],
+        headers={"Cache-Control": f"public, max-age={settings.preview_cache_max_age}, immutable"}
     )
 
 @app.websocket("/ws/{client_id}")
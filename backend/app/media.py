@@ -0,0 +1,153 @@
+import json
+import subprocess
+import logging
+from fractions import Fraction
+from pathlib import Path
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = "ffmpeg"
+FFPROBE = "ffprobe"
+
+
+class VideoInfo(BaseModel):
+    width: int
+    height: int
+    fps: float
+    frame_count: int
+    duration: float
+    has_audio: bool
+    codec: Optional[str] = None
+
+
+def probe_video(path: Path, timeout: int = 60) -> VideoInfo:
+    """Read stream metadata with ffprobe"""
+    result = subprocess.run(
+        [
+            FFPROBE, "-v", "error",
+            "-print_format", "json",
+            "-show_streams", "-show_format",
+            str(path),
+        ],
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+    if result.returncode != 0:
+        raise Exception(f"ffprobe failed for {path}: {result.stderr.strip()[-500:]}")
+
+    data = json.loads(result.stdout)
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if video is None:
+        raise Exception(f"No video stream in {path}")
+
+    fps = float(Fraction(video.get("avg_frame_rate") or video.get("r_frame_rate") or "0/1") or 0)
+    if fps <= 0:
+        fps = float(Fraction(video.get("r_frame_rate", "25/1")))
+    duration = float(video.get("duration") or data.get("format", {}).get("duration") or 0)
+    frame_count = int(video.get("nb_frames") or 0) or int(round(duration * fps))
+
+    return VideoInfo(
+        width=int(video.get("width", 0)),
+        height=int(video.get("height", 0)),
+        fps=fps,
+        frame_count=frame_count,
+        duration=duration,
+        has_audio=any(s.get("codec_type") == "audio" for s in streams),
+        codec=video.get("codec_name"),
+    )
+
+
+def run_ffmpeg(args: List[str], timeout: int = 600) -> None:
+    """Run ffmpeg quietly, raising with the stderr tail on failure"""
+    result = subprocess.run(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-y", *args],
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed: {result.stderr.strip()[-500:]}")
+
+
+def concat_videos(
+    parts: List[Path],
+    output_path: Path,
+    timeout: int = 600,
+    preset: Optional[str] = None,
+    crf: int = 18,
+) -> None:
+    """Join MP4 parts with the concat demuxer.
+
+    Parts are copied losslessly, which needs the same codec parameters and
+    timebase throughout. With ``preset`` the video is re-encoded at the join
+    instead, for parts that come from different encoders.
+    """
+    list_file = output_path.with_suffix(".concat.txt")
+    list_file.write_text("".join(f"file '{part.resolve()}'\n" for part in parts))
+    if preset is None:
+        codec = ["-c", "copy"]
+    else:
+        codec = ["-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p", "-c:a", "copy"]
+    try:
+        run_ffmpeg(
+            ["-f", "concat", "-safe", "0", "-i", str(list_file),
+             *codec, "-movflags", "+faststart", str(output_path)],
+            timeout=timeout,
+        )
+    finally:
+        list_file.unlink(missing_ok=True)
+
+
+def encode_range(
+    path: Path,
+    start_frame: int,
+    end_frame: int,
+    fps: float,
+    output_path: Path,
+    timeout: int = 600,
+    resolution: Optional[str] = None,
+    encoder: str = "libx264",
+    preset: str = "veryfast",
+    crf: int = 18,
+) -> None:
+    """Re-encode frames ``[start_frame, end_frame)`` unchanged.
+
+    Pass the encoder, preset and CRF of the profile FaceFusion renders the
+    other chunks with; the output is written at a constant ``fps`` in
+    yuv420p/AAC like FaceFusion's merge step, so both kinds of chunk share
+    codec parameters and timebase. ``resolution`` ("WxH") matches chunks
+    FaceFusion renders at a profile's output resolution.
+    """
+    scale = ["-vf", "scale=" + resolution.replace("x", ":")] if resolution else []
+    run_ffmpeg(
+        ["-ss", f"{start_frame / fps:.6f}", "-i", str(path),
+         "-frames:v", str(end_frame - start_frame),
+         "-t", f"{(end_frame - start_frame) / fps:.6f}",
+         "-map", "0:v:0", "-map", "0:a:0?",
+         *scale,
+         "-c:v", encoder, "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p", "-r", f"{fps:.6f}",
+         "-c:a", "aac", str(output_path)],
+        timeout=timeout,
+    )
+
+
+def transcode_video(
+    path: Path,
+    output_path: Path,
+    preset: str = "medium",
+    crf: int = 18,
+    timeout: int = 1800,
+) -> None:
+    """Re-encode the video stream for delivery; audio is copied as-is"""
+    run_ffmpeg(
+        ["-i", str(path),
+         "-map", "0:v:0", "-map", "0:a:0?",
+         "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p",
+         "-c:a", "copy", "-movflags", "+faststart", str(output_path)],
+        timeout=timeout,
+    )
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import math
+import threading
+import time
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+from .media import probe_video, run_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_DIR_NAME = ".previews"
+
+POSTER = "poster.jpg"
+SPRITE = "sprite.jpg"
+SPRITE_INDEX = "sprite.json"
+ANIMATED = "preview.webp"
+DONE_MARKER = ".done"
+FAILED_MARKER = ".failed"
+
+PREVIEW_ASSETS = {
+    POSTER: "image/jpeg",
+    SPRITE: "image/jpeg",
+    SPRITE_INDEX: "application/json",
+    ANIMATED: "image/webp",
+}
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+POSTER_WIDTH = 640
+SPRITE_TILE_WIDTH = 160
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+ANIMATED_WIDTH = 320
+ANIMATED_SECONDS = 3
+ANIMATED_FPS = 10
+
+
+def preview_dir(media_dir: Path, media_id: str) -> Path:
+    """Preview cache directory for a media file, kept alongside the media itself"""
+    return media_dir / PREVIEW_DIR_NAME / media_id
+
+
+def find_media(kind: str, media_id: str, upload_dir: Path, output_dir: Path) -> Optional[Tuple[Path, Path]]:
+    """Resolve ``(media_path, preview_dir)`` for an upload id or a job id"""
+    if kind == "upload":
+        matches = sorted(upload_dir.glob(f"{media_id}_*"))
+        if matches:
+            return matches[0], preview_dir(upload_dir, media_id)
+    elif kind == "output":
+        media_path = output_dir / f"{media_id}_output.mp4"
+        if media_path.is_file():
+            return media_path, preview_dir(output_dir, media_id)
+    return None
+
+
+def generate_image_previews(media_path: Path, out_dir: Path):
+    with Image.open(media_path) as image:
+        image.thumbnail((POSTER_WIDTH, POSTER_WIDTH))
+        image.convert("RGB").save(out_dir / POSTER, "JPEG", quality=85)
+
+
+def generate_video_previews(media_path: Path, out_dir: Path):
+    info = probe_video(media_path)
+    duration = max(info.duration, 0.1)
+
+    # Poster frame from 10% in, which skips most fade-ins and black leaders
+    run_ffmpeg([
+        "-ss", f"{duration * 0.1:.3f}", "-i", str(media_path),
+        "-frames:v", "1", "-vf", f"scale={POSTER_WIDTH}:-2",
+        "-q:v", "3", str(out_dir / POSTER),
+    ])
+
+    # Scrub sprite: up to 100 evenly spaced low-res tiles in one image
+    tiles = SPRITE_COLUMNS * SPRITE_ROWS
+    interval = duration / tiles
+    tile_height = int(round(SPRITE_TILE_WIDTH * info.height / info.width / 2)) * 2 if info.width else 90
+    run_ffmpeg([
+        "-i", str(media_path),
+        "-vf", f"fps=1/{interval:.4f},scale={SPRITE_TILE_WIDTH}:{tile_height},tile={SPRITE_COLUMNS}x{SPRITE_ROWS}",
+        "-frames:v", "1", "-q:v", "5", str(out_dir / SPRITE),
+    ])
+    frames = min(tiles, max(1, math.floor(duration / interval)))
+    (out_dir / SPRITE_INDEX).write_text(json.dumps({
+        "url": SPRITE,
+        "tile_width": SPRITE_TILE_WIDTH,
+        "tile_height": tile_height,
+        "columns": SPRITE_COLUMNS,
+        "rows": SPRITE_ROWS,
+        "frames": frames,
+        "interval_seconds": round(interval, 4),
+        "duration": info.duration,
+    }))
+
+    # Short looping animated preview
+    run_ffmpeg([
+        "-ss", f"{duration * 0.1:.3f}", "-t", str(ANIMATED_SECONDS), "-i", str(media_path),
+        "-vf", f"fps={ANIMATED_FPS},scale={ANIMATED_WIDTH}:-2",
+        "-an", "-loop", "0", "-c:v", "libwebp", "-q:v", "50",
+        str(out_dir / ANIMATED),
+    ])
+
+
+def generate_previews(media_path: Path, out_dir: Path):
+    """Generate all preview assets for one media file (blocking)"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if media_path.suffix.lower() in IMAGE_EXTENSIONS:
+        generate_image_previews(media_path, out_dir)
+    else:
+        generate_video_previews(media_path, out_dir)
+    (out_dir / DONE_MARKER).touch()
+    logger.info(f"Previews generated for {media_path.name}")
+
+
+class PreviewFailed(Exception):
+    """Raised for media whose generation failed within the failure TTL"""
+
+
+class PreviewService:
+    """Generates previews on a bounded background pool, one job per media file.
+
+    The heavy lifting happens in ffmpeg subprocesses and Pillow, so a small
+    thread pool is enough to keep the CPU busy without starving the API.
+    A failed generation leaves FAILED_MARKER behind; requests within
+    ``failure_ttl_seconds`` get the failure instead of a retry.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        generate: Callable[[Path, Path], object] = generate_previews,
+        failure_ttl_seconds: float = 600.0,
+    ):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="previews")
+        # Writes every asset into out_dir and touches DONE_MARKER last
+        self.generate = generate
+        self.failure_ttl_seconds = failure_ttl_seconds
+        self._inflight: Dict[Path, Future] = {}
+        self._lock = threading.Lock()
+
+    def failure(self, out_dir: Path) -> Optional[str]:
+        """Error of a recent failed generation; an expired marker is removed so the next request retries"""
+        marker = out_dir / FAILED_MARKER
+        try:
+            if time.time() - marker.stat().st_mtime < self.failure_ttl_seconds:
+                return marker.read_text() or "generation failed"
+        except OSError:
+            return None
+        marker.unlink(missing_ok=True)
+        return None
+
+    def schedule(self, media_path: Path, out_dir: Path) -> Future:
+        """Queue preview generation unless it is already cached or in flight"""
+        with self._lock:
+            future = self._inflight.get(out_dir)
+            if future is not None:
+                return future
+            if (out_dir / DONE_MARKER).exists():
+                done: Future = Future()
+                done.set_result(out_dir)
+                return done
+            error = self.failure(out_dir)
+            if error is not None:
+                failed: Future = Future()
+                failed.set_exception(PreviewFailed(error))
+                return failed
+            future = self.executor.submit(self._generate, media_path, out_dir)
+            self._inflight[out_dir] = future
+            return future
+
+    def _generate(self, media_path: Path, out_dir: Path) -> Path:
+        try:
+            self.generate(media_path, out_dir)
+            return out_dir
+        except Exception as e:
+            logger.error(f"Preview generation failed for {media_path}: {e}")
+            try:
+                out_dir.mkdir(parents=True, exist_ok=True)
+                (out_dir / FAILED_MARKER).write_text(str(e)[-500:])
+            except OSError as marker_error:
+                logger.warning(f"Could not record the failure for {media_path}: {marker_error}")
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(out_dir, None)
+
+    async def ensure(self, media_path: Path, out_dir: Path, asset: str) -> Optional[Path]:
+        """Return the cached asset path, generating previews first if needed"""
+        asset_path = out_dir / asset
+        if (out_dir / DONE_MARKER).exists():
+            return asset_path if asset_path.exists() else None
+        try:
+            await asyncio.wrap_future(self.schedule(media_path, out_dir))
+        except Exception:
+            return None
+        return asset_path if asset_path.exists() else None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,222 @@
+import json
+import threading
+import time
+import logging
+from collections import deque
+from pathlib import Path
+from typing import Annotated, Deque, Dict, List, Optional, Tuple
+
+from pydantic import AfterValidator, BaseModel
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessingProfile(BaseModel):
+    """A named set of FaceFusion options, trading speed for quality"""
+
+    name: str
+    description: str = ""
+    face_detector_model: str = "yolo_face"
+    face_detector_score: float = 0.5
+    face_enhancer_model: Optional[str] = None
+    frame_enhancer_model: Optional[str] = None
+    output_video_resolution: Optional[str] = None  # e.g. "1280x720"; None keeps the target's
+    output_video_encoder: str = "libx264"
+    output_video_preset: str = "veryfast"
+    output_video_quality: int = 80  # FaceFusion's 0-100 scale
+    nominal_fps: float = 10.0  # Used for estimates until real throughput is measured
+
+    @property
+    def processors(self) -> List[str]:
+        processors = ["face_swapper"]
+        if self.face_enhancer_model:
+            processors.append("face_enhancer")
+        if self.frame_enhancer_model:
+            processors.append("frame_enhancer")
+        return processors
+
+    @property
+    def crf(self) -> int:
+        """ffmpeg CRF equivalent of ``output_video_quality`` (FaceFusion's own mapping)"""
+        return round(51 - self.output_video_quality * 0.51)
+
+    def facefusion_options(self) -> Dict[str, object]:
+        """Keyword arguments for ``build_facefusion_command``"""
+        return {
+            "face_detector_model": self.face_detector_model,
+            "face_detector_score": self.face_detector_score,
+            "processors": self.processors,
+            "face_enhancer_model": self.face_enhancer_model,
+            "frame_enhancer_model": self.frame_enhancer_model,
+            "output_video_resolution": self.output_video_resolution,
+            "output_video_encoder": self.output_video_encoder,
+            "output_video_preset": self.output_video_preset,
+            "output_video_quality": self.output_video_quality,
+        }
+
+    def api_options(self) -> Dict[str, object]:
+        """Options for the FaceFusion service's /api/process"""
+        options = {
+            key: value for key, value in self.facefusion_options().items()
+            if value is not None and key != "processors"
+        }
+        options["processors"] = self.processors
+        return options
+
+
+BUILTIN_PROFILES = [
+    ProcessingProfile(
+        name="fast",
+        description="Swap only, fastest detector",
+        output_video_preset="veryfast",
+        output_video_quality=80,
+        nominal_fps=20.0,
+    ),
+    ProcessingProfile(
+        name="balanced",
+        description="Swap with face enhancement",
+        face_enhancer_model="gfpgan_1.4",
+        output_video_preset="fast",
+        output_video_quality=85,
+        nominal_fps=8.0,
+    ),
+    ProcessingProfile(
+        name="quality",
+        description="Most accurate detector, face and frame enhancement",
+        face_detector_model="retinaface",
+        face_enhancer_model="gfpgan_1.4",
+        frame_enhancer_model="real_esrgan_x4plus",
+        output_video_preset="slow",
+        output_video_quality=90,
+        nominal_fps=1.5,
+    ),
+]
+
+
+def load_profiles(path: Optional[Path] = None) -> Dict[str, ProcessingProfile]:
+    """Built-in profiles, overridden or extended by a JSON list in ``path``"""
+    profiles = {profile.name: profile for profile in BUILTIN_PROFILES}
+    if path:
+        for entry in json.loads(Path(path).read_text()):
+            base = profiles.get(entry.get("name"))
+            profile = base.model_copy(update=entry) if base else ProcessingProfile(**entry)
+            profiles[profile.name] = ProcessingProfile(**profile.model_dump())
+    return profiles
+
+
+PROFILES = load_profiles(settings.profiles_file)
+
+
+def get_profile(name: Optional[str] = None) -> ProcessingProfile:
+    """Profile by name (``default_profile`` when None); raises ValueError for unknown names"""
+    name = name or settings.default_profile
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown profile '{name}' (available: {', '.join(PROFILES)})")
+
+
+def _check_profile(name: Optional[str]) -> Optional[str]:
+    if name is not None:
+        get_profile(name)
+    return name
+
+
+# Request field type: rejected with 422 unless it names a configured profile
+ProfileName = Annotated[Optional[str], AfterValidator(_check_profile)]
+
+
+class ProfileStats:
+    """Process-local frames/sec per profile over the last ``window`` samples"""
+
+    def __init__(self, window: int = 50):
+        self.window = window
+        self._samples: Dict[str, Deque[Tuple[int, float]]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, profile: str, frames: int, seconds: float):
+        if frames <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            self._samples.setdefault(profile, deque(maxlen=self.window)).append((frames, seconds))
+
+    def samples(self, profile: str) -> List[Tuple[int, float]]:
+        with self._lock:
+            return list(self._samples.get(profile, ()))
+
+    def fps(self, profile: str) -> Optional[float]:
+        return _fps(self.samples(profile))
+
+    def snapshot(self) -> Dict[str, dict]:
+        return _snapshot(self)
+
+
+class RedisProfileStats:
+    """Shared samples: every worker records, every API replica estimates"""
+
+    def __init__(self, redis_client, window: int = 50, prefix: str = "profiles:samples:"):
+        self.redis = redis_client
+        self.window = window
+        self.prefix = prefix
+
+    def record(self, profile: str, frames: int, seconds: float):
+        if frames <= 0 or seconds <= 0:
+            return
+        key = f"{self.prefix}{profile}"
+        pipe = self.redis.pipeline()
+        pipe.lpush(key, json.dumps([frames, round(seconds, 3)]))
+        pipe.ltrim(key, 0, self.window - 1)
+        pipe.execute()
+
+    def samples(self, profile: str) -> List[Tuple[int, float]]:
+        return [tuple(json.loads(raw)) for raw in self.redis.lrange(f"{self.prefix}{profile}", 0, -1)]
+
+    def fps(self, profile: str) -> Optional[float]:
+        return _fps(self.samples(profile))
+
+    def snapshot(self) -> Dict[str, dict]:
+        return _snapshot(self)
+
+
+def _fps(samples: List[Tuple[int, float]]) -> Optional[float]:
+    seconds = sum(s for _, s in samples)
+    return sum(f for f, _ in samples) / seconds if seconds > 0 else None
+
+
+def _snapshot(stats) -> Dict[str, dict]:
+    snapshot = {}
+    for name, profile in PROFILES.items():
+        samples = stats.samples(name)
+        measured = _fps(samples)
+        snapshot[name] = {
+            **profile.model_dump(),
+            "measured_fps": round(measured, 2) if measured else None,
+            "samples": len(samples),
+        }
+    return snapshot
+
+
+def estimate_job(
+    profile: ProcessingProfile,
+    stats,
+    frames: Optional[int],
+    wait_seconds: float,
+    default_job_seconds: float,
+    now: Optional[float] = None,
+) -> Dict[str, object]:
+    """Estimated completion of a job submitted now: queue wait plus frames at the profile's fps"""
+    now = time.time() if now is None else now
+    measured = stats.fps(profile.name)
+    fps = measured or profile.nominal_fps
+    render_seconds = frames / fps if frames else default_job_seconds
+    return {
+        "profile": profile.name,
+        "frames": frames,
+        "fps": round(fps, 2),
+        "fps_measured": measured is not None,
+        "estimated_wait_seconds": round(wait_seconds, 1),
+        "estimated_render_seconds": round(render_seconds, 1),
+        "estimated_completion_at": round(now + wait_seconds + render_seconds, 1),
+    }
@@ -0,0 +1,122 @@
+import math
+import logging
+from pathlib import Path
+from typing import List, Literal, Optional, Tuple
+
+from pydantic import BaseModel, Field, model_validator
+
+from .checkpoints import FrameRange
+from .media import probe_video
+
+logger = logging.getLogger(__name__)
+
+# (start_frame, end_frame, needs_swap), as planned by plan_job
+Chunk = Tuple[int, int, bool]
+
+
+class TargetRange(BaseModel):
+    """Part of the target to face-swap, in seconds or frames (end exclusive).
+
+    ``exclude`` outputs only the selected part; ``splice`` keeps the whole
+    video and passes the frames outside the range through unchanged.
+    """
+
+    start: Optional[float] = Field(None, ge=0)
+    end: Optional[float] = Field(None, gt=0)
+    start_frame: Optional[int] = Field(None, ge=0)
+    end_frame: Optional[int] = Field(None, gt=0)
+    mode: Literal["exclude", "splice"] = "exclude"
+
+    @model_validator(mode="after")
+    def check_bounds(self) -> "TargetRange":
+        if self.start is not None and self.start_frame is not None:
+            raise ValueError("give start or start_frame, not both")
+        if self.end is not None and self.end_frame is not None:
+            raise ValueError("give end or end_frame, not both")
+        if self.start is not None and self.end is not None and self.end <= self.start:
+            raise ValueError("end must be after start")
+        if self.start_frame is not None and self.end_frame is not None and self.end_frame <= self.start_frame:
+            raise ValueError("end_frame must be after start_frame")
+        return self
+
+    @property
+    def in_frames(self) -> bool:
+        """Whether the bounds can be resolved without knowing the frame rate"""
+        return self.start is None and self.end is None
+
+    def to_frames(self, fps: float, frame_count: int) -> FrameRange:
+        """Frame range within ``[0, frame_count)``; raises ValueError when it is empty"""
+        start = self.start_frame if self.start_frame is not None else int(math.floor((self.start or 0) * fps))
+        if self.end_frame is not None:
+            end = self.end_frame
+        elif self.end is not None:
+            end = int(math.ceil(self.end * fps))
+        else:
+            end = frame_count
+        start, end = max(0, start), min(end, frame_count)
+        if end <= start:
+            raise ValueError(f"Range selects no frames (video has {frame_count} frames at {fps:g} fps)")
+        return start, end
+
+
+def range_frames(fps: float, frame_count: int, target_range: Optional[TargetRange]) -> int:
+    """Frames a job covers: the whole target, or only the selected range"""
+    if target_range is None:
+        return frame_count
+    start, end = target_range.to_frames(fps, frame_count)
+    return end - start
+
+
+def upload_frames(upload_dir: Path, video_id: str, target_range: Optional[TargetRange]) -> Optional[int]:
+    """Frames a job on an uploaded video covers, or None when it cannot be probed.
+
+    Blocking (runs ffprobe); raises ValueError when the range selects no frames.
+    """
+    video_files = list(upload_dir.glob(f"{video_id}_*"))
+    if not video_files:
+        return None
+    try:
+        info = probe_video(video_files[0])
+    except Exception as e:
+        logger.warning(f"Could not probe {video_files[0].name}; estimating from the average job time: {e}")
+        return None
+    return range_frames(info.fps, info.frame_count, target_range)
+
+
+def restrict_chunks(chunks: List[Chunk], frame_range: FrameRange, mode: str = "exclude") -> List[Chunk]:
+    """Apply a frame range to a chunk plan.
+
+    Chunks are cut at the range bounds. ``exclude`` drops everything outside
+    the range; ``splice`` keeps it as passthrough chunks, which are re-encoded
+    without FaceFusion.
+    """
+    first, last = frame_range
+    restricted: List[Chunk] = []
+    for start, end, swap in chunks:
+        for part_start, part_end in ((start, min(end, first)), (max(start, first), min(end, last)), (max(start, last), end)):
+            if part_end <= part_start:
+                continue
+            inside = first <= part_start and part_end <= last
+            if inside:
+                restricted.append((part_start, part_end, swap))
+            elif mode == "splice":
+                restricted.append((part_start, part_end, False))
+    return restricted
+
+
+def swap_frames(chunks: List[Chunk]) -> int:
+    """Frames that go through FaceFusion, i.e. the job's cost"""
+    return sum(end - start for start, end, swap in chunks if swap)
+
+
+def progress_fractions(chunks: List[Chunk]) -> List[float]:
+    """Share of the job's cost done after each chunk; passthrough chunks weigh nothing"""
+    total = swap_frames(chunks)
+    if total == 0:
+        return [(index + 1) / len(chunks) for index in range(len(chunks))]
+    fractions, done = [], 0
+    for start, end, swap in chunks:
+        if swap:
+            done += end - start
+        fractions.append(done / total)
+    return fractions
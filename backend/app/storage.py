@@ -0,0 +1,193 @@
+import mimetypes
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Optional
+
+from fastapi.responses import FileResponse, RedirectResponse, Response
+
+from .config import settings
+
+# Storage areas; object keys are "<prefix><area>/<name>"
+UPLOADS = "uploads"
+OUTPUTS = "outputs"
+
+
+class LocalStorage:
+    """Files stay in ``upload_dir``/``output_dir``; the API serves downloads itself"""
+
+    remote = False
+
+    def __init__(self, upload_dir: Path, output_dir: Path):
+        self.roots: Dict[str, Path] = {UPLOADS: upload_dir, OUTPUTS: output_dir}
+
+    def local_path(self, area: str, name: str) -> Path:
+        return self.roots[area] / Path(name).name
+
+    def put(self, area: str, name: str, path: Path):
+        """Store ``path`` under ``name`` (a no-op when it already lives there)"""
+        target = self.local_path(area, name)
+        if target.resolve() == path.resolve():
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{target.name}.tmp")
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+
+    def fetch(self, area: str, name: str, dest: Path):
+        shutil.copyfile(self.local_path(area, name), dest)
+
+    def find(self, area: str, prefix: str) -> Optional[str]:
+        """Name of the first stored file starting with ``prefix``"""
+        match = next(self.roots[area].glob(f"{Path(prefix).name}*"), None)
+        return match.name if match is not None and match.is_file() else None
+
+    def exists(self, area: str, name: str) -> bool:
+        return self.local_path(area, name).is_file()
+
+    def delete(self, area: str, name: str):
+        self.local_path(area, name).unlink(missing_ok=True)
+
+    def download_response(self, area: str, name: str, media_type: Optional[str] = None) -> Response:
+        path = self.local_path(area, name)
+        if not path.is_file():
+            raise FileNotFoundError(name)
+        return FileResponse(path, media_type=media_type, filename=path.name)
+
+
+class S3Storage:
+    """S3-compatible object storage (AWS S3, MinIO, ...).
+
+    Downloads redirect to short-lived presigned URLs so the bytes never pass
+    through the API. Files above ``multipart_threshold`` are uploaded in
+    parallel ``multipart_chunksize`` parts. ``public_endpoint_url`` is used
+    for presigning when clients reach the store under a different host than
+    the API does (e.g. MinIO inside docker-compose).
+    """
+
+    remote = True
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        public_endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        access_key_id: Optional[str] = None,
+        secret_access_key: Optional[str] = None,
+        presign_expiry_seconds: int = 3600,
+        multipart_threshold: int = 64 * 1024 * 1024,
+        multipart_chunksize: int = 16 * 1024 * 1024,
+    ):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("storage_backend=s3 requires boto3 (pip install boto3)") from e
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.presign_expiry_seconds = presign_expiry_seconds
+        self._client_error = ClientError
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+        )
+
+        def make_client(url: Optional[str]):
+            return boto3.client(
+                "s3",
+                endpoint_url=url,
+                region_name=region,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                # MinIO and most self-hosted stores only support path-style addressing
+                config=Config(signature_version="s3v4", s3={"addressing_style": "path" if url else "auto"}),
+            )
+
+        self.client = make_client(endpoint_url)
+        self.presign_client = make_client(public_endpoint_url) if public_endpoint_url else self.client
+
+    def key(self, area: str, name: str) -> str:
+        return f"{self.prefix}{area}/{Path(name).name}"
+
+    def put(self, area: str, name: str, path: Path):
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.client.upload_file(
+            str(path),
+            self.bucket,
+            self.key(area, name),
+            ExtraArgs={"ContentType": content_type},
+            Config=self.transfer_config,
+        )
+
+    def fetch(self, area: str, name: str, dest: Path):
+        self.client.download_file(self.bucket, self.key(area, name), str(dest), Config=self.transfer_config)
+
+    def find(self, area: str, prefix: str) -> Optional[str]:
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.key(area, prefix), MaxKeys=1)
+        contents = response.get("Contents") or []
+        return contents[0]["Key"].rsplit("/", 1)[-1] if contents else None
+
+    def exists(self, area: str, name: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(area, name))
+            return True
+        except self._client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def delete(self, area: str, name: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(area, name))
+
+    def presigned_url(self, area: str, name: str) -> str:
+        return self.presign_client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self.key(area, name),
+                "ResponseContentDisposition": f'attachment; filename="{Path(name).name}"',
+            },
+            ExpiresIn=self.presign_expiry_seconds,
+        )
+
+    def download_response(self, area: str, name: str, media_type: Optional[str] = None) -> Response:
+        if not self.exists(area, name):
+            raise FileNotFoundError(name)
+        return RedirectResponse(self.presigned_url(area, name), status_code=307)
+
+
+def create_storage(config=settings):
+    """Storage backend selected by ``storage_backend`` (local | s3)"""
+    if config.storage_backend == "local":
+        return LocalStorage(config.upload_dir, config.output_dir)
+    if config.storage_backend == "s3":
+        if not config.s3_bucket:
+            raise ValueError("storage_backend=s3 requires s3_bucket")
+        return S3Storage(
+            config.s3_bucket,
+            prefix=config.s3_prefix,
+            endpoint_url=config.s3_endpoint_url or None,
+            public_endpoint_url=config.s3_public_endpoint_url or None,
+            region=config.s3_region or None,
+            access_key_id=config.s3_access_key_id or None,
+            secret_access_key=config.s3_secret_access_key or None,
+            presign_expiry_seconds=config.s3_presign_expiry_seconds,
+            multipart_threshold=config.s3_multipart_threshold_mb * 1024 * 1024,
+            multipart_chunksize=config.s3_multipart_chunk_mb * 1024 * 1024,
+        )
+    raise ValueError(f"Unknown storage_backend: {config.storage_backend}")
+
+
+_shared_storage = None
+
+
+def get_storage():
+    global _shared_storage
+    if _shared_storage is None:
+        _shared_storage = create_storage(settings)
+    return _shared_storage
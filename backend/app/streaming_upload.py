@@ -0,0 +1,227 @@
+import hashlib
+import os
+import uuid
+import logging
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import HTTPException, Request
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from multipart.multipart import MultipartParser, parse_options_header
+from multipart.exceptions import MultipartParseError
+
+from .utils import sanitize_filename
+
+logger = logging.getLogger(__name__)
+
+# Request chunks are batched up to this size before being handed to the
+# threadpool, so a 100MB upload costs ~100 thread hops instead of ~1600.
+FLUSH_THRESHOLD_BYTES = 1024 * 1024
+
+# Multipart schema for the OpenAPI docs, since the routes read the raw request
+UPLOAD_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                }
+            }
+        },
+    }
+}
+
+
+class StreamedUpload(BaseModel):
+    file_id: str
+    filename: str
+    path: Path
+    size: int
+    sha256: str
+
+
+class _UploadSink:
+    """Multipart callbacks that write the file part straight to its final path.
+
+    All callbacks run inside the threadpool together with ``parser.write``,
+    so the blocking file I/O never touches the event loop.
+    """
+
+    def __init__(
+        self,
+        upload_dir: Path,
+        field_name: str,
+        allowed_extensions: List[str],
+        max_bytes: int,
+    ):
+        self.upload_dir = upload_dir
+        self.field_name = field_name
+        self.allowed_extensions = allowed_extensions
+        self.max_bytes = max_bytes
+
+        self.file_id: Optional[str] = None
+        self.filename: Optional[str] = None
+        self.path: Optional[Path] = None
+        self.size = 0
+        self.completed = False
+        self._hasher = hashlib.sha256()
+        self._fh = None
+        self._in_target_part = False
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._in_target_part = False
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        name = options.get(b"name", b"").decode("utf-8", errors="replace")
+        if name != self.field_name or b"filename" not in options or self.path is not None:
+            return
+
+        filename = options[b"filename"].decode("utf-8", errors="replace")
+        file_ext = Path(filename).suffix.lower()
+        if file_ext not in self.allowed_extensions:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file format. Allowed formats: {', '.join(self.allowed_extensions)}"
+            )
+
+        self.file_id = str(uuid.uuid4())
+        self.filename = filename
+        self.path = self.upload_dir / f"{self.file_id}_{sanitize_filename(filename)}"
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.path, "wb")
+        self._in_target_part = True
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_target_part:
+            return
+        self.size += end - start
+        if self.size > self.max_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Maximum size: {self.max_bytes // (1024 * 1024)}MB"
+            )
+        chunk = data[start:end]
+        self._hasher.update(chunk)
+        self._fh.write(chunk)
+
+    def on_part_end(self):
+        if self._in_target_part:
+            self._fh.close()
+            self._fh = None
+            self._in_target_part = False
+            self.completed = True
+
+    def abort(self):
+        """Close and remove a partially written file"""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self.path is not None and not self.completed:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def sha256(self) -> str:
+        return self._hasher.hexdigest()
+
+
+async def stream_upload_to_disk(
+    request: Request,
+    upload_dir: Path,
+    allowed_extensions: List[str],
+    max_bytes: int,
+    field_name: str = "file",
+) -> StreamedUpload:
+    """Parse a multipart request body incrementally and write the file part to disk.
+
+    The body is consumed once, straight from the ASGI stream: there is no
+    spooled temp file, hashing and size enforcement happen on the fly, and the
+    upload is aborted as soon as ``max_bytes`` is exceeded.
+    """
+    content_type = request.headers.get("content-type", "")
+    mime, params = parse_options_header(content_type)
+    if mime != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data upload")
+
+    # Reject obviously oversized bodies before reading a single byte
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + 64 * 1024:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size: {max_bytes // (1024 * 1024)}MB"
+        )
+
+    sink = _UploadSink(upload_dir, field_name, allowed_extensions, max_bytes)
+    parser = MultipartParser(params[b"boundary"], sink.callbacks())
+
+    pending: List[bytes] = []
+    pending_size = 0
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= FLUSH_THRESHOLD_BYTES:
+                await run_in_threadpool(parser.write, b"".join(pending))
+                pending.clear()
+                pending_size = 0
+        if pending:
+            await run_in_threadpool(parser.write, b"".join(pending))
+        parser.finalize()
+    except HTTPException:
+        await run_in_threadpool(sink.abort)
+        raise
+    except MultipartParseError as e:
+        await run_in_threadpool(sink.abort)
+        raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+    except Exception as e:
+        logger.error(f"Error streaming upload: {e}")
+        await run_in_threadpool(sink.abort)
+        raise HTTPException(status_code=500, detail="Error saving file")
+
+    if not sink.completed:
+        await run_in_threadpool(sink.abort)
+        raise HTTPException(status_code=400, detail=f"Missing '{field_name}' file field")
+
+    return StreamedUpload(
+        file_id=sink.file_id,
+        filename=sink.filename,
+        path=sink.path,
+        size=sink.size,
+        sha256=sink.sha256,
+    )
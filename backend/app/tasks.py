@@ -1,25 +1,409 @@
 import os
+import json
 import asyncio
+import shutil
 import subprocess
+import threading
+import time
+import uuid
 import logging
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from celery import current_task
+from typing import Optional
+import redis
+from celery import chain, current_task
 from celery.exceptions import Ignore
 from .celery_app import celery_app
+from .checkpoints import (
+    JobCheckpoint,
+    checkpoint_dir,
+    cleanup_expired_checkpoints,
+    input_fingerprint,
+    render_chunks,
+)
+from .config import settings
+from .cpu_slots import get_slot_pool
+from .decimate import decimate_video, decimation_dir, restore_timing, unique_video
+from .face_gallery import reference_options
+from .facefusion_cli import FACEFUSION_PATH, build_facefusion_command
+from .hls import PLAYLIST_NAME, ProgressiveRenderer, plan_chunks
+from .input_cache import InputIndex, InputRef, create_content_cache
+from .job_logs import JobLog, cleanup_job_logs, job_log_path
+from .media import concat_videos, encode_range, probe_video
+from .profiles import RedisProfileStats, get_profile
+from .ranges import TargetRange, progress_fractions, restrict_chunks, swap_frames
+from .storage import OUTPUTS, UPLOADS, get_storage
+from .templates import TemplateLibrary, plan_template_chunks
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 UPLOAD_DIR = Path("/app/uploads")
 OUTPUT_DIR = Path("/app/outputs")
-FACEFUSION_PATH = Path("/workspace/facefusion")
+
+# 事前計算済みテンプレート（プローブ結果・顔トラック）の共有ライブラリ
+template_library = TemplateLibrary(settings.template_dir, int(settings.template_cache_max_gb * 1024 ** 3))
+
+# 入力はコンテンツのダイジェストで解決し、ワーカーローカルのLRUキャッシュから読む
+# （同じテンプレート・画像を使うジョブは2回目以降ローカルディスクから読める。
+# 索引導入前のアップロードもストレージから同じキャッシュ・同じ容量上限で取得）
+broker_redis = redis.Redis.from_url(celery_app.conf.broker_url)
+input_index = InputIndex(broker_redis, settings.input_index_ttl_hours * 3600)
+content_cache = create_content_cache(input_index)
+
+# プロファイルごとの実測処理速度（APIが受付時の完了見込みに使う）
+profile_stats = RedisProfileStats(broker_redis)
+
+def template_ref(template):
+    """テンプレート動画の InputRef（ダイジェスト未計算の古いテンプレートは None）"""
+    if not template.sha256:
+        return None
+    path = template_library.video_path(template)
+    return InputRef(digest=template.sha256, name=template.video, area="templates", path=str(path))
+
+def find_upload(file_id, held):
+    """
+    アップロード済みファイルのパス（ダイジェスト索引 → 共有ボリューム → ストレージの順に解決）
+    
+    キャッシュ上のファイルは held（ExitStack）が閉じられるまで追い出されない。
+    """
+    try:
+        ref = input_index.lookup(file_id)
+    except redis.RedisError as e:
+        logger.warning(f"入力索引を参照できません: {e}")
+        ref = None
+    if ref is not None:
+        return held.enter_context(content_cache.hold(lambda: content_cache.get(ref)))
+    # 索引導入前のアップロード
+    local_files = list(UPLOAD_DIR.glob(f"{file_id}_*"))
+    if local_files:
+        return local_files[0]
+    storage = get_storage()
+    return held.enter_context(content_cache.hold(lambda: content_cache.find_stored(storage, UPLOADS, f"{file_id}_")))
+
+def resolve_inputs(video_id, image_id, template_id, held):
+    """入力ファイルのパスを解決し (source_image, target_video, template) を返す（held が閉じるまで入力を保持）"""
+    template = None
+    if template_id:
+        template = template_library.get(template_id)
+        if template is None or template.status != "ready":
+            raise Exception("テンプレートが見つからないか準備中です")
+        ref = template_ref(template)
+        if ref:
+            video_file = held.enter_context(content_cache.hold(lambda: content_cache.get(ref)))
+        else:
+            video_file = template_library.video_path(template)
+    else:
+        video_file = find_upload(video_id, held)
+    image_file = find_upload(image_id, held)
+    
+    if not video_file or not image_file:
+        raise Exception("アップロードファイルが見つかりません")
+    return str(image_file), str(video_file), template
+
+@contextmanager
+def execution_slot():
+    """
+    CPUモードではCPUスロットを確保し、このワーカープロセスをそのCPUに固定
+    
+    固定は子プロセス（FaceFusion・ffmpeg）にも継承される。GPUモードでは None を返す。
+    """
+    pool = get_slot_pool()
+    if pool is None:
+        yield None
+        return
+    original_cpus = os.sched_getaffinity(0)
+    with pool.acquire() as lease:
+        lease.slot.pin()
+        try:
+            yield lease
+        finally:
+            os.sched_setaffinity(0, original_cpus)
+
+def execution_options(slot):
+    """build_facefusion_command に渡す実行プロバイダ・スレッド数（GPUモードは既定値）"""
+    return slot.facefusion_options() if slot is not None else {}
+
+def run_facefusion(cmd, job_log: JobLog, timeout=1800, slot=None):
+    """
+    FaceFusionを同期実行し、失敗時は例外を送出
+    
+    出力は全体をメモリに溜めず1行ずつ job_log（直近N行のリングバッファ）へ流し、
+    エラー時は末尾の数行だけを例外メッセージに含める。
+    """
+    process = subprocess.Popen(
+        cmd,
+        cwd=str(FACEFUSION_PATH),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        # スロットのスレッド数に合わせてOpenMP等のスレッドプールを制限
+        env=slot.env() if slot is not None else None,
+    )
+    # タイムアウトしたらプロセスを強制終了
+    watchdog = threading.Timer(timeout, process.kill)
+    watchdog.start()
+    try:
+        for line in process.stdout:
+            job_log.append(line)
+        returncode = process.wait()
+    finally:
+        watchdog.cancel()
+        job_log.flush()
+    
+    if returncode != 0:
+        error_msg = job_log.tail() or "Unknown error"
+        if returncode < 0:
+            error_msg = f"プロセスが終了されました (signal {-returncode})\n{error_msg}"
+        logger.error(f"FaceFusion処理エラー: {error_msg}")
+        raise Exception(f"FaceFusion処理エラー: {error_msg}")
+
+def plan_job(target_video, chunk_seconds, template=None, trim=None):
+    """
+    動画情報とチャンク計画 [(start, end, 顔交換するか)] を返す
+    
+    テンプレートの場合はプローブを省略する。顔のない範囲をFaceFusionに通さないのは
+    template_passthrough が有効な場合のみ（Haarの正面顔検出は横顔・小さい顔を見落とすため）。
+    trim（TargetRange の dict）があれば範囲外を除外、または splice では無加工で残す。
+    """
+    if template is not None and settings.template_passthrough:
+        info, chunks = template.info, plan_template_chunks(template, chunk_seconds)
+    else:
+        info = template.info if template is not None else probe_video(Path(target_video))
+        chunks = [(start, end, True) for start, end in plan_chunks(info.frame_count, info.fps, chunk_seconds)]
+    if trim:
+        target_range = TargetRange(**trim)
+        chunks = restrict_chunks(chunks, target_range.to_frames(info.fps, info.frame_count), target_range.mode)
+    return info, chunks
+
+def join_options(chunks, profile):
+    """無加工チャンクを含む場合は結合時に再エンコード（FaceFusionの出力とタイムベースが一致する保証がないため）"""
+    if all(swap for _, _, swap in chunks):
+        return {}
+    return {"preset": profile.output_video_preset, "crf": profile.crf}
+
+def passthrough_options(profile):
+    """無加工チャンクのエンコード設定（FaceFusionが描画するチャンクと同じエンコーダ・プリセット・品質）"""
+    return {
+        "resolution": profile.output_video_resolution,
+        "encoder": profile.output_video_encoder,
+        "preset": profile.output_video_preset,
+        "crf": profile.crf,
+    }
+
+def trim_fingerprint(trim):
+    """範囲指定はチェックポイントの指紋に含める（同じチャンク境界でも顔交換の有無が変わる）"""
+    return {"trim": json.dumps(trim, sort_keys=True)} if trim else {}
+
+def decimate_target(job_id, target_video, reference=None):
+    """
+    重複フレームを解析し、ユニークなフレームだけの動画を作成
+    
+    (処理対象のパス, レポート, 参照顔) を返す。重複が少なく間引かない場合は元の動画のまま。
+    間引いた動画ではフレーム番号が変わるため、参照顔のフレームも対応するフレームに置き換える。
+    """
+    directory = decimation_dir(OUTPUT_DIR, job_id)
+    report = decimate_video(Path(target_video), directory, settings.decimate_max_diff, settings.decimate_min_ratio)
+    if not report.applied:
+        return target_video, report, reference
+    if reference:
+        reference = {**reference, "frame": report.unique_index(reference["frame"])}
+    return str(unique_video(directory)), report, reference
+
+def reference_fingerprint(reference):
+    """参照顔はチェックポイントの指紋に含める（交換する顔が変わる）"""
+    return {"reference": json.dumps(reference, sort_keys=True)} if reference else {}
+
+def record_throughput(profile, frames, seconds):
+    """FaceFusionの処理速度を記録（失敗してもジョブは続行）"""
+    try:
+        profile_stats.record(profile.name, frames, seconds)
+    except redis.RedisError as e:
+        logger.warning(f"処理速度を記録できません: {e}")
+
+def make_chunk_renderer(
+    source_image, target_video, fps, chunks, job_log, slot=None, extra_args=None, profile=None, reference=None
+):
+    """チャンク描画関数: 顔のある範囲はFaceFusion、顔のない範囲は再エンコードのみ（reference があればその顔だけ交換）"""
+    profile = profile or get_profile()
+    passthrough = {(start, end) for start, end, swap in chunks if not swap}
+    
+    def render_chunk(start, end, chunk_path):
+        if (start, end) in passthrough:
+            encode_range(Path(target_video), start, end, fps, chunk_path, **passthrough_options(profile))
+            return
+        started_at = time.monotonic()
+        run_facefusion(build_facefusion_command(
+            source_image, target_video, str(chunk_path),
+            trim_frame_start=start, trim_frame_end=end, extra_args=extra_args,
+            **profile.facefusion_options(), **reference_options(reference), **execution_options(slot)
+        ), job_log, slot=slot)
+        record_throughput(profile, end - start, time.monotonic() - started_at)
+    
+    return render_chunk
+
+def render_progressive(
+    task, job_id, source_image, target_video, output_path, job_log, template=None, slot=None, trim=None,
+    profile=None, reference=None,
+):
+    """チャンク単位で処理し、HLSセグメントを順次公開してから1本のMP4に結合"""
+    profile = profile or get_profile()
+    info, chunks = plan_job(target_video, settings.progressive_chunk_seconds, template, trim)
+    ranges = [(start, end) for start, end, _ in chunks]
+    fractions = progress_fractions(chunks)
+    playlist_url = f"/api/hls/{job_id}/{PLAYLIST_NAME}"
+    # チャンクは共有ボリュームのチェックポイントに保存し、再配信時は未完了分のみ処理
+    renderer = ProgressiveRenderer(
+        OUTPUT_DIR / job_id,
+        info.fps,
+        settings.progressive_chunk_seconds,
+        checkpoint=JobCheckpoint(checkpoint_dir(OUTPUT_DIR, job_id)),
+    )
+    render_chunk = make_chunk_renderer(
+        source_image, target_video, info.fps, chunks, job_log, slot, profile=profile, reference=reference
+    )
+    
+    def on_segment(done, total):
+        # 30%〜95%を顔交換済みフレーム数に応じて割り当て
+        task.update_state(
+            state="PROGRESS",
+            meta={
+                "current": 30 + int(65 * fractions[done - 1]),
+                "total": 100,
+                "status": f"セグメント {done}/{total} 公開済み",
+                "playlist_url": playlist_url
+            }
+        )
+    
+    task.update_state(
+        state="PROGRESS",
+        meta={"current": 30, "total": 100, "status": "顔交換処理実行中...", "playlist_url": playlist_url}
+    )
+    renderer.run(
+        ranges, render_chunk, Path(output_path), on_segment,
+        fingerprint=input_fingerprint(
+            Path(source_image), Path(target_video), mode="hls", profile=profile.name,
+            **trim_fingerprint(trim), **reference_fingerprint(reference)
+        ),
+        **join_options(chunks, profile),
+    )
+    return playlist_url
+
+def render_checkpointed(
+    task, job_id, source_image, target_video, output_path, job_log, template=None, slot=None, extra_args=None,
+    trim=None, profile=None, decimate=False, reference=None,
+):
+    """
+    チャンク単位で処理し、完了した範囲を共有ボリュームに記録してから結合
+    
+    task_acks_late により落ちたワーカーのタスクは再配信されるため、
+    再実行時は記録済みチャンクを再利用して続きの範囲から処理する。
+    decimate ではユニークなフレームだけを処理し、元のタイミングと音声に戻して出力する。
+    間引きのレポート（行わなかった場合は None）を返す。
+    """
+    profile = profile or get_profile()
+    decimation = None
+    final_path = output_path
+    if decimate and template is None and not trim:
+        task.update_state(state="PROGRESS", meta={"current": 25, "total": 100, "status": "重複フレームを解析中..."})
+        target_video, decimation, reference = decimate_target(job_id, target_video, reference)
+        if decimation.applied:
+            output_path = str(decimation_dir(OUTPUT_DIR, job_id) / "swapped.mp4")
+    info, chunks = plan_job(target_video, settings.checkpoint_chunk_seconds, template, trim)
+    ranges = [(start, end) for start, end, _ in chunks]
+    if not ranges:
+        # フレーム数が取れない場合は一括処理
+        run_facefusion(build_facefusion_command(
+            source_image, target_video, output_path, extra_args=extra_args,
+            **profile.facefusion_options(), **reference_options(reference), **execution_options(slot)
+        ), job_log, slot=slot)
+        return finish_decimation(job_id, decimation, output_path, final_path, profile)
+    
+    checkpoint = JobCheckpoint(checkpoint_dir(OUTPUT_DIR, job_id))
+    # 追加オプションが違えば別の出力になるため指紋に含める
+    options = {"args": " ".join(extra_args)} if extra_args else {}
+    options.update(trim_fingerprint(trim), profile=profile.name, **reference_fingerprint(reference))
+    if decimation is not None and decimation.applied:
+        options["decimate"] = True
+    restored = checkpoint.begin(
+        ranges, input_fingerprint(Path(source_image), Path(target_video), mode="mp4", **options)
+    )
+    if restored:
+        logger.info(f"チェックポイントから再開: job_id={job_id}, {restored}/{len(ranges)} チャンク完了済み")
+    render_chunk = make_chunk_renderer(
+        source_image, target_video, info.fps, chunks, job_log, slot, extra_args, profile, reference
+    )
+    fractions = progress_fractions(chunks)
+    frames = swap_frames(chunks)
+    
+    def on_chunk(index, chunk_path, resumed):
+        # 30%〜80%を顔交換済みフレーム数に応じて割り当て（範囲外・顔なしのチャンクは数えない）
+        task.update_state(
+            state="PROGRESS",
+            meta={
+                "current": 30 + int(50 * fractions[index]),
+                "total": 100,
+                "status": f"チャンク {index + 1}/{len(ranges)} 完了" + ("（再開）" if resumed else ""),
+                "frames": frames
+            }
+        )
+    
+    concat_videos(render_chunks(checkpoint, render_chunk, on_chunk), Path(output_path), **join_options(chunks, profile))
+    # 完了したジョブのチェックポイントは即削除
+    checkpoint.clear()
+    return finish_decimation(job_id, decimation, output_path, final_path, profile)
+
+def finish_decimation(job_id, decimation, swapped_path, output_path, profile):
+    """間引いた動画の処理結果を元のフレーム数・音声に戻し、作業ディレクトリを削除"""
+    if decimation is None:
+        return None
+    directory = decimation_dir(OUTPUT_DIR, job_id)
+    if decimation.applied:
+        restore_timing(directory, Path(swapped_path), Path(output_path), profile.output_video_preset, profile.crf)
+    shutil.rmtree(directory, ignore_errors=True)
+    return decimation.summary()
 
 @celery_app.task(bind=True, name="app.tasks.process_face_swap")
-def process_face_swap(self, job_id: str, video_id: str, image_id: str):
+def process_face_swap(
+    self,
+    job_id: str,
+    video_id: Optional[str],
+    image_id: str,
+    output_mode: str = "mp4",
+    template_id: Optional[str] = None,
+    trim: Optional[dict] = None,
+    profile: Optional[str] = None,
+    decimate: bool = False,
+    reference: Optional[dict] = None,
+):
     """
     Face swap processing task using Celery
+    
+    output_mode="hls" renders the target in chunks and publishes each one
+    as an HLS segment, so playback can start before the render completes.
+    With template_id the target is a promoted template: probing and face
+    detection are skipped and face-free ranges bypass FaceFusion.
+    trim restricts the swap to a time/frame range of the target; profile
+    names the processing profile (default_profile when None). decimate
+    swaps only the unique frames of an mp4 job and re-times the output.
+    reference ({"frame", "position"} from the target's face gallery)
+    restricts the swap to one person.
     """
+    # FaceFusionの出力は直近N行のみ保持し、APIが /api/job/{task_id}/logs で読めるよう共有ボリュームへ書き出す
+    job_log = JobLog(
+        self.request.id or job_id,
+        max_lines=settings.job_log_max_lines,
+        forward_per_second=settings.job_log_forward_per_second,
+        path=job_log_path(OUTPUT_DIR, self.request.id or job_id),
+    )
+    # 入力はレンダリングが終わるまでキャッシュから追い出さない
+    held_inputs = ExitStack()
     try:
+        # 期限切れ（放棄されたジョブ）のチェックポイントを掃除
+        cleanup_expired_checkpoints(OUTPUT_DIR, settings.checkpoint_ttl_hours * 3600)
+        cleanup_job_logs(OUTPUT_DIR, settings.cleanup_interval_hours * 3600)
+        
         # 進捗状況を更新
         self.update_state(
             state="PROGRESS",
@@ -27,14 +411,8 @@ def process_face_swap(self, job_id: str, video_id: str, image_id: str):
         )
         
         # ファイルパスを取得
-        video_files = list(UPLOAD_DIR.glob(f"{video_id}_*"))
-        image_files = list(UPLOAD_DIR.glob(f"{image_id}_*"))
-        
-        if not video_files or not image_files:
-            raise Exception("アップロードファイルが見つかりません")
-        
-        source_image = str(image_files[0])
-        target_video = str(video_files[0])
+        source_image, target_video, template = resolve_inputs(video_id, image_id, template_id, held_inputs)
+        processing_profile = get_profile(profile)
         output_filename = f"{job_id}_output.mp4"
         output_path = str(OUTPUT_DIR / output_filename)
         
@@ -46,62 +424,61 @@ def process_face_swap(self, job_id: str, video_id: str, image_id: str):
             meta={"current": 20, "total": 100, "status": "FaceFusion処理を開始中..."}
         )
         
-        # FaceFusionコマンドを構築
-        cmd = [
-            "python3",
-            str(FACEFUSION_PATH / "facefusion.py"),
-            "headless-run",
-            "--source", source_image,
-            "--target", target_video,
-            "--output-path", output_path,
-            "--execution-providers", "cuda",
-            "--execution-thread-count", "2",
-            "--face-detector-model", "yolo_face",
-            "--face-detector-score", "0.5",
-            "--processors", "face_swapper",
-            "--log-level", "info"
-        ]
+        playlist_url = None
+        cpu_slot = None
+        decimation = None
+        with execution_slot() as lease:
+            slot = lease.slot if lease is not None else None
+            if output_mode == "hls":
+                playlist_url = render_progressive(
+                    self, job_id, source_image, target_video, output_path, job_log, template, slot, trim,
+                    processing_profile, reference,
+                )
+            else:
+                # 進捗状況を更新
+                self.update_state(
+                    state="PROGRESS",
+                    meta={"current": 30, "total": 100, "status": "顔交換処理実行中..."}
+                )
+                
+                # チャンクごとにチェックポイントを残しながら実行（同期処理でCeleryタスク内）
+                decimation = render_checkpointed(
+                    self, job_id, source_image, target_video, output_path, job_log, template, slot,
+                    trim=trim, profile=processing_profile, decimate=decimate, reference=reference,
+                )
+            if lease is not None:
+                # ジョブ実行中のスロットCPU使用率
+                cpu_slot = {"slot": slot.index, "cpus": slot.cpus, "utilization": lease.utilization()}
+                logger.info(f"CPUスロット {slot.index} 使用率: {cpu_slot['utilization']:.0%}")
         
         # 進捗状況を更新
         self.update_state(
             state="PROGRESS",
-            meta={"current": 30, "total": 100, "status": "顔交換処理実行中..."}
-        )
-        
-        # プロセスを実行（同期処理でCeleryタスク内）
-        process = subprocess.run(
-            cmd,
-            cwd=str(FACEFUSION_PATH),
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30分のタイムアウト
-        )
-        
-        # 進捗状況を更新
-        self.update_state(
-            state="PROGRESS",
-            meta={"current": 80, "total": 100, "status": "処理結果を確認中..."}
+            meta={"current": 80, "total": 100, "status": "処理結果を確認中...", "playlist_url": playlist_url}
         )
         
         # 結果を確認
-        if process.returncode == 0 and os.path.exists(output_path):
-            # 成功
+        if os.path.exists(output_path):
+            # 成功（オブジェクトストレージ利用時は大きな出力をマルチパートでアップロード）
+            get_storage().put(OUTPUTS, output_filename, Path(output_path))
             logger.info(f"処理完了: {output_path}")
             self.update_state(
                 state="PROGRESS",
-                meta={"current": 100, "total": 100, "status": "処理完了"}
+                meta={"current": 100, "total": 100, "status": "処理完了", "playlist_url": playlist_url}
             )
             
             return {
                 "status": "completed",
                 "output_url": f"/api/download/{output_filename}",
+                "playlist_url": playlist_url,
+                "cpu_slot": cpu_slot,
+                "decimation": decimation,
                 "message": "顔交換処理が正常に完了しました"
             }
         else:
             # エラー
-            error_msg = process.stderr if process.stderr else "Unknown error"
-            logger.error(f"FaceFusion処理エラー: {error_msg}")
-            raise Exception(f"FaceFusion処理エラー: {error_msg}")
+            logger.error(f"FaceFusion処理エラー: 出力ファイルがありません {output_path}")
+            raise Exception("FaceFusion処理エラー: 出力ファイルが生成されませんでした")
             
     except Exception as e:
         logger.error(f"顔交換処理エラー: {e}")
@@ -109,4 +486,337 @@ def process_face_swap(self, job_id: str, video_id: str, image_id: str):
             state="FAILURE",
             meta={"error": str(e)}
         )
-        raise Ignore()
\ No newline at end of file
+        raise Ignore()
+    finally:
+        held_inputs.close()
+
+
+def stage_input(path, directory):
+    """共有ボリューム外（ワーカーのローカルキャッシュ）の入力をジョブディレクトリへ複製"""
+    path = Path(path)
+    shared_roots = (UPLOAD_DIR, template_library.root)
+    if any(root in path.parents for root in shared_roots):
+        return str(path)
+    target = directory / "inputs" / path.name
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if not target.exists():
+        # 同じファイルシステム上ならハードリンク（キャッシュから追い出されても残る）
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+    return str(target)
+
+def stage_timings(plan):
+    """各ステージの処理時間と、ステージ間のキュー待ち時間の合計（秒）"""
+    stages = plan["stages"]
+    timings = {name: round(stage["finished_at"] - stage["started_at"], 3) for name, stage in stages.items()}
+    ordered = sorted(stages.values(), key=lambda stage: stage["started_at"])
+    timings["queued"] = round(sum(
+        max(0.0, later["started_at"] - earlier["finished_at"]) for earlier, later in zip(ordered, ordered[1:])
+    ), 3)
+    return timings
+
+def fail_pipeline(task, plan_task_id, error):
+    """ステージの失敗をジョブのタスクIDに記録（以降のステージは実行されない）"""
+    logger.error(f"顔交換処理エラー: {error}")
+    task.update_state(task_id=plan_task_id, state="FAILURE", meta={"error": str(error)})
+    raise Ignore()
+
+def start_face_swap(
+    job_id, video_id, image_id, output_mode="mp4", template_id=None, trim=None, profile=None, decimate=False,
+    reference=None, task_id=None,
+):
+    """
+    ジョブを投入し、状態問い合わせ用のタスクIDを返す
+    
+    staged_pipeline では 準備(media) → 顔交換(face_swap) → エンコード(media) のチェーンとして投入し、
+    最終ステージのタスクIDを全ステージの進捗の記録先にする。
+    task_id を渡すとそのIDで投入する（受付時に確保した枠と対応させるため）。
+    """
+    task_id = task_id or str(uuid.uuid4())
+    if not settings.staged_pipeline:
+        return process_face_swap.apply_async(
+            (job_id, video_id, image_id, output_mode, template_id, trim, profile, decimate, reference),
+            task_id=task_id,
+        ).id
+    chain(
+        prepare_job.s(
+            task_id, job_id, video_id, image_id, output_mode, template_id, trim, profile, decimate, reference
+        ),
+        swap_job.s(),
+        finalize_job.s().set(task_id=task_id),
+    ).apply_async()
+    return task_id
+
+@celery_app.task(bind=True, name="app.tasks.prepare_job")
+def prepare_job(
+    self, task_id, job_id, video_id, image_id, output_mode="mp4", template_id=None, trim=None, profile=None,
+    decimate=False, reference=None,
+):
+    """
+    CPUステージ: 入力の解決・プローブ・チャンク計画と、顔のない範囲の再エンコード
+    
+    decimate（mp4・範囲指定なしのアップロード動画）では重複フレームを間引いた動画を計画の対象にする。
+    
+    成果物（チャンクと計画）は共有ボリュームのチェックポイントに置き、計画を次のステージへ渡す。
+    """
+    started_at = time.time()
+    # 入力はジョブディレクトリへ複製し終えるまで保持
+    held_inputs = ExitStack()
+    try:
+        cleanup_expired_checkpoints(OUTPUT_DIR, settings.checkpoint_ttl_hours * 3600)
+        cleanup_job_logs(OUTPUT_DIR, settings.cleanup_interval_hours * 3600)
+        self.update_state(
+            task_id=task_id,
+            state="PROGRESS",
+            meta={"current": 5, "total": 100, "status": "入力を準備中...", "stage": "prepare"}
+        )
+        
+        source_image, target_video, template = resolve_inputs(video_id, image_id, template_id, held_inputs)
+        processing_profile = get_profile(profile)
+        decimation = None
+        if decimate and output_mode == "mp4" and template is None and not trim:
+            self.update_state(
+                task_id=task_id,
+                state="PROGRESS",
+                meta={"current": 8, "total": 100, "status": "重複フレームを解析中...", "stage": "prepare"}
+            )
+            target_video, decimation, reference = decimate_target(job_id, target_video, reference)
+        chunk_seconds = settings.progressive_chunk_seconds if output_mode == "hls" else settings.checkpoint_chunk_seconds
+        info, chunks = plan_job(target_video, chunk_seconds, template, trim)
+        if not chunks:
+            raise Exception("動画のフレーム数を取得できません")
+        ranges = [(start, end) for start, end, _ in chunks]
+        fingerprint = input_fingerprint(
+            Path(source_image), Path(target_video), mode=output_mode, staged=True,
+            profile=processing_profile.name, **trim_fingerprint(trim), **reference_fingerprint(reference)
+        )
+        
+        checkpoint = JobCheckpoint(checkpoint_dir(OUTPUT_DIR, job_id))
+        restored = checkpoint.begin(ranges, fingerprint)
+        if restored:
+            logger.info(f"チェックポイントから再開: job_id={job_id}, {restored}/{len(ranges)} チャンク完了済み")
+        source_image = stage_input(source_image, checkpoint.directory)
+        target_video = stage_input(target_video, checkpoint.directory)
+        
+        # 顔のない範囲はGPUを使わないのでこのステージで処理
+        for index, (start, end, swap) in enumerate(chunks):
+            if swap or checkpoint.is_done(index):
+                continue
+            encode_range(
+                Path(target_video), start, end, info.fps, checkpoint.chunk_path(index),
+                **passthrough_options(intermediate_profile(processing_profile.name)),
+            )
+            checkpoint.mark_done(index)
+        
+        return {
+            "task_id": task_id,
+            "job_id": job_id,
+            "output_mode": output_mode,
+            "profile": processing_profile.name,
+            "reference": reference,
+            "source_image": source_image,
+            "target_video": target_video,
+            "fps": info.fps,
+            "chunks": chunks,
+            "frames": swap_frames(chunks),
+            "decimation": decimation.summary() if decimation is not None else None,
+            "fingerprint": fingerprint,
+            "chunk_seconds": chunk_seconds,
+            "stages": {"prepare": {"started_at": started_at, "finished_at": time.time()}},
+        }
+    except Exception as e:
+        fail_pipeline(self, task_id, e)
+    finally:
+        held_inputs.close()
+
+def intermediate_profile(name=None):
+    """GPUステージ用のプロファイル: 最終エンコードはCPUステージで行うため、中間チャンクは軽いプリセットで出力"""
+    return get_profile(name).model_copy(update={"output_video_preset": settings.pipeline_intermediate_preset})
+
+@celery_app.task(bind=True, name="app.tasks.swap_job")
+def swap_job(self, plan):
+    """GPUステージ: 顔のある範囲だけFaceFusionで処理（HLSはチャンクごとにセグメント公開）"""
+    started_at = time.time()
+    task_id = plan["task_id"]
+    job_id = plan["job_id"]
+    job_log = JobLog(
+        task_id,
+        max_lines=settings.job_log_max_lines,
+        forward_per_second=settings.job_log_forward_per_second,
+        path=job_log_path(OUTPUT_DIR, task_id),
+    )
+    chunks = [tuple(chunk) for chunk in plan["chunks"]]
+    ranges = [(start, end) for start, end, _ in chunks]
+    fractions = progress_fractions(chunks)
+    checkpoint = JobCheckpoint(checkpoint_dir(OUTPUT_DIR, job_id))
+    playlist_url = f"/api/hls/{job_id}/{PLAYLIST_NAME}" if plan["output_mode"] == "hls" else None
+    
+    def on_chunk(index, chunk_path=None, resumed=False):
+        # 10%〜80%を顔交換済みフレーム数に応じて割り当て
+        self.update_state(
+            task_id=task_id,
+            state="PROGRESS",
+            meta={
+                "current": 10 + int(70 * fractions[index]),
+                "total": 100,
+                "status": f"チャンク {index + 1}/{len(ranges)} 完了",
+                "stage": "swap",
+                "playlist_url": playlist_url,
+                "frames": plan.get("frames")
+            }
+        )
+    
+    try:
+        with execution_slot() as lease:
+            slot = lease.slot if lease is not None else None
+            render_chunk = make_chunk_renderer(
+                plan["source_image"], plan["target_video"], plan["fps"], chunks, job_log, slot,
+                profile=intermediate_profile(plan.get("profile")), reference=plan.get("reference"),
+            )
+            if playlist_url:
+                renderer = ProgressiveRenderer(
+                    OUTPUT_DIR / job_id, plan["fps"], plan["chunk_seconds"], checkpoint=checkpoint
+                )
+                renderer.render(ranges, render_chunk, lambda done, total: on_chunk(done - 1), plan["fingerprint"])
+            else:
+                checkpoint.begin(ranges, plan["fingerprint"])
+                render_chunks(checkpoint, render_chunk, on_chunk)
+        plan["stages"]["swap"] = {"started_at": started_at, "finished_at": time.time()}
+        plan["playlist_url"] = playlist_url
+        return plan
+    except Exception as e:
+        fail_pipeline(self, task_id, e)
+
+@celery_app.task(bind=True, name="app.tasks.finalize_job")
+def finalize_job(self, plan):
+    """CPUステージ: チャンクを結合して最終エンコードし、出力を公開"""
+    started_at = time.time()
+    job_id = plan["job_id"]
+    try:
+        self.update_state(
+            state="PROGRESS",
+            meta={"current": 85, "total": 100, "status": "エンコード中...", "stage": "encode",
+                  "playlist_url": plan.get("playlist_url")}
+        )
+        checkpoint = JobCheckpoint(checkpoint_dir(OUTPUT_DIR, job_id))
+        chunk_paths = [checkpoint.chunk_path(index) for index in range(len(plan["chunks"]))]
+        output_filename = f"{job_id}_output.mp4"
+        output_path = OUTPUT_DIR / output_filename
+        # 最終エンコードはプロファイルのプリセット・品質で行う
+        profile = get_profile(plan.get("profile"))
+        decimation = plan.get("decimation")
+        if decimation and decimation["applied"]:
+            # 間引いたフレームを複製して元のタイミングに戻し、元の音声を付ける
+            joined_path = checkpoint.directory / "joined.mp4"
+            concat_videos(chunk_paths, joined_path)
+            restore_timing(
+                decimation_dir(OUTPUT_DIR, job_id), joined_path, output_path, profile.output_video_preset, profile.crf
+            )
+        else:
+            # 結合と同時に再エンコード（無加工チャンクとFaceFusionのチャンクでタイムベースが違っても安全）
+            concat_videos(chunk_paths, output_path, preset=profile.output_video_preset, crf=profile.crf)
+        get_storage().put(OUTPUTS, output_filename, output_path)
+        checkpoint.clear()
+        shutil.rmtree(decimation_dir(OUTPUT_DIR, job_id), ignore_errors=True)
+        
+        plan["stages"]["encode"] = {"started_at": started_at, "finished_at": time.time()}
+        timings = stage_timings(plan)
+        logger.info(f"処理完了: {output_path} ステージ別時間(秒) {timings}")
+        return {
+            "status": "completed",
+            "output_url": f"/api/download/{output_filename}",
+            "playlist_url": plan.get("playlist_url"),
+            "timings": timings,
+            "frames": plan.get("frames"),
+            "decimation": plan.get("decimation"),
+            "message": "顔交換処理が正常に完了しました"
+        }
+    except Exception as e:
+        fail_pipeline(self, self.request.id, e)
+
+
+@contextmanager
+def exclusive_job(job_id, ttl=60):
+    """
+    同じ job_id を複数のワーカーが同時に処理しないためのRedisロック
+    
+    処理中は ttl/3 ごとに延長し、ワーカーが落ちればロックは ttl 後に切れる。
+    同じチェックポイント・一時ファイルへの書き込みが重ならないよう、取得できなければ失敗させる。
+    """
+    lock = broker_redis.lock(f"bulk:running:{job_id}", timeout=ttl)
+    if not lock.acquire(blocking=False):
+        raise Exception(f"ジョブ {job_id} は別のワーカーで処理中です")
+    stop = threading.Event()
+    
+    def keep_alive():
+        while not stop.wait(ttl / 3):
+            try:
+                lock.extend(ttl, replace_ttl=True)
+            except redis.RedisError as e:
+                logger.warning(f"ジョブ {job_id} のロックを延長できません: {e}")
+    
+    thread = threading.Thread(target=keep_alive, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        try:
+            lock.release()
+        except redis.RedisError as e:
+            logger.warning(f"ジョブ {job_id} のロックを解放できません: {e}")
+
+def render_to_outputs(task, job_id, source_image, target_video, outputs, job_log, slot=None, extra_args=None):
+    """
+    1回の処理結果を複数の出力パスへ書き出す（一括処理で同一入力の行をまとめた場合）
+    
+    一時ファイルに書いてから置き換えるため、出力パスが存在すれば完成品とみなせる。
+    """
+    outputs = [Path(output) for output in outputs]
+    partial_path = outputs[0].with_name(f".{outputs[0].stem}.partial{outputs[0].suffix}")
+    partial_path.parent.mkdir(parents=True, exist_ok=True)
+    render_checkpointed(
+        task, job_id, source_image, target_video, str(partial_path), job_log, slot=slot, extra_args=extra_args
+    )
+    if not partial_path.exists():
+        raise Exception("FaceFusion処理エラー: 出力ファイルが生成されませんでした")
+    for output in outputs[1:]:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output.with_name(f".{output.stem}.partial{output.suffix}")
+        shutil.copyfile(partial_path, tmp_path)
+        os.replace(tmp_path, output)
+    os.replace(partial_path, outputs[0])
+
+@celery_app.task(bind=True, name="app.tasks.bulk_face_swap")
+def bulk_face_swap(self, job_id, source_image, target_video, outputs, extra_args=None):
+    """一括処理CLI（app.bulk）用: 共有ボリューム上のパスを直接指定して処理"""
+    job_log = JobLog(
+        job_id,
+        max_lines=settings.job_log_max_lines,
+        forward_per_second=settings.job_log_forward_per_second,
+        path=job_log_path(OUTPUT_DIR, job_id),
+    )
+    # 中断後の再実行で同じ job_id が再投入されても、処理中のものとは重ならない
+    with exclusive_job(job_id), execution_slot() as lease:
+        render_to_outputs(
+            self, job_id, source_image, target_video, outputs, job_log,
+            slot=lease.slot if lease is not None else None, extra_args=extra_args
+        )
+    return {"status": "completed", "outputs": outputs}
+
+
+@celery_app.task(name="app.tasks.build_template")
+def build_template(template_id: str):
+    """テンプレートのプローブ結果と顔トラックを事前計算"""
+    template = template_library.build(
+        template_id, sample_fps=settings.template_face_sample_fps, pad_seconds=settings.template_face_pad_seconds
+    )
+    ref = template_ref(template)
+    if ref is not None:
+        # 他ノードのワーカーがHTTP経由で取得できるよう索引に登録
+        input_index.record(ref)
+    logger.info(f"テンプレート作成: {template_id} status={template.status}, 顔あり {template.face_frames} フレーム")
+    return template.status
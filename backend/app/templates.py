@@ -0,0 +1,235 @@
+import json
+import os
+import shutil
+import time
+import uuid
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+from pydantic import BaseModel
+
+from .checkpoints import FrameRange
+from .face_detect import detect_faces
+from .input_cache import file_sha256
+from .media import VideoInfo, probe_video
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_META = "template.json"
+FACE_TRACK = "faces.json"
+LAST_USED_MARKER = ".last_used"
+
+# A chunk of a template render: (start_frame, end_frame, needs_swap)
+TemplateChunk = Tuple[int, int, bool]
+
+
+class TemplateInfo(BaseModel):
+    template_id: str
+    name: str
+    video: str
+    status: str  # building | ready | failed
+    info: Optional[VideoInfo] = None
+    sample_step: int = 1
+    face_ranges: List[FrameRange] = []
+    face_frames: int = 0
+    size_bytes: int = 0
+    sha256: Optional[str] = None  # Video digest, for worker input caches
+    created_at: float
+    error: Optional[str] = None
+
+
+def scan_faces(video_path: Path, info: VideoInfo, sample_fps: float) -> Tuple[int, Dict[int, list]]:
+    """Detect faces on frames sampled at ``sample_fps``; returns (step, {frame: boxes})"""
+    step = max(1, int(round(info.fps / sample_fps))) if sample_fps > 0 else 1
+    capture = cv2.VideoCapture(str(video_path))
+    boxes: Dict[int, list] = {}
+    frame_index = 0
+    try:
+        while True:
+            # grab() skips the decode-to-BGR cost on frames we don't sample
+            if not capture.grab():
+                break
+            if frame_index % step == 0:
+                ok, frame = capture.retrieve()
+                if ok:
+                    boxes[frame_index] = [list(box) for box in detect_faces(frame)]
+            frame_index += 1
+    finally:
+        capture.release()
+    return step, boxes
+
+
+def face_ranges(boxes: Dict[int, list], step: int, frame_count: int, pad_frames: int) -> List[FrameRange]:
+    """Merge sampled frames with faces into padded ``[start, end)`` ranges.
+
+    A sample stands for the ``step`` frames after it; padding absorbs
+    detector misses and faces entering between samples.
+    """
+    ranges: List[FrameRange] = []
+    for frame in sorted(f for f, faces in boxes.items() if faces):
+        start = max(0, frame - pad_frames)
+        end = min(frame_count, frame + step + pad_frames)
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def plan_template_chunks(
+    template: TemplateInfo,
+    chunk_seconds: float,
+    min_passthrough_seconds: float = 1.0,
+) -> List[TemplateChunk]:
+    """Chunks covering the whole template; only ranges with faces need FaceFusion.
+
+    Face-free gaps shorter than ``min_passthrough_seconds`` are swapped anyway,
+    since an extra chunk boundary costs more than the frames it saves.
+    """
+    info = template.info
+    chunk_frames = max(1, int(round(chunk_seconds * info.fps)))
+    min_gap = int(round(min_passthrough_seconds * info.fps))
+
+    spans: List[TemplateChunk] = []
+    cursor = 0
+    for start, end in template.face_ranges:
+        if start - cursor >= min_gap:
+            spans.append((cursor, start, False))
+        elif spans and spans[-1][2]:
+            start = spans.pop()[0]
+        else:
+            start = cursor
+        spans.append((start, end, True))
+        cursor = end
+    if cursor < info.frame_count:
+        if info.frame_count - cursor >= min_gap or not spans:
+            spans.append((cursor, info.frame_count, False))
+        else:
+            spans[-1] = (spans[-1][0], info.frame_count, spans[-1][2])
+
+    # Both kinds are split to chunk size so checkpoints and HLS segments stay small
+    return [
+        (chunk_start, min(chunk_start + chunk_frames, end), swap)
+        for start, end, swap in spans
+        for chunk_start in range(start, end, chunk_frames)
+    ]
+
+
+class TemplateLibrary:
+    """Template videos with precomputed probe metadata and face tracks.
+
+    Each template lives in its own directory under ``root``; a marker file's
+    mtime records its last use, and the least recently used templates are
+    evicted once the library exceeds ``max_bytes``.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, protect_seconds: float = 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.protect_seconds = protect_seconds
+
+    def template_dir(self, template_id: str) -> Path:
+        return self.root / template_id
+
+    def _write(self, template: TemplateInfo):
+        directory = self.template_dir(template.template_id)
+        tmp_path = directory / f".{TEMPLATE_META}.tmp"
+        tmp_path.write_text(template.model_dump_json())
+        os.replace(tmp_path, directory / TEMPLATE_META)
+
+    def create(self, name: str, video_path: Path) -> TemplateInfo:
+        """Register a template in ``building`` state, copying the video into the library"""
+        template_id = uuid.uuid4().hex
+        directory = self.template_dir(template_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        video_name = f"video{video_path.suffix.lower()}"
+        try:
+            os.link(video_path, directory / video_name)
+        except OSError:
+            shutil.copy2(video_path, directory / video_name)
+        template = TemplateInfo(
+            template_id=template_id,
+            name=name,
+            video=video_name,
+            status="building",
+            created_at=time.time(),
+        )
+        self._write(template)
+        (directory / LAST_USED_MARKER).touch()
+        return template
+
+    def build(self, template_id: str, sample_fps: float = 5.0, pad_seconds: float = 0.5) -> TemplateInfo:
+        """Probe the video and precompute its face track (blocking)"""
+        template = self.get(template_id, touch=False)
+        if template is None:
+            raise KeyError(template_id)
+        directory = self.template_dir(template_id)
+        video_path = directory / template.video
+        try:
+            template.sha256 = file_sha256(video_path)
+            info = probe_video(video_path)
+            step, boxes = scan_faces(video_path, info, sample_fps)
+            (directory / FACE_TRACK).write_text(json.dumps({"step": step, "boxes": boxes}))
+            template.info = info
+            template.sample_step = step
+            template.face_ranges = face_ranges(boxes, step, info.frame_count, int(round(pad_seconds * info.fps)))
+            template.face_frames = sum(end - start for start, end in template.face_ranges)
+            template.status = "ready"
+        except Exception as e:
+            template.status = "failed"
+            template.error = str(e)
+            logger.error(f"Template {template_id} build failed: {e}")
+        template.size_bytes = sum(p.stat().st_size for p in directory.iterdir() if p.is_file())
+        self._write(template)
+        self.evict(keep=template_id)
+        return template
+
+    def get(self, template_id: str, touch: bool = True) -> Optional[TemplateInfo]:
+        directory = self.template_dir(Path(template_id).name)
+        try:
+            template = TemplateInfo.model_validate_json((directory / TEMPLATE_META).read_text())
+        except (OSError, ValueError):
+            return None
+        if touch:
+            (directory / LAST_USED_MARKER).touch()
+        return template
+
+    def video_path(self, template: TemplateInfo) -> Path:
+        return self.template_dir(template.template_id) / template.video
+
+    def face_track(self, template_id: str) -> Optional[dict]:
+        try:
+            return json.loads((self.template_dir(template_id) / FACE_TRACK).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def list(self) -> List[TemplateInfo]:
+        if not self.root.is_dir():
+            return []
+        templates = [self.get(d.name, touch=False) for d in self.root.iterdir() if d.is_dir()]
+        return sorted((t for t in templates if t), key=lambda t: t.created_at)
+
+    def _last_used(self, template_id: str) -> float:
+        try:
+            return (self.template_dir(template_id) / LAST_USED_MARKER).stat().st_mtime
+        except OSError:
+            return 0.0
+
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        """Delete least recently used templates until the library fits ``max_bytes``"""
+        templates = self.list()
+        total = sum(t.size_bytes for t in templates)
+        evicted = []
+        now = time.time()
+        for template in sorted(templates, key=lambda t: self._last_used(t.template_id)):
+            if total <= self.max_bytes:
+                break
+            if template.template_id == keep or now - self._last_used(template.template_id) < self.protect_seconds:
+                continue
+            shutil.rmtree(self.template_dir(template.template_id), ignore_errors=True)
+            total -= template.size_bytes
+            evicted.append(template.template_id)
+            logger.info(f"Evicted template {template.template_id} ({template.name})")
+        return evicted
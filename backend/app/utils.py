@@ -0,0 +1,13 @@
+import os
+import re
+
+# Anything but word characters, whitespace, dots and dashes
+_UNSAFE_CHARS = re.compile(r'[^\w\s.-]')
+
+
+def sanitize_filename(filename: str) -> str:
+    """Sanitize filename to prevent path traversal attacks"""
+    # Remove any path separators and special characters
+    filename = os.path.basename(filename)
+    filename = _UNSAFE_CHARS.sub('', filename)
+    return filename[:255]  # Limit filename length
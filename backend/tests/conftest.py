@@ -0,0 +1,98 @@
+import json
+import timeit
+from pathlib import Path
+
+import pytest
+
+BASELINE_PATH = Path(__file__).with_name("benchmarks.json")
+_runner_key = pytest.StashKey["BenchmarkRunner"]()
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmarks")
+    group.addoption(
+        "--benchmark",
+        choices=("off", "report", "check", "save"),
+        default="off",
+        help="Run tests/test_benchmarks.py: report timings, fail on regressions against "
+             "tests/benchmarks.json (check), or record new baselines (save)",
+    )
+    group.addoption(
+        "--benchmark-threshold",
+        type=float,
+        default=1.0,
+        help="Slowdown over the baseline tolerated by --benchmark=check (1.0 = up to 2x); "
+             "the regressions it guards against are order-of-magnitude, timer noise is not",
+    )
+
+
+def calibrate() -> float:
+    """Seconds per call of a fixed pure-Python workload.
+
+    Results are stored relative to this, so baselines recorded on one
+    machine remain comparable on a faster or slower one.
+    """
+    return min(timeit.repeat(lambda: sum(i * i for i in range(10_000)), number=20, repeat=5)) / 20
+
+
+class BenchmarkRunner:
+    """Times hot paths and compares them with the stored baselines"""
+
+    def __init__(self, mode: str, threshold: float):
+        self.mode = mode
+        self.threshold = threshold
+        self.unit = calibrate()
+        self.baselines = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+        self.results = {}
+
+    def __call__(self, name: str, fn, number: int = 100, repeat: int = 5) -> float:
+        """Best-of-``repeat`` seconds per call of ``fn``"""
+        seconds = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+        relative = seconds / self.unit
+        self.results[name] = {"seconds": seconds, "relative": float(f"{relative:.4g}")}
+        baseline = self.baselines.get(name)
+        if self.mode == "check" and baseline:
+            slowdown = relative / baseline["relative"]
+            if slowdown > 1 + self.threshold:
+                pytest.fail(
+                    f"{name} regressed: {seconds * 1e6:.1f}us per call, {slowdown:.2f}x its baseline "
+                    f"(tolerated {1 + self.threshold:.2f}x)"
+                )
+        return seconds
+
+    def save(self):
+        baselines = {**self.baselines, **{
+            name: {"relative": result["relative"]} for name, result in self.results.items()
+        }}
+        BASELINE_PATH.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture
+def benchmark(request):
+    mode = request.config.getoption("--benchmark")
+    if mode == "off":
+        pytest.skip("benchmarks run with --benchmark=report|check|save")
+    runner = request.config.stash.get(_runner_key, None)
+    if runner is None:
+        runner = BenchmarkRunner(mode, request.config.getoption("--benchmark-threshold"))
+        request.config.stash[_runner_key] = runner
+    return runner
+
+
+def pytest_sessionfinish(session):
+    runner = session.config.stash.get(_runner_key, None)
+    if runner is not None and runner.mode == "save":
+        runner.save()
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    runner = config.stash.get(_runner_key, None)
+    if runner is None or not runner.results:
+        return
+    terminalreporter.section("benchmarks")
+    for name, result in sorted(runner.results.items()):
+        baseline = runner.baselines.get(name)
+        change = f"{result['relative'] / baseline['relative']:.2f}x baseline" if baseline else "no baseline"
+        terminalreporter.write_line(f"{name:<45} {result['seconds'] * 1e6:>12.1f}us  {change}")
+    if runner.mode == "save":
+        terminalreporter.write_line(f"baselines written to {BASELINE_PATH}")
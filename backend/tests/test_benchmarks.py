@@ -0,0 +1,130 @@
+import asyncio
+import itertools
+import os
+import sys
+import uuid
+
+import pytest
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from starlette.requests import Request
+
+from app.job_status_cache import status_etag
+from app.main_improved import ConnectionManager, JobStatus, JobStore
+from app.previews import find_media
+from app.streaming_upload import stream_upload_to_disk
+from app.utils import sanitize_filename
+
+# Hot-path microbenchmarks; skipped unless run with --benchmark (see conftest.py):
+#   pytest tests/test_benchmarks.py --benchmark=report   timings only
+#   pytest tests/test_benchmarks.py --benchmark=check    fail on regressions
+#   pytest tests/test_benchmarks.py --benchmark=save     record new baselines
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def make_job(job_id: str, status: str = "completed") -> JobStatus:
+    return JobStatus(job_id=job_id, status=status, progress=100, output_url=f"/api/download/{job_id}_output.mp4")
+
+
+def test_sanitize_filename(benchmark):
+    benchmark("sanitize_filename", lambda: sanitize_filename("../uploads/holiday video (final) #2.mp4"), number=20000)
+
+
+def test_job_store_with_many_jobs(benchmark):
+    store = JobStore(ttl_hours=24)
+    for index in range(10_000):
+        store.add_job(f"job-{index}", make_job(f"job-{index}"))
+    job = make_job("new")
+    ids = itertools.count()
+
+    benchmark("job_store.add_job[10k jobs]", lambda: store.add_job(f"new-{next(ids)}", job), number=2000)
+    benchmark("job_store.get_job[10k jobs]", lambda: store.get_job("job-5000"), number=20000)
+    benchmark("job_store.update_job[10k jobs]", lambda: store.update_job("job-5000", job), number=20000)
+
+
+class FakeWebSocket:
+    """Accepts every message after a network-like delay"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_text(self, message: str):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+def test_broadcast_fanout(benchmark, loop):
+    manager = ConnectionManager()
+    sockets = [FakeWebSocket(latency=0.001) for _ in range(200)]
+    for index, websocket in enumerate(sockets):
+        manager.active_connections[f"client-{index}"] = websocket
+    message = '{"type": "job_update", "job_id": "x", "status": "processing", "progress": 50}'
+
+    benchmark("broadcast[200 sockets, 1ms]", lambda: loop.run_until_complete(manager.broadcast(message)), number=5)
+    assert all(websocket.sent >= 5 for websocket in sockets)
+
+
+def multipart_request(body: bytes, boundary: str, chunk_size: int = 64 * 1024) -> Request:
+    chunks = [body[offset:offset + chunk_size] for offset in range(0, len(body), chunk_size)]
+
+    async def receive():
+        if chunks:
+            return {"type": "http.request", "body": chunks.pop(0), "more_body": bool(chunks)}
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/upload/video",
+        "headers": [
+            (b"content-type", f"multipart/form-data; boundary={boundary}".encode()),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+    return Request(scope, receive)
+
+
+def test_save_upload_file_throughput(benchmark, loop, tmp_path):
+    boundary = "benchmarkboundary"
+    payload = os.urandom(16 * 1024 * 1024)
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"clip.mp4\"\r\n"
+        f"Content-Type: video/mp4\r\n\r\n"
+    ).encode() + payload + f"\r\n--{boundary}--\r\n".encode()
+
+    def upload():
+        request = multipart_request(body, boundary)
+        upload = loop.run_until_complete(stream_upload_to_disk(request, tmp_path, [".mp4"], 100 * 1024 * 1024))
+        upload.path.unlink()
+
+    benchmark("save_upload_file[16MB]", upload, number=3)
+
+
+def test_status_serialization(benchmark):
+    payload = make_job(str(uuid.uuid4()), status="processing").dict()
+
+    def serialize():
+        status_etag(payload)
+        return JSONResponse(content=jsonable_encoder(payload)).body
+
+    benchmark("status_serialization", serialize, number=5000)
+
+
+def test_upload_lookup_large_directory(benchmark, tmp_path):
+    file_ids = [str(uuid.uuid4()) for _ in range(10_000)]
+    for file_id in file_ids:
+        (tmp_path / f"{file_id}_clip.mp4").touch()
+
+    assert find_media("upload", file_ids[5000], tmp_path, tmp_path) is not None
+    benchmark("upload_lookup[10k files]", lambda: find_media("upload", file_ids[5000], tmp_path, tmp_path), number=20)
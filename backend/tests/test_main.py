@@ -38,6 +38,191 @@ def test_health_check():
     assert response.status_code == 200
     assert response.json()["status"] == "healthy"
 
+def test_health_reports_circuit_state():
+    """Test health check exposes FaceFusion circuit breaker state"""
+    response = client.get("/health")
+    facefusion = response.json()["facefusion"]
+    assert facefusion["available"] is True
+    assert facefusion["backends"][0]["state"] == "closed"
+
+def test_circuit_breaker_opens_and_recovers():
+    """Test breaker fails fast after threshold and lets one probe through"""
+    from app.resilience import CircuitBreaker
+    
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    
+    breaker.reset_timeout = 0
+    assert breaker.allow_request()  # half-open probe
+    assert not breaker.allow_request()  # only one probe at a time
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+def test_cancelled_probe_releases_half_open_breaker():
+    """Test a half-open probe cancelled mid-flight (e.g. by hedging) lets the next probe through"""
+    import asyncio
+    import httpx
+    from app import facefusion_client
+    
+    async def run():
+        started = asyncio.Event()
+        
+        async def hang(*args, **kwargs):
+            started.set()
+            await asyncio.sleep(60)
+        
+        async with facefusion_client.FaceFusionClient(base_url="http://ff:7860") as client:
+            client.client = Mock(request=hang)
+            backend = client.pool.backends[0]
+            for _ in range(backend.breaker.failure_threshold):
+                backend.breaker.record_failure()
+            backend.breaker.reset_timeout = 0
+            probe = asyncio.create_task(client._send(backend, "GET", "/health"))
+            await started.wait()
+            assert not backend.breaker.allow_request()
+            probe.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+            return backend
+    
+    backend = asyncio.run(run())
+    assert backend.outstanding == 0
+    assert backend.breaker.state == "half_open"
+    assert backend.breaker.allow_request()
+
+def test_backend_pool_least_outstanding():
+    """Test backend selection prefers the least loaded, non-open backend"""
+    from app.facefusion_client import BackendPool
+    
+    pool = BackendPool(["http://a:7860", "http://b:7860"])
+    pool.backends[0].outstanding = 3
+    assert pool.choose().url == "http://b:7860"
+    for _ in range(5):
+        pool.backends[1].breaker.record_failure()
+    assert pool.choose().url == "http://a:7860"
+
+def test_path_reference_payload(tmp_path, monkeypatch):
+    """Test files on the shared volume are sent as relative paths"""
+    from app.facefusion_client import FaceFusionClient, local_volume_id
+    
+    monkeypatch.setattr(settings, "shared_volume_root", tmp_path)
+    (tmp_path / "uploads").mkdir()
+    source = tmp_path / "uploads" / "a_face.jpg"
+    target = tmp_path / "uploads" / "b_clip.mp4"
+    source.write_bytes(b"img")
+    target.write_bytes(b"video")
+    
+    volume_id = local_volume_id(tmp_path)
+    assert volume_id and local_volume_id(tmp_path) == volume_id
+    
+    client = FaceFusionClient(base_url="http://facefusion:7860")
+    payload = client._path_reference_payload(source, target, tmp_path / "outputs" / "job.mp4")
+    assert payload["source_path"] == "uploads/a_face.jpg"
+    assert payload["output_path"] == "outputs/job.mp4"
+    assert payload["target_size"] == 5
+    
+    # Anything off the shared volume forces the multipart fallback
+    assert client._path_reference_payload(source, Path("/elsewhere/clip.mp4"), None) is None
+
+def test_path_reference_negotiation_falls_back(tmp_path, monkeypatch):
+    """Test a backend on a different volume receives a multipart upload"""
+    import asyncio
+    import httpx
+    from app import facefusion_client
+    
+    monkeypatch.setattr(settings, "shared_volume_root", tmp_path)
+    monkeypatch.setattr(settings, "facefusion_path_reference", True)
+    source = tmp_path / "face.jpg"
+    target = tmp_path / "clip.mp4"
+    source.write_bytes(b"img")
+    target.write_bytes(b"video")
+    requests = []
+    
+    def handler(request):
+        requests.append(request)
+        if request.url.path == "/api/capabilities":
+            return httpx.Response(200, json={"path_reference": True, "volume_id": "other-volume"})
+        return httpx.Response(200, json={"job_id": "remote-1", "output_url": "/out.mp4"})
+    
+    async def run():
+        monkeypatch.setattr(
+            facefusion_client, "_shared_http_client",
+            httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        async with facefusion_client.FaceFusionClient(base_url="http://ff:7860") as client:
+            return await client.process_face_swap(source, target, output_path=tmp_path / "out.mp4")
+    
+    result = asyncio.run(run())
+    assert result["path_reference"] is False
+    assert result["output_url"] == "http://ff:7860/out.mp4"
+    assert requests[0].url.path == "/api/capabilities"
+    assert requests[-1].headers["content-type"].startswith("multipart/form-data")
+
+def test_download_output_streams_and_trips_breaker_on_5xx(tmp_path, monkeypatch):
+    """Test downloads are written in full and failing 5xx responses open the backend's breaker"""
+    import asyncio
+    import httpx
+    from app import facefusion_client
+    
+    monkeypatch.setattr(facefusion_client, "DOWNLOAD_WRITE_BATCH", 1000)
+    monkeypatch.setattr(settings, "facefusion_retry_base_delay", 0)
+    body = bytes(range(256)) * 64
+    
+    def handler(request):
+        if request.url.path == "/broken.mp4":
+            return httpx.Response(500)
+        return httpx.Response(200, content=body)
+    
+    async def run():
+        monkeypatch.setattr(
+            facefusion_client, "_shared_http_client",
+            httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        async with facefusion_client.FaceFusionClient(base_url="http://ff:7860") as client:
+            await client.download_output("http://ff:7860/out.mp4", tmp_path / "out.mp4")
+            backend = client.pool.backends[0]
+            backend.breaker.failure_threshold = 2
+            for _ in range(2):
+                with pytest.raises(httpx.HTTPStatusError):
+                    await client.download_output("http://ff:7860/broken.mp4", tmp_path / "broken.mp4")
+            return backend.breaker.state
+    
+    assert asyncio.run(run()) == "open"
+    assert (tmp_path / "out.mp4").read_bytes() == body
+
+def test_celery_monitor_snapshot_from_events():
+    """Test cluster snapshot is built from events without touching the broker"""
+    import time
+    from app.celery_app import celery_app
+    from app.celery_monitor import ClusterStateMonitor
+    
+    monitor = ClusterStateMonitor(celery_app, snapshot_min_interval=0)
+    now = time.time()
+    host = "worker1@node"
+    monitor.on_event({"type": "worker-online", "hostname": host, "timestamp": now, "clock": 1, "local_received": now})
+    monitor.on_event({"type": "task-received", "uuid": "t1", "name": "app.tasks.process_face_swap",
+                      "hostname": host, "timestamp": now, "clock": 2, "local_received": now})
+    monitor.on_event({"type": "task-received", "uuid": "t2", "name": "app.tasks.process_face_swap",
+                      "hostname": host, "timestamp": now, "clock": 3, "local_received": now})
+    monitor.on_event({"type": "task-started", "uuid": "t1", "hostname": host,
+                      "timestamp": now, "clock": 4, "local_received": now})
+    
+    snapshot = monitor.snapshot()
+    assert snapshot["status"] == "connected"
+    assert [t["id"] for t in snapshot["active_tasks"][host]] == ["t1"]
+    assert [t["id"] for t in snapshot["reserved_tasks"][host]] == ["t2"]
+    assert snapshot["age_seconds"] is not None
+    
+    monitor.on_event({"type": "task-succeeded", "uuid": "t1", "hostname": host, "runtime": 12.0,
+                      "timestamp": now, "clock": 5, "local_received": now})
+    snapshot = monitor.snapshot()
+    assert host not in snapshot["active_tasks"]
+    assert snapshot["throughput"][host]["avg_runtime_seconds"] == 12.0
+
 def test_upload_video_invalid_format():
     """Test video upload with invalid format"""
     with tempfile.NamedTemporaryFile(suffix=".txt") as tmp:
@@ -64,6 +249,108 @@ def test_upload_video_success():
     assert "file_id" in data
     assert "filename" in data
 
+def test_upload_video_streams_hash():
+    """Test streamed upload reports size and SHA-256 of the stored file"""
+    import hashlib
+    content = b"fake video content" * 1000
+    response = client.post(
+        "/api/upload/video",
+        files={"file": ("test.mp4", content, "video/mp4")}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["size"] == len(content)
+    assert data["sha256"] == hashlib.sha256(content).hexdigest()
+    stored = list(settings.upload_dir.glob(f"{data['file_id']}_*"))
+    assert len(stored) == 1
+    assert stored[0].read_bytes() == content
+
+def test_upload_idempotency_key_replays_file_id():
+    """Test a retried upload with the same Idempotency-Key returns the original file"""
+    from app.main_improved import idempotency_store
+    
+    avoided = idempotency_store.duplicates_avoided()
+    headers = {"Idempotency-Key": "upload-retry-1"}
+    first = client.post(
+        "/api/upload/video",
+        files={"file": ("test.mp4", b"fake video content", "video/mp4")},
+        headers=headers
+    )
+    second = client.post(
+        "/api/upload/video",
+        files={"file": ("test.mp4", b"fake video content", "video/mp4")},
+        headers=headers
+    )
+    assert first.status_code == 200 and second.status_code == 200
+    assert second.json()["file_id"] == first.json()["file_id"]
+    assert second.json()["idempotent_replay"] is True
+    assert len(list(settings.upload_dir.glob("*_test.mp4"))) == 1
+    assert client.get("/health").json()["idempotency"]["duplicates_avoided"] == avoided + 1
+
+def test_process_idempotency_key(monkeypatch):
+    """Test failed submissions release the key and a reused key must match the body"""
+    headers = {"Idempotency-Key": "process-retry-1"}
+    body = {"video_id": "nonexistent", "image_id": "nonexistent"}
+    
+    # Failure (404) must not be cached: the retry runs again
+    assert client.post("/api/process", json=body, headers=headers).status_code == 404
+    assert client.post("/api/process", json=body, headers=headers).status_code == 404
+    
+    from app.idempotency import MemoryIdempotencyStore, DONE, MISMATCH, NEW, request_fingerprint
+    store = MemoryIdempotencyStore(ttl_seconds=60)
+    fingerprint = request_fingerprint(body)
+    assert store.begin("k", fingerprint) == (NEW, None)
+    store.complete("k", fingerprint, {"job_id": "abc"})
+    assert store.begin("k", fingerprint) == (DONE, {"job_id": "abc"})
+    assert store.begin("k", request_fingerprint({**body, "video_id": "other"}))[0] == MISMATCH
+
+def test_abandoned_idempotency_key_expires(monkeypatch):
+    """Test a key left pending by a crashed request frees after the pending TTL, not the result TTL"""
+    import app.idempotency as idempotency
+    from app.idempotency import MemoryIdempotencyStore, DONE, NEW, PENDING
+    
+    now = [1000.0]
+    monkeypatch.setattr(idempotency.time, "monotonic", lambda: now[0])
+    store = MemoryIdempotencyStore(ttl_seconds=86400, pending_ttl_seconds=30)
+    assert store.begin("k", "f", owner="first") == (NEW, None)
+    # No complete() or abandon(): the request died
+    now[0] += 29
+    assert store.begin("k", "f") == (PENDING, None)
+    now[0] += 2
+    assert store.begin("k", "f") == (NEW, None)
+    
+    # A late failure of the first owner leaves the new owner's marker alone
+    now[0] += 31
+    assert store.begin("k", "f", owner="second") == (NEW, None)
+    store.abandon("k", owner="first")
+    assert store.begin("k", "f", owner="third") == (PENDING, None)
+    store.abandon("k", owner="second")
+    assert store.begin("k", "f", owner="third") == (NEW, None)
+    
+    # A completed result keeps the long TTL
+    store.complete("k", "f", {"job_id": "abc"})
+    now[0] += 3600
+    assert store.begin("k", "f") == (DONE, {"job_id": "abc"})
+    
+    # Redis compares the owner and deletes in one script call
+    from app.idempotency import RedisIdempotencyStore
+    redis_client = Mock()
+    redis_store = RedisIdempotencyStore(redis_client, ttl_seconds=86400, pending_ttl_seconds=30)
+    redis_store.abandon("k", owner="first")
+    redis_store._abandon.assert_called_once_with(keys=["idempotency:k"], args=[PENDING, "first"])
+    redis_client.delete.assert_not_called()
+
+def test_upload_video_too_large(monkeypatch):
+    """Test oversized upload is aborted and the partial file removed"""
+    monkeypatch.setattr(settings, "max_upload_size_mb", 1)
+    content = b"x" * (3 * 1024 * 1024)
+    response = client.post(
+        "/api/upload/video",
+        files={"file": ("big.mp4", content, "video/mp4")}
+    )
+    assert response.status_code == 413
+    assert not list(settings.upload_dir.glob("*_big.mp4"))
+
 def test_upload_image_invalid_format():
     """Test image upload with invalid format"""
     with tempfile.NamedTemporaryFile(suffix=".bmp") as tmp:
@@ -76,20 +363,147 @@ def test_upload_image_invalid_format():
     assert response.status_code == 400
     assert "Invalid file format" in response.json()["detail"]
 
-def test_upload_image_success():
+def make_image_bytes(size=(400, 300), mode="RGB", image_format="JPEG", exif=None):
+    import io
+    from PIL import Image
+    
+    buffer = io.BytesIO()
+    image = Image.new(mode, size, (200, 150, 100, 128)[:len(mode)])
+    if exif is not None:
+        image.save(buffer, image_format, exif=exif)
+    else:
+        image.save(buffer, image_format)
+    return buffer.getvalue()
+
+@pytest.fixture
+def fake_face(monkeypatch):
+    """Pretend every image contains one face (the Haar detector needs a real photo)"""
+    monkeypatch.setattr("app.image_preprocess.detect_faces", lambda image: [(10, 10, 50, 50)])
+
+def test_upload_image_success(fake_face):
     """Test successful image upload"""
-    with tempfile.NamedTemporaryFile(suffix=".jpg") as tmp:
-        tmp.write(b"fake image content")
-        tmp.seek(0)
-        response = client.post(
-            "/api/upload/image",
-            files={"file": ("test.jpg", tmp, "image/jpeg")}
-        )
+    response = client.post(
+        "/api/upload/image",
+        files={"file": ("test.jpg", make_image_bytes(), "image/jpeg")}
+    )
     assert response.status_code == 200
     data = response.json()
     assert "file_id" in data
     assert "filename" in data
 
+def test_upload_image_not_an_image():
+    """Test upload of a file that isn't a decodable image"""
+    response = client.post(
+        "/api/upload/image",
+        files={"file": ("test.jpg", b"fake image content", "image/jpeg")}
+    )
+    assert response.status_code == 400
+    assert not list(settings.upload_dir.glob("*_test.jpg"))
+
+def test_upload_image_without_face_rejected():
+    """Test source images with no detectable face are rejected at upload time"""
+    response = client.post(
+        "/api/upload/image",
+        files={"file": ("blank.jpg", make_image_bytes(), "image/jpeg")}
+    )
+    assert response.status_code == 422
+    assert "No face" in response.json()["detail"]
+    assert not list(settings.upload_dir.glob("*_blank.jpg"))
+
+def test_upload_image_decompression_bomb_rejected():
+    """Test an image whose header declares huge dimensions is rejected with 413 and deleted"""
+    import struct
+    import zlib
+    
+    def png_chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    
+    # 40000x40000 RGB declared in IHDR; the file itself is a few dozen bytes
+    header = struct.pack(">IIBBBBB", 40000, 40000, 8, 2, 0, 0, 0)
+    bomb = b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", header) + png_chunk(b"IDAT", zlib.compress(b"")) + png_chunk(b"IEND", b"")
+    response = client.post(
+        "/api/upload/image",
+        files={"file": ("bomb.png", bomb, "image/png")}
+    )
+    assert response.status_code == 413
+    assert not list(settings.upload_dir.glob("*_bomb.png"))
+
+def test_upload_image_normalized(fake_face, monkeypatch):
+    """Test EXIF orientation, alpha/metadata stripping and downscaling"""
+    from PIL import Image
+    
+    monkeypatch.setattr(settings, "image_max_dimension", 200)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 CW
+    exif[0x010F] = "TestCam"
+    response = client.post(
+        "/api/upload/image",
+        files={"file": ("rotated.jpg", make_image_bytes((400, 300), exif=exif), "image/jpeg")}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["width"], data["height"]) == (150, 200)
+    with Image.open(next(settings.upload_dir.glob(f"{data['file_id']}_*"))) as stored:
+        assert stored.size == (150, 200)
+        assert not stored.getexif()
+    
+    response = client.post(
+        "/api/upload/image",
+        files={"file": ("alpha.png", make_image_bytes((100, 100), "RGBA", "PNG"), "image/png")}
+    )
+    with Image.open(next(settings.upload_dir.glob(f"{response.json()['file_id']}_*"))) as stored:
+        assert stored.mode == "RGB"
+
+def test_image_poster_preview(fake_face):
+    """Test an uploaded image gets a cached poster with long-lived cache headers"""
+    import io
+    from PIL import Image
+    
+    response = client.post(
+        "/api/upload/image",
+        files={"file": ("face.png", make_image_bytes((1200, 800), image_format="PNG"), "image/png")}
+    )
+    file_id = response.json()["file_id"]
+    
+    response = client.get(f"/api/preview/upload/{file_id}/poster.jpg")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    assert "immutable" in response.headers["cache-control"]
+    with Image.open(io.BytesIO(response.content)) as poster:
+        assert max(poster.size) == 640
+    
+    # Images have no scrub sprite
+    response = client.get(f"/api/preview/upload/{file_id}/sprite.jpg")
+    assert response.status_code == 404
+
+def test_failed_preview_is_remembered(tmp_path):
+    """Test a failed generation answers from its marker until the TTL expires, without running again"""
+    import asyncio
+    import time
+    from app.previews import FAILED_MARKER, PreviewService
+    
+    calls = []
+    
+    def broken(media_path, out_dir):
+        calls.append(media_path)
+        raise RuntimeError("ffmpeg failed: invalid data")
+    
+    service = PreviewService(max_workers=1, generate=broken, failure_ttl_seconds=60)
+    media = tmp_path / "clip.mp4"
+    out_dir = tmp_path / "previews"
+    for _ in range(3):
+        assert asyncio.run(service.ensure(media, out_dir, "poster.jpg")) is None
+    assert len(calls) == 1
+    assert "invalid data" in service.failure(out_dir)
+    
+    # Once the marker expires the next request tries again
+    old = time.time() - 120
+    os.utime(out_dir / FAILED_MARKER, (old, old))
+    assert service.failure(out_dir) is None
+    assert asyncio.run(service.ensure(media, out_dir, "poster.jpg")) is None
+    assert len(calls) == 2
+    service.shutdown()
+
 def test_process_missing_files():
     """Test process with missing files"""
     response = client.post(
@@ -98,12 +512,886 @@ def test_process_missing_files():
     )
     assert response.status_code == 404
 
+def test_process_rejected_when_queue_full(monkeypatch):
+    """Test /api/process sheds load with 503 and a Retry-After header"""
+    from app.main_improved import admission
+    
+    monkeypatch.setattr(admission, "max_queue_depth", 0)
+    response = client.post(
+        "/api/process",
+        json={"video_id": "nonexistent", "image_id": "nonexistent"}
+    )
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+
+def test_admission_controller_limits():
+    """Test per-client 429 and drain-time based 503 decisions"""
+    from fastapi import HTTPException
+    from app.admission import AdmissionController
+    
+    controller = AdmissionController(
+        max_queue_depth=100, max_wait_seconds=600, max_jobs_per_client=2, default_job_seconds=60
+    )
+    controller.check(queue_depth=5, workers=1, client_active=1)
+    
+    with pytest.raises(HTTPException) as exc:
+        controller.check(queue_depth=0, workers=1, client_active=2)
+    assert exc.value.status_code == 429
+    
+    # 20 queued jobs at 60s each on 1 worker = 1200s wait, 600s over the limit
+    with pytest.raises(HTTPException) as exc:
+        controller.check(queue_depth=20, workers=1)
+    assert exc.value.status_code == 503
+    assert exc.value.headers["Retry-After"] == "600"
+    
+    # Faster measured throughput admits the same backlog
+    for _ in range(20):
+        controller.throughput.record(10)
+    controller.check(queue_depth=20, workers=1)
+
+def test_client_slots_admit_concurrent_submissions_atomically():
+    """Test concurrent submissions cannot all pass the per-client limit, and refused jobs free their slot"""
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi import HTTPException
+    from app.admission import AdmissionController, ClientSlots, RedisClientSlots
+    
+    controller = AdmissionController(
+        max_queue_depth=100, max_wait_seconds=600, max_jobs_per_client=2, default_job_seconds=60
+    )
+    slots = ClientSlots()
+    
+    def submit(index):
+        try:
+            controller.admit(slots, "client", f"job-{index}", queue_depth=0, workers=1)
+            return 200
+        except HTTPException as e:
+            return e.status_code
+    
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        statuses = list(pool.map(submit, range(32)))
+    assert statuses.count(200) == 2 and statuses.count(429) == 30
+    assert slots.active("client") == 2
+    
+    # A job refused for the backlog gives its slot back
+    with pytest.raises(HTTPException) as exc:
+        controller.admit(slots, "other", "job-x", queue_depth=100, workers=1)
+    assert exc.value.status_code == 503
+    assert slots.active("other") == 0
+    
+    # Redis: the limit check and the add run as one script
+    redis_client = Mock()
+    redis_client.smembers.return_value = {b"done-task"}
+    redis_client.register_script.return_value.return_value = 0
+    redis_slots = RedisClientSlots(redis_client, is_finished=lambda task_id: True)
+    assert not redis_slots.try_acquire("client", "task-1", 2)
+    redis_client.srem.assert_called_once_with("admission:client:client", "done-task")
+    redis_client.register_script.return_value.assert_called_once_with(
+        keys=["admission:client:client", "admission:job:task-1"], args=["task-1", 2, 86400, "client"]
+    )
+    redis_client.get.return_value = b"client"
+    redis_slots.release("task-1")
+    redis_client.pipeline.return_value.srem.assert_called_once_with("admission:client:client", "task-1")
+
 def test_get_job_not_found():
     """Test getting non-existent job"""
     response = client.get("/api/job/nonexistent")
     assert response.status_code == 404
     assert "Job not found" in response.json()["detail"]
 
+def test_job_status_etag_and_long_poll():
+    """Test job status ETag, 304 revalidation and long-poll timeout"""
+    from app.main_improved import job_store, JobStatus
+    
+    job_store.add_job("etag-job", JobStatus(job_id="etag-job", status="pending", progress=0))
+    response = client.get("/api/job/etag-job")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    
+    response = client.get("/api/job/etag-job", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    
+    response = client.get("/api/job/etag-job?wait=0.5", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    
+    job = job_store.get_job("etag-job")
+    job.progress = 50
+    job_store.update_job("etag-job", job)
+    import time
+    time.sleep(0.3)  # let the micro-cache entry expire
+    response = client.get("/api/job/etag-job?wait=5", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["progress"] == 50
+    assert response.headers["etag"] != etag
+
+def test_status_cache_coalesces_concurrent_reads():
+    """Test concurrent lookups of one job share a single backend read"""
+    import asyncio
+    from app.job_status_cache import CoalescingStatusCache
+    
+    async def loader(job_id):
+        await asyncio.sleep(0.05)
+        return {"job_id": job_id, "status": "processing"}
+    
+    async def run():
+        cache = CoalescingStatusCache(loader=loader, ttl=10)
+        results = await asyncio.gather(*[cache.get("job") for _ in range(50)])
+        return cache.backend_reads, {etag for _, etag in results}
+    
+    reads, etags = asyncio.run(run())
+    assert reads == 1
+    assert len(etags) == 1
+
+def test_plan_chunks_and_live_playlist(tmp_path):
+    """Test chunk planning and the growing HLS playlist"""
+    from app.hls import LivePlaylist, plan_chunks
+    
+    assert plan_chunks(100, 10.0, 3) == [(0, 30), (30, 60), (60, 90), (90, 100)]
+    assert plan_chunks(100, 10.0, 3, start_frame=50, end_frame=70) == [(50, 70)]
+    
+    playlist = LivePlaylist(tmp_path, target_duration=3)
+    playlist.add_segment("seg_00000.ts", 3.0)
+    text = playlist.path.read_text()
+    assert "#EXT-X-PLAYLIST-TYPE:EVENT" in text
+    assert "seg_00000.ts" in text
+    assert "#EXT-X-ENDLIST" not in text
+    
+    playlist.add_segment("seg_00001.ts", 1.0)
+    playlist.finalize()
+    text = playlist.path.read_text()
+    assert text.count("#EXTINF") == 2
+    assert text.rstrip().endswith("#EXT-X-ENDLIST")
+
+def test_checkpoint_resumes_after_lost_worker(tmp_path):
+    """Test a redelivered job only renders the chunks missing from its checkpoint"""
+    import os
+    import time
+    from app.checkpoints import JobCheckpoint, checkpoint_dir, cleanup_expired_checkpoints, render_chunks
+    
+    ranges = [(0, 30), (30, 60), (60, 90)]
+    rendered = []
+    
+    def render_chunk(start, end, path):
+        rendered.append(start)
+        if start == 60 and len(rendered) == 3:
+            raise RuntimeError("worker lost")
+        path.write_bytes(b"x" * (end - start))
+    
+    directory = checkpoint_dir(tmp_path, "job-1")
+    checkpoint = JobCheckpoint(directory)
+    assert checkpoint.begin(ranges, "inputs") == 0
+    with pytest.raises(RuntimeError):
+        render_chunks(checkpoint, render_chunk)
+    
+    # Redelivery: first two chunks come from the checkpoint
+    checkpoint = JobCheckpoint(directory)
+    assert checkpoint.begin(ranges, "inputs") == 2
+    resumed = []
+    paths = render_chunks(checkpoint, render_chunk, lambda i, path, was_resumed: resumed.append(was_resumed))
+    assert rendered == [0, 30, 60, 60]
+    assert resumed == [True, True, False]
+    assert len(paths) == 3
+    
+    # Different inputs invalidate the checkpoint
+    assert JobCheckpoint(directory).begin(ranges, "other-inputs") == 0
+    
+    old = time.time() - 7200
+    os.utime(directory / "manifest.json", (old, old))
+    assert cleanup_expired_checkpoints(tmp_path, max_age_seconds=3600) == 1
+    assert not directory.exists()
+
+def test_local_executor_priority_limit_and_recovery(tmp_path):
+    """Test the local executor honours priority/FIFO, its concurrency cap and restarts"""
+    import asyncio
+    import time
+    from app.local_executor import LocalExecutor, LocalJobQueue
+    
+    queue = LocalJobQueue(tmp_path / "jobs.sqlite3")
+    queue.enqueue("low-1", {"n": 1})
+    queue.enqueue("low-2", {"n": 2})
+    queue.enqueue("high", {"n": 3}, priority=5)
+    assert queue.position("low-2") == 2
+    
+    # A job claimed before a crash is requeued ahead of later ones
+    assert queue.claim_next()["job_id"] == "high"
+    assert queue.count(("processing",)) == 1
+    
+    order = []
+    peak = 0
+    
+    async def handler(job_id, payload):
+        nonlocal peak
+        order.append(job_id)
+        peak = max(peak, len(executor.running))
+        await asyncio.sleep(0.01)
+        queue.update(job_id, status="completed", progress=100)
+    
+    executor = LocalExecutor(LocalJobQueue(tmp_path / "jobs.sqlite3"), handler, concurrency=1)
+    
+    async def run():
+        await executor.start()
+        await executor.submit("low-3", {"n": 4})
+        while executor.queue.count():
+            await asyncio.sleep(0.01)
+        await executor.stop()
+    
+    asyncio.run(run())
+    assert order == ["high", "low-1", "low-2", "low-3"]
+    assert peak == 1
+    assert executor.queue.get("low-3")["status"] == "completed"
+    
+    # Finished rows are purged periodically, not only at startup
+    async def purge():
+        await executor.start(purge_after_seconds=60, purge_interval_seconds=0.01)
+        with executor.queue._lock:
+            executor.queue._conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = 'low-1'", (time.time() - 120,))
+        for _ in range(100):
+            if executor.queue.get("low-1") is None:
+                break
+            await asyncio.sleep(0.01)
+        await executor.stop()
+    
+    asyncio.run(purge())
+    assert executor.queue.get("low-1") is None and executor.queue.get("low-3") is not None
+
+def test_job_log_ring_buffer(tmp_path, caplog):
+    """Test job logs keep a bounded tail, rate-limit forwarding and persist for the API"""
+    import logging
+    from app.job_logs import JobLog, job_log_path, read_job_log
+    
+    path = job_log_path(tmp_path, "job-1")
+    job_log = JobLog("job-1", max_lines=5, forward_per_second=2, path=path, flush_interval=3600)
+    with caplog.at_level(logging.INFO, logger="app.job_logs"):
+        for i in range(100):
+            job_log.append(f"frame {i}\n")
+    assert len([r for r in caplog.records if "[job-1]" in r.message]) == 2
+    
+    snapshot = job_log.snapshot(limit=3)
+    assert [entry["line"] for entry in snapshot["lines"]] == ["frame 97", "frame 98", "frame 99"]
+    assert snapshot["total_lines"] == 100 and snapshot["dropped"] == 95
+    assert job_log.tail(2) == "frame 98\nframe 99"
+    
+    job_log.flush()
+    persisted = read_job_log(path, limit=1)
+    assert persisted["lines"][0]["line"] == "frame 99"
+    assert read_job_log(tmp_path / "missing.json") is None
+    
+    # Event-loop callers flush from the threadpool, never on the loop's thread
+    import asyncio
+    import threading
+    async_log = JobLog("job-2", path=job_log_path(tmp_path, "job-2"), flush_interval=0)
+    flush_threads = []
+    flush = async_log.flush
+    async_log.flush = lambda: (flush_threads.append(threading.current_thread()), flush())
+    asyncio.run(async_log.append_async("frame 0\n"))
+    assert flush_threads and threading.main_thread() not in flush_threads
+    assert read_job_log(job_log_path(tmp_path, "job-2"))["lines"][0]["line"] == "frame 0"
+
+def test_template_chunks_skip_faceless_ranges(tmp_path):
+    """Test templates plan FaceFusion only for face ranges and evict least recently used"""
+    import os
+    import time
+    from app.media import VideoInfo
+    from app.templates import TemplateLibrary, face_ranges, plan_template_chunks
+    
+    # Samples every 5 frames; faces at frames 50-60 and 70 only
+    boxes = {frame: [] for frame in range(0, 200, 5)}
+    for frame in (50, 55, 60, 70):
+        boxes[frame] = [[10, 10, 40, 40]]
+    assert face_ranges(boxes, step=5, frame_count=200, pad_frames=5) == [(45, 80)]
+    
+    library = TemplateLibrary(tmp_path / "templates", max_bytes=10)
+    video = tmp_path / "clip.mp4"
+    video.write_bytes(b"v" * 8)
+    template = library.create("clip", video)
+    template.info = VideoInfo(width=64, height=64, fps=10.0, frame_count=200, duration=20.0, has_audio=False)
+    template.face_ranges = [(45, 80)]
+    
+    chunks = plan_template_chunks(template, chunk_seconds=2)
+    assert chunks[0] == (0, 20, False)
+    assert [c for c in chunks if c[2]] == [(45, 65, True), (65, 80, True)]
+    assert chunks[-1] == (180, 200, False)
+    assert sum(end - start for start, end, _ in chunks) == 200
+    
+    # Passthrough is opt-in; mixed plans are re-encoded at the join
+    from app.profiles import get_profile
+    from app.tasks import join_options, plan_job
+    assert all(swap for _, _, swap in plan_job(None, 2, template)[1])
+    with patch.object(settings, "template_passthrough", True):
+        assert plan_job(None, 2, template)[1] == chunks
+    profile = get_profile("fast")
+    assert join_options(chunks, profile) == {"preset": profile.output_video_preset, "crf": profile.crf}
+    assert join_options([(0, 20, True)], profile) == {}
+    
+    # Over budget: the older, idle template is evicted, the fresh one kept
+    library.protect_seconds = 60
+    template.size_bytes = 8
+    library._write(template)
+    newer = library.create("other", video)
+    newer.size_bytes = 8
+    library._write(newer)
+    old = time.time() - 3600
+    os.utime(library.template_dir(template.template_id) / ".last_used", (old, old))
+    assert library.evict() == [template.template_id]
+    assert library.get(template.template_id) is None
+    assert library.get(newer.template_id).name == "other"
+
+def test_storage_local_download_and_read_through_cache(tmp_path):
+    """Test local storage serves outputs and the worker input cache fetches stored uploads once"""
+    import time
+    from app.input_cache import ContentCache
+    from app.storage import OUTPUTS, UPLOADS, LocalStorage
+    
+    settings.output_dir.mkdir(exist_ok=True)
+    output = settings.output_dir / "job-1_output.mp4"
+    output.write_bytes(b"mp4 bytes")
+    response = client.get("/api/download/job-1_output.mp4")
+    assert response.status_code == 200
+    assert response.content == b"mp4 bytes"
+    
+    class RemoteStorage(LocalStorage):
+        remote = True
+        fetches = 0
+        
+        def fetch(self, area, name, dest):
+            RemoteStorage.fetches += 1
+            super().fetch(area, name, dest)
+    
+    remote = RemoteStorage(tmp_path / "bucket-uploads", tmp_path / "bucket-outputs")
+    for name in ("a_clip.mp4", "b_clip.mp4", "c_clip.mp4"):
+        source = tmp_path / name
+        source.write_bytes(b"x" * 6)
+        remote.put(UPLOADS, name, source)
+    
+    cache = ContentCache(tmp_path / "cache", max_bytes=10, fetchers=[], protect_seconds=0)
+    first = cache.find_stored(remote, UPLOADS, "a_")
+    assert first.read_bytes() == b"x" * 6
+    assert cache.find_stored(remote, UPLOADS, "a_") == first
+    assert RemoteStorage.fetches == 1
+    assert cache.find_stored(remote, UPLOADS, "missing_") is None
+    
+    # Over budget: the least recently used copy is evicted, unless a job holds it
+    old = time.time() - 60
+    os.utime(first, (old, old))
+    with cache.hold(lambda: cache.find_stored(remote, UPLOADS, "a_")) as held:
+        assert held == first
+        os.utime(first, (old, old))
+        second = cache.find_stored(remote, UPLOADS, "b_")
+        assert first.exists() and second.exists()
+    os.utime(first, (old, old))
+    os.utime(second, (old + 1, old + 1))
+    cache.find_stored(remote, UPLOADS, "c_")
+    assert not first.exists() and not second.exists()
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 3 and stats["fetched_storage"] == 3
+    
+    # Locks of evicted entries are removed with them
+    assert [p.name for p in (tmp_path / "cache" / ".locks").iterdir()] == ["c_clip.mp4.lock"]
+    
+    # Local storage is read in place
+    local = LocalStorage(tmp_path, tmp_path)
+    assert cache.find_stored(local, OUTPUTS, "a_") == tmp_path / "a_clip.mp4"
+    with cache.hold(lambda: tmp_path / "a_clip.mp4") as held:
+        assert held == tmp_path / "a_clip.mp4"
+
+def test_cpu_slots_follow_topology(tmp_path):
+    """Test CPU slots keep SMT siblings and NUMA nodes together and lease exclusively"""
+    from app.cpu_slots import SlotPool, discover_topology, parse_cpulist, plan_slots, read_cpu_times
+    
+    # 2 NUMA nodes x 4 cores x 2 threads; sibling of cpu N is cpu N+8
+    sys_cpu, sys_node = tmp_path / "cpu", tmp_path / "node"
+    for cpu in range(16):
+        topology = sys_cpu / f"cpu{cpu}" / "topology"
+        topology.mkdir(parents=True)
+        (topology / "core_id").write_text(str(cpu % 8))
+        (topology / "physical_package_id").write_text(str(cpu % 8 // 4))
+    for node, cpulist in ((0, "0-3,8-11"), (1, "4-7,12-15")):
+        (sys_node / f"node{node}").mkdir(parents=True)
+        (sys_node / f"node{node}" / "cpulist").write_text(cpulist)
+    assert parse_cpulist("0-2,8") == [0, 1, 2, 8]
+    
+    topology = discover_topology(list(range(16)), sys_cpu, sys_node)
+    slots = plan_slots(topology, cores_per_slot=2)
+    assert [slot.cpus for slot in slots] == [[0, 1, 8, 9], [2, 3, 10, 11], [4, 5, 12, 13], [6, 7, 14, 15]]
+    assert [slot.nodes for slot in slots] == [[0], [0], [1], [1]]
+    assert slots[0].facefusion_options() == {"execution_providers": "cpu", "execution_thread_count": 4}
+    assert len(plan_slots(topology, slot_count=3)) == 3
+    
+    proc_stat = tmp_path / "stat"
+    proc_stat.write_text("cpu  1 0 0 0\n" + "".join(f"cpu{c} 10 0 0 90 0\n" for c in range(16)))
+    pool = SlotPool(slots[:2], tmp_path / "locks", poll_interval=0.01, proc_stat=proc_stat)
+    assert read_cpu_times(proc_stat)[3] == (10, 100)
+    with pool.acquire() as first, pool.acquire() as second:
+        assert {first.slot.index, second.slot.index} == {0, 1}
+        assert pool.try_acquire() is None
+        proc_stat.write_text("".join(f"cpu{c} 85 0 0 115 0\n" for c in range(16)))
+        assert first.utilization() == 0.75
+        assert [entry["busy"] for entry in pool.snapshot()] == [True, True]
+    with pool.acquire(timeout=0) as lease:
+        assert lease.slot.index == 0
+
+def test_staged_pipeline_routes_and_timings():
+    """Test pipeline stages are routed by resource and timed separately"""
+    import time
+    from app.celery_app import celery_app
+    from app.celery_monitor import ClusterStateMonitor
+    from app.tasks import stage_timings
+    
+    routes = celery_app.conf.task_routes
+    assert routes["app.tasks.swap_job"] == "face_swap"
+    assert {routes[name] for name in ("app.tasks.prepare_job", "app.tasks.finalize_job", "app.tasks.build_template")} == {"media"}
+    
+    plan = {"stages": {
+        "prepare": {"started_at": 0.0, "finished_at": 2.0},
+        "swap": {"started_at": 5.0, "finished_at": 15.0},
+        "encode": {"started_at": 16.0, "finished_at": 19.0},
+    }}
+    assert stage_timings(plan) == {"prepare": 2.0, "swap": 10.0, "encode": 3.0, "queued": 4.0}
+    
+    # The GPU stage's chunks use the light preset, as the profile's one and only preset flag
+    from app.facefusion_cli import build_facefusion_command
+    from app.tasks import intermediate_profile
+    profile = intermediate_profile("quality")
+    cmd = build_facefusion_command("s.jpg", "t.mp4", "o.mp4", **profile.facefusion_options())
+    assert cmd.count("--output-video-preset") == 1
+    assert cmd[cmd.index("--output-video-preset") + 1] == settings.pipeline_intermediate_preset
+    assert profile.name == "quality" and profile.face_enhancer_model
+    
+    # Only GPU-stage runtimes feed the admission throughput estimate
+    runtimes = []
+    monitor = ClusterStateMonitor(
+        celery_app,
+        on_task_succeeded=lambda hostname, runtime: runtimes.append(runtime),
+        throughput_tasks={"app.tasks.swap_job"},
+    )
+    now = time.time()
+    for clock, (uuid, name, runtime) in enumerate([("p1", "app.tasks.prepare_job", 1.0), ("s1", "app.tasks.swap_job", 30.0)]):
+        monitor.on_event({"type": "task-received", "uuid": uuid, "name": name, "hostname": "w1",
+                          "timestamp": now, "clock": 2 * clock, "local_received": now})
+        monitor.on_event({"type": "task-succeeded", "uuid": uuid, "hostname": "w1", "runtime": runtime,
+                          "timestamp": now, "clock": 2 * clock + 1, "local_received": now})
+    assert runtimes == [30.0]
+
+def test_bulk_manifest_dedupes_and_resumes(tmp_path):
+    """Test bulk manifests skip finished outputs, merge duplicate rows and summarize throughput"""
+    import io
+    import json
+    import threading
+    import time
+    from app.bulk import BulkCancelled, _LocalProgress, load_manifest, options_to_args, plan_bulk, run_bulk
+    
+    (tmp_path / "face.jpg").write_bytes(b"face")
+    (tmp_path / "a.mp4").write_bytes(b"video a")
+    (tmp_path / "a_copy.mp4").write_bytes(b"video a")
+    (tmp_path / "b.mp4").write_bytes(b"video b")
+    (tmp_path / "out").mkdir()
+    (tmp_path / "out" / "done.mp4").write_bytes(b"finished")
+    manifest = tmp_path / "catalog.csv"
+    manifest.write_text(
+        "source,target,output,options\n"
+        "face.jpg,a.mp4,out/a.mp4,\n"
+        "face.jpg,a_copy.mp4,out/a2.mp4,\n"
+        'face.jpg,b.mp4,out/b.mp4,"{""face_detector_score"": 0.6}"\n'
+        "face.jpg,b.mp4,out/done.mp4,\n"
+    )
+    rows = load_manifest(manifest)
+    assert rows[2].options == {"face_detector_score": 0.6}
+    
+    jobs, skipped = plan_bulk(rows)
+    assert [row.line for row in skipped] == [5]
+    assert [[o.name for o in job.outputs] for job in jobs] == [["a.mp4", "a2.mp4"], ["b.mp4"]]
+    assert options_to_args({"face_detector_score": 0.6, "processors": ["face_swapper", "face_enhancer"]}) == [
+        "--face-detector-score", "0.6", "--processors", "face_swapper", "face_enhancer"
+    ]
+    
+    jsonl = tmp_path / "catalog.jsonl"
+    jsonl.write_text(json.dumps({"source": "face.jpg", "target": "a.mp4", "output": "out/x.mp4"}) + "\n\n")
+    assert load_manifest(jsonl)[0].target == tmp_path / "a.mp4"
+    
+    class FakeBackend:
+        def submit(self, job):
+            return job
+        
+        def poll(self, job, _):
+            if job.target.name == "b.mp4":
+                return "boom", 100
+            for output in job.outputs:
+                output.write_bytes(b"rendered")
+            return "done", 100
+        
+        def shutdown(self):
+            pass
+    
+    out = io.StringIO()
+    summary = run_bulk(jobs, FakeBackend(), parallelism=1, poll_interval=0, out=out)
+    assert summary["completed"] == 1 and summary["failed"] == 1 and summary["outputs_written"] == 2
+    assert "FAILED" in out.getvalue()
+    
+    # A re-run only picks up the failed row
+    jobs, skipped = plan_bulk(load_manifest(manifest))
+    assert [job.outputs[0].name for job in jobs] == ["b.mp4"] and len(skipped) == 3
+    
+    # Ctrl-C cancels the jobs in flight before the CLI exits
+    class InterruptedBackend(FakeBackend):
+        cancelled = None
+        
+        def poll(self, job, _):
+            raise KeyboardInterrupt
+        
+        def cancel(self, handles):
+            InterruptedBackend.cancelled = handles
+    
+    with pytest.raises(KeyboardInterrupt):
+        run_bulk(jobs, InterruptedBackend(), parallelism=2, poll_interval=0, out=out)
+    assert InterruptedBackend.cancelled == jobs
+    
+    # A cancelled local render stops at its next chunk
+    cancelled = threading.Event()
+    progress = _LocalProgress(lambda current: None, cancelled)
+    progress.update_state(meta={"current": 40})
+    cancelled.set()
+    with pytest.raises(BulkCancelled):
+        progress.update_state(meta={"current": 50})
+    
+    # Workers refuse a job id another worker is still rendering
+    from app import tasks
+    held = Mock()
+    held.lock.return_value.acquire.return_value = False
+    with patch.object(tasks, "broker_redis", held):
+        with pytest.raises(Exception, match="別のワーカー"):
+            with tasks.exclusive_job("bulk-abc"):
+                pass
+    free = Mock()
+    with patch.object(tasks, "broker_redis", free):
+        with tasks.exclusive_job("bulk-abc", ttl=0.03):
+            time.sleep(0.05)
+    assert free.lock.call_args == (("bulk:running:bulk-abc",), {"timeout": 0.03})
+    free.lock.return_value.extend.assert_called_with(0.03, replace_ttl=True)
+    free.lock.return_value.release.assert_called_once()
+
+def test_autoscaler_policy_scales_on_backlog_with_hysteresis():
+    """キュー滞留に応じたスケール判断（上昇は即時、縮小は遅延付き）"""
+    import json
+    from app.autoscaler import ScalingPolicy, ScalingSignals, oldest_wait_seconds
+    
+    policy = ScalingPolicy(min_workers=1, max_workers=6, target_wait_seconds=300,
+                           max_job_age_seconds=600, scale_down_delay_seconds=120, max_step=2)
+    
+    # 10 jobs x 120s = 1200s of work -> 4 workers, reached two at a time
+    up = policy.decide(ScalingSignals(backlog=10, current=1, avg_job_seconds=120), now=0)
+    assert up.wanted == 4 and up.desired == 3
+    
+    # Short jobs: the backlog alone wants one worker, but an old job adds one
+    aged = policy.decide(ScalingSignals(backlog=3, oldest_wait_seconds=900, current=1, avg_job_seconds=10), now=0)
+    assert aged.desired == 2 and "oldest job" in aged.reason
+    
+    # Measured memory caps growth regardless of the backlog
+    capped = policy.decide(ScalingSignals(backlog=50, current=2, avg_job_seconds=600, busy=2,
+                                          memory_per_job_mb=4096, memory_available_mb=2048 + 4096), now=0)
+    assert capped.wanted == 3 and "memory" in capped.reason
+    
+    # Shrinking waits out the delay, then steps down one at a time
+    idle = ScalingSignals(backlog=0, current=4, avg_job_seconds=120)
+    assert policy.decide(idle, now=100).desired == 4
+    assert policy.decide(idle, now=200).desired == 4
+    assert policy.decide(idle, now=220).desired == 3
+    assert policy.decide(idle.copy(update={"current": 3}), now=230).desired == 3
+    # New work cancels a pending scale-down
+    assert policy.decide(ScalingSignals(backlog=3, current=3, avg_job_seconds=300), now=400).desired == 3
+    assert policy.decide(idle.copy(update={"current": 3}), now=410).desired == 3
+    
+    message = json.dumps({"headers": {"enqueued_at": 1000.0}}).encode()
+    pipe = Mock()
+    pipe.execute.return_value = [message, None] + [b"not json"] * 8
+    broker = Mock()
+    broker.pipeline.return_value = pipe
+    assert oldest_wait_seconds(broker, now=1045.0) == 45.0
+    assert pipe.lindex.call_count == 10
+    
+    # media ワーカーと prepare_job/finalize_job は face_swap の容量・滞留に数えない
+    from app.autoscaler import face_swap_tasks, face_swap_workers
+    snapshot = {
+        "workers": {"face_swap@gpu1": {"alive": True}, "face_swap@gpu2": {"alive": False},
+                    "media@cpu1": {"alive": True}},
+        "active_tasks": {"face_swap@gpu1": [{"name": "app.tasks.swap_job"}],
+                         "media@cpu1": [{"name": "app.tasks.finalize_job"}]},
+        "reserved_tasks": {"face_swap@gpu1": [{"name": "app.tasks.swap_job"}],
+                           "media@cpu1": [{"name": "app.tasks.prepare_job"}, {"name": "app.tasks.prepare_job"}]},
+    }
+    assert face_swap_workers(snapshot) == ["face_swap@gpu1"]
+    assert face_swap_tasks(snapshot) == 2
+    assert face_swap_tasks(snapshot, kinds=("reserved_tasks",)) == 1
+
+def test_content_cache_coalesces_fetches_and_evicts(tmp_path):
+    """ダイジェストで解決する入力キャッシュ（同時取得の集約・検証・LRU追い出し）"""
+    import hashlib
+    import threading
+    import time
+    from app.input_cache import ContentCache, InputRef, SharedPathFetcher
+    
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    template = shared / "template.mp4"
+    template.write_bytes(b"template video" * 1000)
+    digest = hashlib.sha256(template.read_bytes()).hexdigest()
+    ref = InputRef(digest=digest, name="video.mp4", area="templates", path=str(template))
+    
+    class CorruptFetcher:
+        name = "corrupt"
+        
+        def fetch(self, ref, dest):
+            dest.write_bytes(b"truncated")
+            return True
+    
+    class SlowFetcher(SharedPathFetcher):
+        calls = 0
+        
+        def fetch(self, ref, dest):
+            SlowFetcher.calls += 1
+            time.sleep(0.2)
+            return super().fetch(ref, dest)
+    
+    exported = []
+    cache = ContentCache(tmp_path / "cache", max_bytes=20000, fetchers=[CorruptFetcher(), SlowFetcher()],
+                         protect_seconds=0, on_lookup=exported.append)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(ref))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    # One download despite four concurrent lookups; the corrupt copy was rejected
+    assert SlowFetcher.calls == 1
+    assert len(set(results)) == 1 and results[0].read_bytes() == template.read_bytes()
+    assert results[0].suffix == ".mp4"
+    stats = cache.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 3 and stats["coalesced"] == 3
+    assert stats["fetched_shared"] == 1 and stats["hit_rate"] == 0.75
+    assert {"misses": 1, "bytes_fetched": 14000, "fetched_shared": 1} in exported
+    
+    # A second input pushes the cache over its cap and evicts the least recently used one
+    other = shared / "face.jpg"
+    other.write_bytes(b"face" * 2000)
+    other_ref = InputRef(digest=hashlib.sha256(other.read_bytes()).hexdigest(), name="face.jpg", path=str(other))
+    os.utime(results[0], (time.time() - 60, time.time() - 60))
+    assert cache.get(other_ref).is_file()
+    assert not results[0].exists()
+    
+    missing = InputRef(digest="0" * 64, name="gone.mp4", path=str(shared / "gone.mp4"))
+    with pytest.raises(FileNotFoundError):
+        cache.get(missing)
+
+def test_target_range_restricts_chunk_plan():
+    """範囲指定: 範囲外の除外・無加工での結合と、進捗・コストへの反映"""
+    from pydantic import ValidationError
+    from app.ranges import TargetRange, progress_fractions, restrict_chunks, swap_frames
+    
+    # 3 minutes at 25 fps in 60s chunks
+    chunks = [(0, 1500, True), (1500, 3000, True), (3000, 4500, True)]
+    excerpt = TargetRange(start=62, end=67)
+    frame_range = excerpt.to_frames(25.0, 4500)
+    assert frame_range == (1550, 1675)
+    
+    assert restrict_chunks(chunks, frame_range) == [(1550, 1675, True)]
+    spliced = restrict_chunks(chunks, frame_range, "splice")
+    assert spliced == [(0, 1500, False), (1500, 1550, False), (1550, 1675, True), (1675, 3000, False), (3000, 4500, False)]
+    assert swap_frames(spliced) == 125
+    # Passthrough chunks do not move the progress bar
+    assert progress_fractions(spliced) == [0.0, 0.0, 1.0, 1.0, 1.0]
+    
+    # Frame bounds are clamped to the video; an open end runs to the last frame
+    assert TargetRange(start_frame=4000).to_frames(25.0, 4500) == (4000, 4500)
+    assert TargetRange(start_frame=10, end_frame=99999).to_frames(25.0, 4500) == (10, 4500)
+    with pytest.raises(ValueError):
+        TargetRange(start=500).to_frames(25.0, 4500)
+    with pytest.raises(ValidationError):
+        TargetRange(start=5, start_frame=125)
+    with pytest.raises(ValidationError):
+        TargetRange(start=10, end=5)
+
+def test_processing_profiles_drive_command_and_estimates(tmp_path):
+    """Test profiles are validated, map to FaceFusion flags and estimate from measured fps"""
+    import json
+    from app.facefusion_cli import build_facefusion_command
+    from app.profiles import ProfileStats, estimate_job, get_profile, load_profiles
+    
+    response = client.post("/api/process", json={"video_id": "v", "image_id": "i", "profile": "ludicrous"})
+    assert response.status_code == 422
+    
+    quality = get_profile("quality")
+    cmd = build_facefusion_command("face.jpg", "target.mp4", "out.mp4", **quality.facefusion_options())
+    assert cmd[cmd.index("--face-detector-model") + 1] == "retinaface"
+    assert cmd[cmd.index("--processors") + 1:cmd.index("--log-level")] == ["face_swapper", "face_enhancer", "frame_enhancer"]
+    assert cmd[cmd.index("--output-video-preset") + 1] == "slow"
+    assert "--face-enhancer-model" not in build_facefusion_command("a", "b", "c", **get_profile("fast").facefusion_options())
+    assert get_profile().name == settings.default_profile
+    # The service API keeps the detector and enhancers it sent before profiles existed
+    service = get_profile(settings.service_default_profile).api_options()
+    assert (service["face_detector_model"], service["face_enhancer_model"], service["frame_enhancer_model"]) == (
+        "retinaface", "gfpgan_1.4", "real_esrgan_x4plus"
+    )
+    
+    # Nominal fps until a job of that profile has been measured
+    stats = ProfileStats(window=2)
+    estimate = estimate_job(quality, stats, frames=300, wait_seconds=60, default_job_seconds=120, now=1000)
+    assert not estimate["fps_measured"] and estimate["estimated_render_seconds"] == 200.0
+    stats.record("quality", 100, 50)
+    stats.record("quality", 300, 50)
+    estimate = estimate_job(quality, stats, frames=300, wait_seconds=60, default_job_seconds=120, now=1000)
+    assert estimate["fps"] == 4.0 and estimate["estimated_completion_at"] == 1000 + 60 + 75
+    stats.record("quality", 30, 30)  # The window keeps the latest two samples
+    assert round(stats.fps("quality"), 2) == 4.12
+    # Unknown length falls back to the average job time
+    assert estimate_job(quality, stats, None, 0, 120)["estimated_render_seconds"] == 120
+    
+    overrides = tmp_path / "profiles.json"
+    overrides.write_text(json.dumps([
+        {"name": "fast", "output_video_resolution": "1280x720"},
+        {"name": "preview", "output_video_quality": 50, "nominal_fps": 40},
+    ]))
+    profiles = load_profiles(overrides)
+    assert profiles["fast"].output_video_resolution == "1280x720" and profiles["fast"].nominal_fps == 20.0
+    assert profiles["preview"].crf == 26 and list(profiles) == ["fast", "balanced", "quality", "preview"]
+
+def test_duplicate_frames_decimated_into_runs(tmp_path):
+    """Test static frames collapse into runs while small motion and slow fades do not"""
+    import numpy as np
+    from app.checkpoints import input_fingerprint
+    from app.decimate import DecimationReport, decimate_video, duplicate_runs, frame_signature
+    
+    still = np.full((360, 640, 3), 120, dtype=np.uint8)
+    noisy = still.copy()
+    noisy[::7, ::5] = 124  # Encoder noise
+    mouth = still.copy()
+    mouth[200:230, 300:350] = 30  # A mouth opening in a talking head
+    frames = [still, noisy, still, mouth, mouth, still]
+    # Each fade step is below the threshold, but the fade as a whole is not
+    frames += [np.full_like(still, 120 + 3 * step) for step in range(1, 6)]
+    
+    runs = duplicate_runs((frame_signature(frame) for frame in frames), max_diff=6)
+    assert runs == [3, 2, 3, 3]
+    assert sum(runs) == len(frames)
+    
+    report = DecimationReport(fingerprint="f", fps=25.0, frames=sum(runs), runs=runs, applied=True)
+    assert report.summary() == {
+        "applied": True, "frames": 11, "unique_frames": 4, "duplicate_frames": 7, "duplicate_ratio": 0.636,
+    }
+    
+    # A report from an earlier attempt on the same target is reused without decoding again
+    target = tmp_path / "target.mp4"
+    target.write_bytes(b"video")
+    directory = tmp_path / "job.decimate"
+    directory.mkdir()
+    fingerprint = input_fingerprint(target, max_diff=6, min_ratio=0.1)
+    previous = report.model_copy(update={"fingerprint": fingerprint, "applied": False})
+    (directory / "report.json").write_text(previous.model_dump_json())
+    assert decimate_video(target, directory, 6, 0.1) == previous
+
+def test_job_store_expiry_and_broadcast_fanout():
+    """Test expired jobs are dropped from the head and broadcast drops failing clients"""
+    import asyncio
+    from datetime import datetime, timedelta
+    from app.main_improved import ConnectionManager, JobStatus, JobStore
+    
+    store = JobStore(ttl_hours=1)
+    for job_id in ("a", "b", "c"):
+        store.add_job(job_id, JobStatus(job_id=job_id, status="pending", progress=0))
+    # Re-adding a job moves it behind the others
+    store.add_job("a", JobStatus(job_id="a", status="pending", progress=0))
+    assert list(store.jobs) == ["b", "c", "a"]
+    store.jobs["b"] = (store.jobs["b"][0], datetime.now() - timedelta(hours=2))
+    store.add_job("d", JobStatus(job_id="d", status="pending", progress=0))
+    assert list(store.jobs) == ["c", "a", "d"]
+    
+    class FakeWebSocket:
+        def __init__(self, fail=False):
+            self.fail = fail
+            self.messages = []
+        
+        async def send_text(self, message):
+            await asyncio.sleep(0.01)
+            if self.fail:
+                raise RuntimeError("connection closed")
+            self.messages.append(message)
+    
+    manager = ConnectionManager()
+    sockets = {f"client-{index}": FakeWebSocket(fail=index == 3) for index in range(50)}
+    manager.active_connections.update(sockets)
+    asyncio.run(manager.broadcast("hello"))
+    assert "client-3" not in manager.active_connections
+    assert len(manager.active_connections) == 49
+    assert all(ws.messages == ["hello"] for client_id, ws in sockets.items() if client_id != "client-3")
+
+def test_face_gallery_clusters_identities_and_selects_reference(monkeypatch):
+    """Test faces cluster into identities that map to FaceFusion's reference options"""
+    import time
+    import numpy as np
+    from app.face_gallery import (
+        DONE_MARKER, FaceGallery, FaceIdentity, FaceSighting, GALLERY_INDEX,
+        cluster_faces, gallery_dir, pick_reference, reference_options,
+    )
+    from app.facefusion_cli import build_facefusion_command
+    
+    def embedding(seed):
+        vector = np.random.default_rng(seed).normal(size=64).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+    
+    lead, extra = embedding(1), embedding(2)
+    sightings = []
+    # Lead and an extra on frames 0-50 (sampled every 25), the lead alone at 200 after a cut
+    for frame, faces in ((0, 2), (25, 2), (50, 2)):
+        sightings.append((FaceSighting(frame=frame, box=(100 + frame, 100, 200, 200), position=0, faces=faces), lead))
+        sightings.append((FaceSighting(frame=frame, box=(900, 400, 60, 60), position=1, faces=faces), extra))
+    # Different box, so only appearance can re-identify the lead
+    sightings.append((FaceSighting(frame=200, box=(600, 50, 150, 150), position=0, faces=1), lead + 0.05 * extra))
+    
+    clusters = cluster_faces(sightings, step=25, match_threshold=0.75)
+    assert sorted(clusters, key=len, reverse=True) == [[0, 2, 4, 6], [1, 3, 5]]
+    # Alone in the frame beats a larger face among others
+    assert pick_reference([sightings[index][0] for index in clusters[0]]).frame == 200
+    
+    options = reference_options({"frame": 200, "position": 0})
+    cmd = build_facefusion_command("s.jpg", "t.mp4", "o.mp4", **options)
+    assert cmd[cmd.index("--face-selector-mode") + 1] == "reference"
+    assert cmd[cmd.index("--reference-frame-number") + 1] == "200"
+    assert cmd[cmd.index("--face-selector-order") + 1] == "large-small"
+    assert reference_options(None) == {}
+    assert "--face-selector-mode" not in build_facefusion_command("s.jpg", "t.mp4", "o.mp4")
+    
+    # A cached gallery is served as is and validates reference_face
+    video_id = "gallery-video"
+    settings.upload_dir.mkdir(exist_ok=True)
+    (settings.upload_dir / f"{video_id}_clip.mp4").write_bytes(b"video")
+    out_dir = gallery_dir(settings.upload_dir, video_id)
+    out_dir.mkdir(parents=True)
+    identity = FaceIdentity(
+        identity=0, sightings=4, first_frame=0, last_frame=200, reference_frame=200,
+        reference_position=0, box=(600, 50, 150, 150), thumbnail="0.jpg",
+    )
+    gallery = FaceGallery(
+        video="clip.mp4", fps=25.0, frame_count=250, sample_step=25, identities=[identity], created_at=time.time()
+    )
+    (out_dir / GALLERY_INDEX).write_text(gallery.model_dump_json())
+    (out_dir / DONE_MARKER).touch()
+    
+    response = client.get(f"/api/faces/{video_id}")
+    assert response.status_code == 200
+    assert response.json()["identities"][0]["thumbnail_url"] == f"/api/faces/{video_id}/0.jpg"
+    assert gallery.reference(0) == {"frame": 200, "position": 0}
+    
+    response = client.post("/api/process", json={"video_id": video_id, "image_id": "x", "reference_face": 3})
+    assert response.status_code == 400
+    
+    # /api/process never builds a gallery itself: it queues the build and answers 409
+    from app.main_improved import gallery_service
+    schedule = Mock()
+    monkeypatch.setattr(gallery_service, "schedule", schedule)
+    (settings.upload_dir / "unscanned_clip.mp4").write_bytes(b"video")
+    response = client.post("/api/process", json={"video_id": "unscanned", "image_id": "x", "reference_face": 0})
+    assert response.status_code == 409 and "/api/faces/unscanned" in response.json()["detail"]
+    assert schedule.call_args[0][1] == gallery_dir(settings.upload_dir, "unscanned")
+    assert client.get("/api/faces/missing-video").status_code == 404
+
 def test_download_file_not_found():
     """Test downloading non-existent file"""
     response = client.get("/api/download/nonexistent.mp4")
@@ -46,46 +46,54 @@ function App() {
     }
   }, [jobId, taskId])
 
-  // ポーリングでタスク状態を確認（WebSocketのバックアップ）
+  // ロングポーリングでタスク状態を確認（WebSocketのバックアップ）
+  // ETagを送り、状態が変わるまでサーバー側で待機してもらう
   useEffect(() => {
-    if (taskId) {
-      // 初回チェック
-      checkTaskStatus()
-      
-      // 定期的にチェック
-      intervalRef.current = setInterval(() => {
-        checkTaskStatus()
-      }, 2000) // 2秒ごと
-      
-      return () => {
-        if (intervalRef.current) {
-          clearInterval(intervalRef.current)
+    if (!taskId) return
+
+    let cancelled = false
+    const controller = new AbortController()
+    intervalRef.current = controller
+
+    const poll = async () => {
+      let etag = null
+      while (!cancelled) {
+        try {
+          const response = await axios.get(`${API_URL}/api/job/${taskId}`, {
+            params: etag ? { wait: 30 } : {},
+            headers: etag ? { 'If-None-Match': etag } : {},
+            signal: controller.signal,
+            validateStatus: (status) => status === 200 || status === 304,
+          })
+          if (response.status === 304) continue
+
+          etag = response.headers.etag || null
+          const data = response.data
+          console.log('タスク状態:', data)
+          setJobStatus(data)
+
+          // 完了または失敗したらポーリング停止
+          if (data.status === 'completed' || data.status === 'failed') {
+            break
+          }
+          // ETag非対応のサーバーでは従来通り2秒間隔
+          if (!etag) await new Promise((resolve) => setTimeout(resolve, 2000))
+        } catch (error) {
+          if (cancelled) break
+          console.error('タスク状態確認エラー:', error)
+          await new Promise((resolve) => setTimeout(resolve, 2000))
         }
       }
     }
-  }, [taskId])
 
-  const checkTaskStatus = async () => {
-    if (!taskId) return
-    
-    try {
-      const response = await axios.get(`${API_URL}/api/job/${taskId}`)
-      const data = response.data
-      console.log('タスク状態:', data)
-      
-      setJobStatus(data)
-      
-      // 完了または失敗したらポーリング停止
-      if (data.status === 'completed' || data.status === 'failed') {
-        if (intervalRef.current) {
-          clearInterval(intervalRef.current)
-          intervalRef.current = null
-        }
-      }
-    } catch (error) {
-      console.error('タスク状態確認エラー:', error)
+    poll()
+
+    return () => {
+      cancelled = true
+      controller.abort()
+      intervalRef.current = null
     }
-  }
+  }, [taskId])
 
   const onDropVideo = async (acceptedFiles) => {
     const file = acceptedFiles[0]